@@ -13,12 +13,14 @@ import argparse
 import tempfile
 from datetime import datetime, timedelta
 
+import numpy as np
 import pandas as pd
 import geopandas as gpd
 from searvey.coops import COOPS_TidalDatum
 from searvey.coops import COOPS_TimeZone
 from searvey.coops import COOPS_Units
-from shapely.geometry import box
+from pyproj import Geod
+from shapely.geometry import box, Polygon
 from stormevents import StormEvent
 from stormevents.nhc import VortexTrack
 
@@ -32,6 +34,96 @@ logging.basicConfig(
 
 EFS_MOUNT_POINT = pathlib.Path('~').expanduser() / f'app/io/output'
 
+ISOTACH_QUADRANTS = ('NEQ', 'SEQ', 'SWQ', 'NWQ')
+NAUTICAL_MILE = 1852.0
+GEODETIC = Geod(ellps='WGS84')
+
+
+def get_windswath(track_data, advisory, track_start_time, wind_speed=34, segments=91):
+    '''Calculate the isotach windswath of a single track
+
+    Unlike `VortexTrack.wind_swaths` which builds the swaths of all
+    the advisories and all the track start times, only the swath of
+    the requested track is calculated.
+
+    Parameters
+    ----------
+    track_data: gpd.GeoDataFrame
+        track dataframe (`VortexTrack.data`)
+    advisory: str
+        advisory of the track to calculate the swath for
+    track_start_time: datetime
+        start time of the track to calculate the swath for
+    wind_speed: int
+        isotach wind speed in knots
+    segments: int
+        number of vertices on each isotach quadrant arc
+
+    Returns
+    -------
+    shapely.geometry.Polygon
+        union of the consecutive isotach convex hulls
+    '''
+
+    isotach_data = track_data[
+        (track_data.advisory == advisory)
+        & (track_data.track_start_time == track_start_time)
+        & (track_data.isotach_radius == wind_speed)
+    ].sort_values('datetime')
+
+    radii = isotach_data[
+        [f'isotach_radius_for_{quad}' for quad in ISOTACH_QUADRANTS]
+    ].to_numpy(dtype=float) * NAUTICAL_MILE
+    # NOTE: Missing (NaN) and zero radius quadrants have no arc
+    has_arc = np.isfinite(radii) & (radii > 0)
+    has_isotach = has_arc.any(axis=1)
+    isotach_data = isotach_data[has_isotach]
+    radii = radii[has_isotach]
+    has_arc = has_arc[has_isotach]
+    if len(isotach_data) == 0:
+        raise ValueError(
+            f"No {wind_speed}kt isotach found for {advisory} track"
+            f" starting at {track_start_time}!"
+        )
+
+    # All isotach vertices for all track points are calculated in a
+    # single geodesic call: (point, quadrant, segment)
+    n_pts = len(isotach_data)
+    shape = (n_pts, len(ISOTACH_QUADRANTS), segments)
+    azimuths = (
+        np.arange(len(ISOTACH_QUADRANTS))[:, None] * 90.
+        + np.linspace(0., 90., segments)[None, :]
+    )
+    lons, lats, _ = GEODETIC.fwd(
+        np.broadcast_to(isotach_data.longitude.values[:, None, None], shape).ravel(),
+        np.broadcast_to(isotach_data.latitude.values[:, None, None], shape).ravel(),
+        np.broadcast_to(azimuths[None, :, :], shape).ravel(),
+        np.broadcast_to(np.where(has_arc, radii, 0.)[:, :, None], shape).ravel(),
+    )
+    arcs = np.stack((lons, lats), axis=-1).reshape(*shape, 2)
+
+    # Quadrants without an arc are replaced by the track point
+    centers = isotach_data[['longitude', 'latitude']].to_numpy(dtype=float)
+    rings = [
+        np.concatenate([
+            arcs[pt, quad] if has_arc[pt, quad] else centers[pt, None]
+            for quad in range(len(ISOTACH_QUADRANTS))
+        ])
+        for pt in range(n_pts)
+    ]
+    isotachs = gpd.GeoSeries(
+        [Polygon(ring) for ring in rings], crs="EPSG:4326"
+    ).buffer(0)
+    if n_pts == 1:
+        return isotachs.iloc[0]
+
+    hulls = isotachs.iloc[:-1].reset_index(drop=True).union(
+        isotachs.iloc[1:].reset_index(drop=True)
+    ).convex_hull
+
+    return hulls.unary_union
+
+
 def main(args):
 
     name_or_code = args.name_or_code
@@ -132,13 +224,13 @@ def main(args):
         gdf_track.forecast_hours = 0
         track = VortexTrack(storm=gdf_track, file_deck='b', advisories=['BEST'])
 
-        windswath_dict = track.wind_swaths(wind_speed=34)
-        windswaths = windswath_dict['BEST']  # Faked BEST
         logger.info(f"Fetching {advisory} windswath...")
-        windswath_time = min(pd.to_datetime(list(windswaths.keys())))
-        windswath = windswaths[
-            windswath_time.strftime("%Y%m%dT%H%M%S")
-        ]
+        isotach_data = track.data[track.data.isotach_radius == 34]
+        windswath = get_windswath(
+            track.data, 'BEST',  # Faked BEST
+            isotach_data.track_start_time.min(),
+            wind_speed=34
+        )
 
     else:
 
@@ -149,15 +241,15 @@ def main(args):
 
         logger.info("Fetching BEST windswath...")
         track = event.track(file_deck='b')
-        windswath_dict = track.wind_swaths(wind_speed=34)
         # NOTE: event.start_date (first advisory date) doesn't
-        # necessarily match the windswath key which comes from track
-        # start date for the first advisory (at least in 2021!)
-        windswaths = windswath_dict['BEST']
-        latest_advistory_stamp = max(pd.to_datetime(list(windswaths.keys())))
-        windswath = windswaths[
-            latest_advistory_stamp.strftime("%Y%m%dT%H%M%S")
-        ]
+        # necessarily match the windswath track start date for the
+        # first advisory (at least in 2021!)
+        isotach_data = track.data[track.data.isotach_radius == 34]
+        windswath = get_windswath(
+            track.data, 'BEST',
+            isotach_data.track_start_time.max(),
+            wind_speed=34
+        )
 
         logger.info("Fetching water level measurements from COOPS stations...")
         coops_ssh = event.coops_product_within_isotach(
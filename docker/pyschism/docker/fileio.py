@@ -0,0 +1,76 @@
+"""Filesystem helpers shared by the setup and combine scripts
+
+Cache objects, shared member inputs and WWM grids are all placed into
+run directories with `link_file`, and all the JSON manifests and
+indices are written with `write_json_atomic` so that readers never see
+a partially written file.
+"""
+
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+from pathlib import Path
+
+
+# From linux/fs.h, clone a file's extents (reflink) on CoW filesystems
+FICLONE = 0x40049409
+
+
+def file_digest(path: Path, blocksize: int = 2**20) -> str:
+    '''SHA-256 hex digest of the contents of a file'''
+
+    m = hashlib.sha256()
+    with open(path, 'rb') as fp:
+        for block in iter(lambda: fp.read(blocksize), b''):
+            m.update(block)
+    return m.hexdigest()
+
+
+def reflink(src: Path, dst: Path) -> None:
+    '''Copy `src` to `dst` sharing its extents, fails if not CoW'''
+
+    with open(src, 'rb') as fp_src, open(dst, 'wb') as fp_dst:
+        try:
+            fcntl.ioctl(fp_dst.fileno(), FICLONE, fp_src.fileno())
+        except OSError:
+            os.remove(dst)
+            raise
+
+
+def _relative_symlink(src: Path, dst: Path) -> None:
+
+    os.symlink(os.path.relpath(src, dst.parent), dst)
+
+
+def link_file(src: Path, dst: Path) -> None:
+    '''Atomically place a link to `src` at `dst`
+
+    Hardlinks are preferred since they work on EFS and survive syncing
+    the run directory to other storage, then reflinks on CoW
+    filesystems, then relative symlinks (e.g. across devices) and
+    finally a copy. A temporary name is linked first and then renamed
+    to `dst`, replacing any existing file.
+    '''
+
+    tmp = dst.with_name(f'.{dst.name}.{os.getpid()}.tmp')
+    for linker in (os.link, reflink, _relative_symlink):
+        try:
+            linker(src, tmp)
+            break
+        except OSError:
+            if tmp.is_symlink() or tmp.exists():
+                os.remove(tmp)
+    else:
+        shutil.copy(src, tmp)
+    os.replace(tmp, dst)
+
+
+def write_json_atomic(path: Path, data) -> None:
+    '''Write `data` as JSON to a temporary file then rename to `path`'''
+
+    tmp = path.with_name(f'.{path.name}.{os.getpid()}.tmp')
+    with open(tmp, 'w') as fo:
+        json.dump(data, fo, indent=2)
+    os.replace(tmp, path)
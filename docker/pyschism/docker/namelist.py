@@ -0,0 +1,60 @@
+"""Declarative patching of SCHISM/WWM Fortran namelist files
+
+All the edits to a namelist file are collected as patches and applied
+with a single read and a single write of the file. A patch is either a
+nested dictionary of `{group: {variable: value}}` or, for edits that
+cannot be expressed as values (e.g. array start indices), a callable
+that modifies the namelist in place.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List, Union
+
+import f90nml
+
+
+MAX_WORKERS = 8
+
+Patch = Union[Dict[str, Dict], Callable[[f90nml.Namelist], None]]
+
+# Workardoun for hydrology param bug #34
+IF_SOURCE_PATCH = {'opt': {'if_source': 1}}
+
+
+def _apply_patch(nml: f90nml.Namelist, patch: Patch) -> None:
+
+    if callable(patch):
+        patch(nml)
+        return
+
+    for group, values in patch.items():
+        if group not in nml:
+            nml[group] = f90nml.Namelist()
+        for key, value in values.items():
+            nml[group][key] = value
+
+
+def patch_namelist(path: Path, patches: Iterable[Patch]) -> f90nml.Namelist:
+    '''Apply all the patches to the namelist file in one read/write'''
+
+    nml = f90nml.read(path)
+    for patch in patches:
+        _apply_patch(nml, patch)
+    nml.write(path, force=True)
+
+    return nml
+
+
+def patch_namelists(
+        paths: Iterable[Path],
+        patches: Iterable[Patch],
+        max_workers: int = MAX_WORKERS,
+        ) -> List[f90nml.Namelist]:
+    '''Apply the same patches to many namelist files concurrently'''
+
+    patches = list(patches)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(
+            lambda path: patch_namelist(path, patches), paths
+        ))
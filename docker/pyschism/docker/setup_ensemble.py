@@ -196,7 +196,9 @@ def main(args):
     })
 
     if use_wwm:
-        wwm.setup_wwm(mesh_file, workdir, ensemble=True)
+        # NOTE: The spinup of this image runs without WWM, so the runs
+        # cold start WWM rather than reading a spinup hotfile
+        wwm.setup_wwm(mesh_file, workdir, ensemble=True, hotstart=False)
 
 
 def parse_arguments():
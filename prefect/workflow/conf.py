@@ -49,6 +49,7 @@ TERRAFORM_CONFIG_FILE = THIS_FILE.parent.parent/'vars_from_terraform'
 
 WORKFLOW_TAG_NAME = "Workflow Tag"
 INIT_FINI_LOCK = "/efs/.initfini.lock"
+CACHE_MAX_SIZE_GB = 200
 
 run_cfg_local_aws_cred = UniversalRun(labels=['tacc-odssm-local'])
 run_cfg_local_pw_cred = UniversalRun(labels=['tacc-odssm-local-for-rdhpcs'])
@@ -13,6 +13,7 @@ from conf import (
     WF_CLUSTER, WF_TEMPLATE_ID, WF_IMG,
     ECS_TASK_ROLE, ECS_EXEC_ROLE,
     PREFECT_PROJECT_NAME,
+    CACHE_MAX_SIZE_GB,
 )
 from tasks.params import (
     param_storm_name, param_storm_year, param_run_id,
@@ -236,6 +237,8 @@ info_flow_ecs_task_details = {
             ),
             _use_if(param_ensemble, False, "--cache-dir"),
             _use_if(param_ensemble, False, 'cache'),
+            _use_if(param_ensemble, False, "--cache-max-size"),
+            _use_if(param_ensemble, False, CACHE_MAX_SIZE_GB),
             _use_if(param_ensemble, False, "--nwm-dir"),
             _use_if(param_ensemble, False, 'nwm'),
             # Command and arguments for ensemble run
@@ -468,7 +471,12 @@ def make_flow_solve_ecs_task(child_flow):
                         year=param_storm_year,
                         run_id=param_run_id,
                         schism_dir=result_ensemble_dir + '/spinup',
-                        schism_exec='pschism_PAHM_TVD-VL',
+                        # Spinup writes WWM hotfile if coupled
+                        schism_exec=task_return_this_if_param_true_else_that(
+                            param_wind_coupling,
+                            'pschism_WWM_PAHM_TVD-VL',
+                            'pschism_PAHM_TVD-VL',
+                        ),
                     ),
                     run_config=ecs_config,
                 )
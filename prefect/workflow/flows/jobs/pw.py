@@ -240,7 +240,12 @@ def make_flow_solve_rdhpcs_pw_task():
             result_after_coldstart = task_submit_slurm(
                 command=task_format_schism_slurm(
                     run_path=result_ensemble_dir + '/spinup',
-                    schism_exec='pschism_PAHM_TVD-VL',
+                    # Spinup writes WWM hotfile if coupled
+                    schism_exec=task_return_this_if_param_true_else_that(
+                        param_wind_coupling,
+                        'pschism_WWM_PAHM_TVD-VL',
+                        'pschism_PAHM_TVD-VL',
+                    ),
                     upstream_tasks=[result_s3_to_lustre]))
             result_wait_slurm_done_spinup = task_wait_slurm_done(
                 job_id=result_after_coldstart)
@@ -2,6 +2,7 @@ import pathlib
 import shutil
 import subprocess
 import json
+import fcntl
 from datetime import datetime, timezone
 
 import boto3
@@ -187,13 +188,65 @@ def task_cleanup_run(run_tag):
     shutil.rmtree(src)
 
 
-task_cache_to_s3 = ShellTask(
-    name="Sync all cached files with static S3",
-    command='\n'.join([
-        "mkdir -p /efs/cache", # To avoid error if no cache!
-        f"aws s3 sync /efs/cache s3://{STATIC_S3}/cache/"
-        ])
-)
+@task(name="Sync new cached files with static S3")
+def task_cache_to_s3():
+    cache_dir = pathlib.Path('/efs/cache')
+    cache_dir.mkdir(parents=True, exist_ok=True) # To avoid error if no cache!
+
+    manifest_path = cache_dir / 'cache_manifest.json'
+    if not manifest_path.is_file():
+        # Cache not managed by setup (e.g. legacy), sync everything
+        subprocess.run(
+            ["aws", "s3", "sync", str(cache_dir), f"s3://{STATIC_S3}/cache/"],
+            check=True
+        )
+        return
+
+    s3 = boto3.client("s3")
+    # Same lock as the one used by cache manager in setup
+    with open(cache_dir / ".cache.lock", "w") as lock_fp:
+        try:
+            fcntl.flock(lock_fp.fileno(), fcntl.LOCK_EX)
+
+            with open(manifest_path) as fp:
+                manifest = json.load(fp)
+
+            # Evicted entries are removed from S3 as well, unless their
+            # files have been recreated by a live entry since
+            referenced = {
+                relpath
+                for entry in manifest['entries'].values()
+                for relpath in entry['files']
+            }
+            for relpath in manifest['deleted']:
+                if relpath in referenced:
+                    continue
+                s3.delete_object(Bucket=STATIC_S3, Key=f'cache/{relpath}')
+            manifest['deleted'] = []
+
+            # Only upload entries that are not synced yet
+            for entry in manifest['entries'].values():
+                if entry['synced']:
+                    continue
+                for relpath in entry['files']:
+                    s3.upload_file(
+                        str(cache_dir / relpath), STATIC_S3, f'cache/{relpath}')
+                entry['synced'] = True
+
+            # Indices are small and updated by each entry change
+            for p in cache_dir.glob('*/meteo_index.json'):
+                s3.upload_file(
+                    str(p), STATIC_S3, f'cache/{p.relative_to(cache_dir)}')
+
+            tmp = cache_dir / '.cache_manifest.json.tmp'
+            with open(tmp, 'w') as fp:
+                json.dump(manifest, fp, indent=2)
+            tmp.replace(manifest_path)
+            s3.upload_file(
+                str(manifest_path), STATIC_S3, 'cache/cache_manifest.json')
+
+        finally:
+            fcntl.flock(lock_fp.fileno(), fcntl.LOCK_UN)
 
 @task(name="Cleanup EFS after run")
 def task_cleanup_efs(run_tag):
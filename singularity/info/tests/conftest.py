@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# NOTE: In the image the scripts are on PYTHONPATH
+sys.path.insert(0, str(Path(__file__).parents[1] / 'files'))
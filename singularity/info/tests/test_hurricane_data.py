@@ -0,0 +1,69 @@
+import pytest
+
+pytest.importorskip('stormevents')
+pytest.importorskip('searvey')
+
+import numpy as np
+import pandas as pd
+from shapely.geometry import Point
+
+import hurricane_data
+
+START = pd.Timestamp('2022-09-26 00:00')
+
+
+def _track(radii):
+
+    n_pts = len(radii)
+    data = pd.DataFrame(
+        np.asarray(radii, dtype=float),
+        columns=[
+            f'isotach_radius_for_{quad}' for quad in hurricane_data.ISOTACH_QUADRANTS
+        ],
+    )
+    data['advisory'] = 'OFCL'
+    data['track_start_time'] = START
+    data['isotach_radius'] = 34
+    data['datetime'] = START + pd.to_timedelta(6 * np.arange(n_pts), unit='h')
+    data['longitude'] = -82.0
+    data['latitude'] = 24.0 + np.arange(n_pts)
+    return data
+
+
+def test_windswath_missing_quadrants():
+
+    track = _track([
+        [100, 80, 60, 90],
+        # missing quadrants
+        [100, np.nan, np.nan, 90],
+        # no isotach at all
+        [np.nan, np.nan, 0, np.nan],
+        [100, 80, 0, 90],
+    ])
+
+    swath = hurricane_data.get_windswath(track, 'OFCL', START)
+
+    assert swath.is_valid and swath.area > 0
+    assert np.isfinite(swath.bounds).all()
+    for lon, lat in track[['longitude', 'latitude']].values:
+        assert swath.contains(Point(lon, lat))
+
+
+def test_windswath_single_quadrant():
+
+    track = _track([[100, np.nan, 0, np.nan]])
+
+    swath = hurricane_data.get_windswath(track, 'OFCL', START)
+
+    assert swath.is_valid
+    # only the north-east quadrant is covered
+    assert swath.contains(Point(-81.5, 24.5))
+    assert not swath.contains(Point(-82.5, 23.5))
+
+
+def test_windswath_no_isotach():
+
+    track = _track([[np.nan, 0, np.nan, np.nan]])
+
+    with pytest.raises(ValueError):
+        hurricane_data.get_windswath(track, 'OFCL', START)
@@ -0,0 +1,140 @@
+'''Adaptive ensemble size based on surrogate convergence
+
+Members are run in batches (in sample order, e.g. Korobov). After
+each batch the KL/PC surrogate is refit from all the finished members
+and its percentile maps are compared to those of the previous batch.
+Once the change is within tolerance no more batches are launched.
+'''
+
+import json
+import re
+from argparse import ArgumentParser
+from pathlib import Path
+
+import numpy
+import xarray
+
+from ensembleperturbation.utilities import get_logger
+
+from analyze_ensemble import analyze
+from combine_ensemble import combine_from_store, write_zarr_stores
+from fileio import write_json_atomic
+
+LOGGER = get_logger('klpc_wetonly')
+
+# Max change (m) in RMS of surrogate percentiles between batches
+DEFAULT_TOLERANCE = 0.05
+# Manning coefficient of the analysis used for convergence
+CONVERGENCE_MANN_COEF = 0.025
+CONVERGENCE_FILE = 'convergence.json'
+CONVERGED_FLAG = 'converged'
+
+
+def _sample_index(run_name):
+    match = re.search(r'_(\d+)$', run_name)
+    return int(match.group(1)) if match is not None else -1
+
+
+def ordered_runs(ensemble_dir):
+    '''Run names in the order samples were drawn, unperturbed first'''
+
+    return sorted(
+        (run.name for run in (ensemble_dir / 'runs').iterdir()),
+        key=lambda name: (_sample_index(name), name)
+    )
+
+
+def percentile_change(previous_path, current_path):
+    '''Max over percentiles of RMS change of the surrogate percentiles'''
+
+    with xarray.open_dataset(previous_path) as previous, \
+            xarray.open_dataset(current_path) as current:
+        previous = previous['quantiles'].sel(source='surrogate')
+        current = current['quantiles'].sel(source='surrogate')
+        previous, current = xarray.align(previous, current, join='inner')
+        diff = (current - previous).values
+        rms = numpy.sqrt(numpy.nanmean(diff ** 2, axis=-1))
+
+    return float(numpy.nanmax(rms))
+
+
+def check_convergence(ensemble_dir, tracks_dir, batch, tolerance):
+    '''Refit surrogate from finished members and check convergence'''
+
+    analyze_dir = ensemble_dir / 'analyze'
+    batch_dir = analyze_dir / f'batch_{batch:03d}'
+
+    # NOTE: Only finished members are combined, later batches aren't
+    # run yet and failed runs are skipped
+    combine_from_store(ensemble_dir, tracks_dir, output_dir=batch_dir)
+    write_zarr_stores(batch_dir)
+    # NOTE: Figures of intermediate batches aren't needed
+    output_directory = analyze(
+        tracks_dir, batch_dir, mann_coefs=[CONVERGENCE_MANN_COEF], make_plots=False
+    )[CONVERGENCE_MANN_COEF]
+
+    convergence_path = analyze_dir / CONVERGENCE_FILE
+    history = []
+    if convergence_path.exists():
+        with open(convergence_path) as fi:
+            history = json.load(fi)
+    history = [entry for entry in history if entry['batch'] < batch]
+
+    percentiles_path = output_directory / 'percentiles.nc'
+    change = None
+    if len(history) > 0:
+        change = percentile_change(
+            Path(history[-1]['percentiles']), percentiles_path
+        )
+    converged = change is not None and change <= tolerance
+    with xarray.open_dataset(batch_dir / 'maxele.63.nc') as max_elevations:
+        n_runs = len(max_elevations['run'])
+
+    history.append({
+        'batch': batch,
+        'runs': n_runs,
+        'percentiles': str(percentiles_path),
+        'change': change,
+        'tolerance': tolerance,
+        'converged': converged,
+    })
+    # NOTE: Polled by the workflow while batches are running
+    write_json_atomic(convergence_path, history)
+
+    LOGGER.info(
+        f'batch {batch}: {n_runs} runs, percentile change {change}'
+        f' (tolerance {tolerance})'
+    )
+    if converged:
+        LOGGER.info('surrogate converged, no more members are needed')
+        (analyze_dir / CONVERGED_FLAG).touch()
+
+    return converged
+
+
+def main(args):
+
+    ensemble_dir = args.ensemble_dir
+
+    if args.command == 'order':
+        # Used by the workflow to submit runs in batches
+        print('\n'.join(ordered_runs(ensemble_dir)))
+
+    elif args.command == 'check':
+        check_convergence(
+            ensemble_dir, args.tracks_dir, args.batch, args.tolerance
+        )
+
+
+if __name__ == '__main__':
+
+    parser = ArgumentParser()
+    parser.add_argument('command', choices=['order', 'check'])
+    parser.add_argument('-d', '--ensemble-dir', type=Path)
+    parser.add_argument('-t', '--tracks-dir', type=Path)
+    parser.add_argument('-b', '--batch', type=int, default=0)
+    parser.add_argument(
+        '--tolerance', type=float, default=DEFAULT_TOLERANCE
+    )
+
+    main(parser.parse_args())
@@ -1,43 +1,58 @@
 from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+import os
 from pathlib import Path
-import pickle
 
-import chaospy
 import dask
-from matplotlib import pyplot
+import dask.array
 import numpy
-from sklearn.linear_model import LassoCV, ElasticNetCV, LinearRegression
-from sklearn.model_selection import ShuffleSplit, LeaveOneOut
+from pyproj.transformer import Transformer
+from scipy.spatial import KDTree
 import xarray
 
-from ensembleperturbation.parsing.adcirc import (
-    extrapolate_water_elevation_to_dry_areas,
-    subset_dataset,
-)
-from ensembleperturbation.perturbation.atcf import VortexPerturbedVariable
-from ensembleperturbation.plotting.perturbation import plot_perturbations
-from ensembleperturbation.plotting.surrogate import (
-    plot_kl_surrogate_fit,
-    plot_selected_percentiles,
-    plot_selected_validations,
-    plot_sensitivities,
-    plot_validations,
-)
+from ensembleperturbation.parsing.adcirc import subset_dataset
 from ensembleperturbation.uncertainty_quantification.karhunen_loeve_expansion import (
     karhunen_loeve_expansion,
-    karhunen_loeve_prediction,
 )
 from ensembleperturbation.uncertainty_quantification.surrogate import (
-    percentiles_from_surrogate,
-    sensitivities_from_surrogate,
     surrogate_from_karhunen_loeve,
     surrogate_from_training_set,
     validations_from_surrogate,
 )
 from ensembleperturbation.utilities import get_logger
 
+from karhunen_loeve import (
+    KL_DIRECTORY,
+    NODE_CHUNK as KL_NODE_CHUNK,
+    karhunen_loeve_expansion_randomized,
+    read_karhunen_loeve,
+    save_karhunen_loeve,
+)
+from plot_ensemble import PERTURBATIONS_FILENAME, TRAINING_SET_FILENAME, render_plots
+from query_surrogate import QUERY_INFO, write_query_info
+from surrogate_eval import (
+    percentiles_from_kl_surrogate,
+    sensitivities_from_kl_surrogate,
+)
+from surrogate_fit import (
+    CROSS_VALIDATIONS,
+    POLYNOMIAL_ORDER,
+    RANDOM_STATE,
+    perturbation_distribution,
+    regression_model as surrogate_regression_model,
+    surrogate_from_training_set_parallel,
+    with_expansion,
+)
+
 LOGGER = get_logger('klpc_wetonly')
 
+MANN_COEFS = [0.025, 0.05, 0.1]
+SHARED_DIR = 'shared'
+# Closest nodes checked for being wet before a per run search
+NEIGHBOR_CANDIDATES = 16
+# Subset size above which KL uses randomized SVD instead of PCA
+KL_RANDOMIZED_MIN_NODES = 100_000
+
 
 
 def main(args):
@@ -45,21 +60,271 @@ def main(args):
     tracks_dir = args.tracks_dir
     ensemble_dir = args.ensemble_dir
 
-    analyze(tracks_dir, ensemble_dir/'analyze')
+    if args.plots_only:
+        # NOTE: Re-render the figures of a finished analysis
+        analyze_dir = ensemble_dir/'analyze'
+        render_plots(
+            tracks_dir,
+            analyze_dir/SHARED_DIR,
+            sorted(path.parent for path in analyze_dir.glob(f'*/{QUERY_INFO}')),
+            max_workers=args.plot_workers,
+        )
+        return
+
+    analyze(
+        tracks_dir,
+        ensemble_dir/'analyze',
+        max_workers=1 if args.sequential else None,
+        surrogate_cv=args.surrogate_cv,
+        surrogate_workers=args.surrogate_workers,
+        make_plots=not args.skip_plots,
+        plot_workers=args.plot_workers,
+    )
 
 
 
-def analyze(tracks_dir, analyze_dir):
+def open_combined_dataset(path):
+    '''Open combined results, from the Zarr store if up to date'''
 
-    mann_coefs = [0.025, 0.05, 0.1]
-    for mann_coef in mann_coefs:
-        _analyze(tracks_dir, analyze_dir, mann_coef)
+    zarr_path = path.with_suffix('.zarr')
+    if zarr_path.exists() and (
+            not path.exists()
+            or zarr_path.stat().st_mtime >= path.stat().st_mtime):
+        return xarray.open_zarr(zarr_path)
+    if path.exists():
+        return xarray.open_dataset(path, chunks='auto')
+    raise FileNotFoundError(path.name)
 
 
-def _analyze(tracks_dir, analyze_dir, mann_coef):
 
-    # KL parameters
-    variance_explained = 0.9999
+def analyze(
+    tracks_dir,
+    analyze_dir,
+    mann_coefs=MANN_COEFS,
+    max_workers=None,
+    surrogate_cv='loo',
+    surrogate_workers=None,
+    make_plots=True,
+    plot_workers=None,
+):
+    '''Analyze for each Manning coefficient, sharing the subset
+
+    The figures are rendered once all the analyses are written, unless
+    `make_plots` is False'''
+
+    shared = _prepare(tracks_dir, analyze_dir)
+
+    n_concurrent = 1 if max_workers == 1 else len(mann_coefs)
+    if max_workers is not None:
+        n_concurrent = min(n_concurrent, max_workers)
+    if surrogate_workers is None:
+        # split the cores between the concurrent analyses
+        surrogate_workers = max(1, os.cpu_count() // n_concurrent)
+    analyze_kwargs = {
+        'surrogate_cv': surrogate_cv,
+        'surrogate_workers': surrogate_workers,
+    }
+
+    # NOTE: Only the dry-area extrapolation depends on the coefficient,
+    # `shared` only holds paths and parameters so it's cheap to pickle
+    if n_concurrent == 1:
+        output_directories = {
+            mann_coef: _analyze(shared, analyze_dir, mann_coef, **analyze_kwargs)
+            for mann_coef in mann_coefs
+        }
+    else:
+        with ProcessPoolExecutor(max_workers=n_concurrent) as executor:
+            futures = {
+                mann_coef: executor.submit(
+                    _analyze, shared, analyze_dir, mann_coef, **analyze_kwargs
+                )
+                for mann_coef in mann_coefs
+            }
+            output_directories = {
+                mann_coef: future.result() for mann_coef, future in futures.items()
+            }
+
+    if make_plots:
+        render_plots(
+            tracks_dir,
+            shared['shared_directory'],
+            list(output_directories.values()),
+            max_workers=plot_workers,
+        )
+
+    return output_directories
+
+
+def dry_area_neighbors(da, k_neighbors, filename=None):
+    '''Closest wet nodes to the dry nodes of each run
+
+    A single tree of all the nodes is queried for wet candidates, only
+    dry nodes without enough wet candidates query a tree of the wet
+    nodes of their run. The index is cached in `filename`.
+    '''
+
+    runs = da['run'].values.astype(str)
+    if filename is not None and filename.exists():
+        with numpy.load(filename) as cached:
+            neighbors = dict(cached)
+        if (numpy.array_equal(neighbors['runs'], runs)
+                and neighbors['n_nodes'] == da.sizes['node']
+                and neighbors['neighbors'].shape[-1] == k_neighbors):
+            LOGGER.info(f'loading dry area neighbors from "{filename}"')
+            return neighbors
+
+    # Get coordinates in conformal projection (e.g,, Mercator)
+    # for determining closest distance
+    crs_from = 'EPSG:4326'  # WGS84
+    crs_to = 'EPSG:3857'  # Mercator
+    transformer = Transformer.from_crs(crs_from=crs_from, crs_to=crs_to, always_xy=True)
+    x, y = transformer.transform(da['x'].values, da['y'].values)
+    projected_coordinates = numpy.vstack([x, y]).T
+
+    null = da.isnull().values
+    dry_nodes = numpy.flatnonzero(null.any(axis=0))
+    distances, neighbor_nodes = _wet_neighbors(
+        projected_coordinates, null, dry_nodes, k_neighbors
+    )
+
+    neighbors = {
+        'runs': runs,
+        'n_nodes': da.sizes['node'],
+        'dry_nodes': dry_nodes,
+        'distances': distances,
+        'neighbors': neighbor_nodes,
+    }
+    if filename is not None:
+        LOGGER.info(f'saving dry area neighbors to "{filename}"')
+        numpy.savez(filename, **neighbors)
+
+    return neighbors
+
+
+def _wet_neighbors(projected_coordinates, null, dry_nodes, k_neighbors):
+    '''Distances to and closest wet nodes of `dry_nodes` in each run'''
+
+    # for mapping back to node numbers
+    nodes = numpy.arange(null.shape[1])
+
+    n_runs = null.shape[0]
+    shape = (n_runs, len(dry_nodes), k_neighbors)
+    distances = numpy.full(shape, numpy.nan)
+    neighbor_nodes = numpy.full(shape, -1)
+    if len(dry_nodes) == 0:
+        # all nodes are wet in every run
+        return distances, neighbor_nodes
+
+    # NOTE: Candidates are sorted by distance
+    n_candidates = min(NEIGHBOR_CANDIDATES + k_neighbors, len(nodes))
+    tree = KDTree(projected_coordinates)
+    candidate_dd, candidate_nn = tree.query(
+        projected_coordinates[dry_nodes], k=n_candidates
+    )
+    candidate_dd = candidate_dd.reshape(len(dry_nodes), -1)
+    candidate_nn = candidate_nn.reshape(len(dry_nodes), -1)
+
+    for run in range(n_runs):
+        dry = null[run, dry_nodes]
+        wet_candidates = ~null[run][candidate_nn] & dry[:, None]
+        rank = numpy.cumsum(wet_candidates, axis=1)
+        found = rank[:, -1] >= k_neighbors
+
+        rows = numpy.flatnonzero(dry & found)
+        selected = wet_candidates[rows] & (rank[rows] <= k_neighbors)
+        columns = selected.nonzero()[1].reshape(len(rows), k_neighbors)
+        distances[run, rows] = candidate_dd[rows[:, None], columns]
+        neighbor_nodes[run, rows] = candidate_nn[rows[:, None], columns]
+
+        missing = numpy.flatnonzero(dry & ~found)
+        if len(missing) > 0:
+            wet_tree = KDTree(projected_coordinates[~null[run]])
+            dd, nn = wet_tree.query(
+                projected_coordinates[dry_nodes[missing]], k=k_neighbors
+            )
+            distances[run, missing] = dd.reshape(len(missing), -1)
+            neighbor_nodes[run, missing] = (
+                nodes[~null[run]][nn].reshape(len(missing), -1)
+            )
+
+    return distances, neighbor_nodes
+
+
+def extrapolate_to_dry_areas(
+    da,
+    neighbors,
+    idw_order=1,
+    mann_coef=0.05,
+    u_ref=0.4,
+    d_ref=1.0,
+    min_depth=0.0,
+):
+    '''Same as `extrapolate_water_elevation_to_dry_areas` with headloss
+    but using the precomputed `dry_area_neighbors`'''
+
+    # compute the friction factor for headloss calculation:
+    # Rucker, et al. (2021). Natural Hazards.
+    # https://doi.org/10.1007/s11069-021-04634-8
+    friction_factor = (u_ref * mann_coef) ** 2 / d_ref ** (4 / 3)
+
+    dry_nodes = neighbors['dry_nodes']
+    if len(dry_nodes) == 0:
+        return da.copy()
+    dd = neighbors['distances']
+    nn = neighbors['neighbors']
+    # nodes that are wet in a run have no neighbors
+    dry = nn[..., 0] >= 0
+
+    max_allowable_values = (
+        da['depth'].values[dry_nodes] + min_depth - numpy.finfo(float).eps
+    )
+
+    # NOTE: Only the wet nodes next to dry areas are read here
+    wet_nodes, wet_index = numpy.unique(numpy.fmax(nn, 0), return_inverse=True)
+    wet_values = da.isel(node=wet_nodes).values
+
+    # hydraulic friction loss
+    run_index = numpy.arange(wet_values.shape[0])[:, None, None]
+    wet_index = wet_index.reshape(nn.shape)
+    total_head = wet_values[run_index, wet_index] - dd * friction_factor
+    if nn.shape[-1] == 1:
+        extrapolated = total_head[..., 0]
+    else:
+        # inverse distance weighting of order `idw_order`
+        weights = dd ** (-idw_order)
+        extrapolated = (total_head * weights).sum(axis=-1) / weights.sum(axis=-1)
+    extrapolated = numpy.fmin(extrapolated, max_allowable_values)
+
+    def replace_dry(values, run_start=0, node_start=0):
+        runs = slice(run_start, run_start + values.shape[0])
+        in_block = (dry_nodes >= node_start) & (dry_nodes < node_start + values.shape[1])
+        columns = dry_nodes[in_block] - node_start
+        values = values.copy()
+        values[:, columns] = numpy.where(
+            dry[runs][:, in_block], extrapolated[runs][:, in_block], values[:, columns]
+        )
+        return values
+
+    if isinstance(da.data, dask.array.Array):
+        # NOTE: Each block is adjusted as it's computed, the runs can be
+        # split in several chunks too (`split_large_chunks`)
+        adjusted = da.data.map_blocks(
+            lambda values, block_info=None: replace_dry(
+                values,
+                run_start=block_info[0]['array-location'][0][0],
+                node_start=block_info[0]['array-location'][1][0],
+            ),
+            dtype=da.dtype,
+        )
+    else:
+        adjusted = replace_dry(da.values)
+
+    return da.copy(data=adjusted)
+
+
+def _prepare(tracks_dir, analyze_dir):
+    '''Subset and split the ensemble once for all analyses'''
+
     # subsetting parameters
     isotach = 34  # -kt wind swath of the cyclone
     depth_bounds = 25.0
@@ -74,78 +339,37 @@ def _analyze(tracks_dir, analyze_dir, mann_coef):
     log_space = False  # use log-scale to keep depths positive
     training_runs = 'korobov'
     validation_runs = 'random'
-    # PC parameters
-    polynomial_order = 3
-    # cross_validator = ShuffleSplit(n_splits=10, test_size=12, random_state=666)
-    # cross_validator = ShuffleSplit(random_state=666)
-    cross_validator = LeaveOneOut()
-    # regression_model = LassoCV(
-    #    fit_intercept=False, cv=cross_validator, selection='random', random_state=666
-    # )
-    regression_model = ElasticNetCV(
-        fit_intercept=False,
-        cv=cross_validator,
-        l1_ratio=0.5,
-        selection='random',
-        random_state=666,
-    )
-    # regression_model = LinearRegression(fit_intercept=False)
-    regression_name = 'ElasticNet_LOO'
     if training_runs == 'quadrature':
         use_quadrature = True
     else:
         use_quadrature = False
 
-    make_perturbations_plot = True
-    make_klprediction_plot = True
-    make_klsurrogate_plot = True
-    make_sensitivities_plot = True
-    make_validation_plot = True
-    make_percentile_plot = True
-
-    save_plots = True
-    show_plots = False
-
     storm_name = None
 
-    if log_space:
-        output_directory = (
-            analyze_dir / f'log_k{k_neighbors}_p{idw_order}_n{mann_coef}'
-        )
-    else:
-        output_directory = (
-            analyze_dir / f'linear_k{k_neighbors}_p{idw_order}_n{mann_coef}'
-        )
-    if not output_directory.exists():
-        output_directory.mkdir(parents=True, exist_ok=True)
-
+    shared_directory = analyze_dir / SHARED_DIR
+    if not shared_directory.exists():
+        shared_directory.mkdir(parents=True, exist_ok=True)
 
-    subset_filename = output_directory / 'subset.nc'
-    kl_filename = output_directory / 'karhunen_loeve.pkl'
-    kl_surrogate_filename = output_directory / 'kl_surrogate.npy'
-    surrogate_filename = output_directory / 'surrogate.npy'
-    kl_validation_filename = output_directory / 'kl_surrogate_fit.nc'
-    sensitivities_filename = output_directory / 'sensitivities.nc'
-    validation_filename = output_directory / 'validation.nc'
-    percentile_filename = output_directory / 'percentiles.nc'
+    subset_filename = shared_directory / 'subset.nc'
+    neighbors_filename = shared_directory / 'neighbors.npz'
 
     filenames = ['perturbations.nc', 'maxele.63.nc']
     if storm_name is None:
         storm_name = tracks_dir / 'original.22'
 
     datasets = {}
-    existing_filenames = []
     for filename in filenames:
-        filename = analyze_dir / filename
-        if filename.exists():
-            datasets[filename.name] = xarray.open_dataset(filename, chunks='auto')
-        else:
-            raise FileNotFoundError(filename.name)
+        datasets[filename] = open_combined_dataset(analyze_dir / filename)
 
     perturbations = datasets[filenames[0]]
     max_elevations = datasets[filenames[1]]
     min_depth = 0.8 * max_elevations.h0  # the minimum allowable depth
 
+    # NOTE: In adaptive ensembles not all perturbed members are run
+    perturbations = perturbations.sel(
+        run=perturbations['run'].isin(max_elevations['run'])
+    )
+
     perturbations = perturbations.assign_coords(
         type=(
             'run',
@@ -169,30 +393,11 @@ def _analyze(tracks_dir, analyze_dir, mann_coef):
         )
         LOGGER.info('dividing 70/30% for training/testing the model')
 
+    perturbations = perturbations.load()
     training_perturbations = perturbations.sel(run=perturbations['type'] == 'training')
-    validation_perturbations = perturbations.sel(run=perturbations['type'] == 'validation')
 
-    if make_perturbations_plot:
-        plot_perturbations(
-            training_perturbations=training_perturbations,
-            validation_perturbations=validation_perturbations,
-            runs=perturbations['run'].values,
-            perturbation_types=perturbations['type'].values,
-            track_directory=tracks_dir,
-            output_directory=output_directory if save_plots else None,
-        )
-
-    variables = {
-        variable_class.name: variable_class()
-        for variable_class in VortexPerturbedVariable.__subclasses__()
-    }
-
-    distribution = chaospy.J(
-        *(
-            variables[variable_name].chaospy_distribution()
-            for variable_name in perturbations['variable'].values
-        )
-    )
+    # split used by the analyses and the figures
+    perturbations.to_netcdf(shared_directory / PERTURBATIONS_FILENAME)
 
     # sample based on subset and excluding points that are never wet during training run
     if not subset_filename.exists():
@@ -208,31 +413,152 @@ def _analyze(tracks_dir, analyze_dir, mann_coef):
             point_spacing=point_spacing,
             output_filename=subset_filename,
         )
+        # cached neighbors are of the old subset
+        if neighbors_filename.exists():
+            neighbors_filename.unlink()
+
+    shared = {
+        'shared_directory': shared_directory,
+        'variable_name': variable_name,
+        'variable_names': perturbations['variable'].values,
+        'point_spacing': point_spacing,
+        'k_neighbors': k_neighbors,
+        'idw_order': idw_order,
+        'use_depth': use_depth,
+        'log_space': log_space,
+        'use_quadrature': use_quadrature,
+        'min_depth': float(min_depth),
+        'subset_filename': subset_filename,
+        'neighbors_filename': None
+        if node_status_mask == 'always_wet'
+        else neighbors_filename,
+    }
+
+    # NOTE: Finds the dry area neighbors once for all the analyses
+    _open_shared(shared)
+
+    return shared
+
+
+def _open_shared(shared):
+    '''Open the split, subset and neighbors written by `_prepare`
+
+    Each analysis reads them from the shared directory rather than
+    having them pickled to its worker process.
+    '''
+
+    perturbations = xarray.open_dataset(
+        shared['shared_directory'] / PERTURBATIONS_FILENAME
+    ).load()
+    training_perturbations = perturbations.sel(run=perturbations['type'] == 'training')
+    validation_perturbations = perturbations.sel(run=perturbations['type'] == 'validation')
 
     # subset chunking can be disturbed by point_spacing so load from saved filename always
-    LOGGER.info(f'loading subset from "{subset_filename}"')
-    subset = xarray.open_dataset(subset_filename)
+    LOGGER.info(f'opening subset from "{shared["subset_filename"]}"')
+    subset = xarray.open_dataset(
+        shared['subset_filename'], chunks={'node': KL_NODE_CHUNK}
+    )
+    elements = None
     if 'element' in subset:
-        elements = subset['element']
-    subset = subset[variable_name]
+        elements = subset['element'].load()
+    subset = subset[shared['variable_name']]
 
     # divide subset into training/validation runs
     with dask.config.set(**{'array.slicing.split_large_chunks': True}):
         training_set = subset.sel(run=training_perturbations['run'])
-        validation_set = subset.sel(run=validation_perturbations['run'])
+        # NOTE: Only the training set is read by chunks of nodes, the
+        # validation statistics assign into the loaded values
+        validation_set = subset.sel(run=validation_perturbations['run']).load()
 
     LOGGER.info(f'total {training_set.shape} training samples')
     LOGGER.info(f'total {validation_set.shape} validation samples')
 
-    if node_status_mask == 'always_wet':
+    neighbors = None
+    if shared['neighbors_filename'] is not None:
+        LOGGER.info('finding closest wet nodes to dry areas')
+        neighbors = dry_area_neighbors(
+            training_set,
+            shared['k_neighbors'],
+            filename=shared['neighbors_filename'],
+        )
+
+    return {
+        'training_perturbations': training_perturbations,
+        'validation_perturbations': validation_perturbations,
+        'subset': subset,
+        'elements': elements,
+        'training_set': training_set,
+        'validation_set': validation_set,
+        'neighbors': neighbors,
+    }
+
+
+def _analyze(
+    shared,
+    analyze_dir,
+    mann_coef,
+    surrogate_cv='loo',
+    surrogate_workers=None,
+):
+
+    # KL parameters
+    variance_explained = 0.9999
+
+    # shared subset and analysis type
+    point_spacing = shared['point_spacing']
+    k_neighbors = shared['k_neighbors']
+    idw_order = shared['idw_order']
+    use_depth = shared['use_depth']
+    log_space = shared['log_space']
+    use_quadrature = shared['use_quadrature']
+    min_depth = shared['min_depth']
+
+    inputs = _open_shared(shared)
+    training_perturbations = inputs['training_perturbations']
+    validation_perturbations = inputs['validation_perturbations']
+    subset = inputs['subset']
+    elements = inputs['elements']
+    training_set = inputs['training_set']
+    validation_set = inputs['validation_set']
+    neighbors = inputs['neighbors']
+
+    # PC parameters
+    polynomial_order = POLYNOMIAL_ORDER
+    # loo (ElasticNet LOO), kfold (ElasticNet K-fold) or press (ridge)
+    cross_validation = surrogate_cv
+    random_state = RANDOM_STATE
+
+    if log_space:
+        output_directory = (
+            analyze_dir / f'log_k{k_neighbors}_p{idw_order}_n{mann_coef}'
+        )
+    else:
+        output_directory = (
+            analyze_dir / f'linear_k{k_neighbors}_p{idw_order}_n{mann_coef}'
+        )
+    if not output_directory.exists():
+        output_directory.mkdir(parents=True, exist_ok=True)
+
+
+    kl_directory = output_directory / KL_DIRECTORY
+    kl_surrogate_filename = output_directory / 'kl_surrogate.npy'
+    surrogate_filename = output_directory / 'surrogate.npy'
+    kl_validation_filename = output_directory / 'kl_surrogate_fit.nc'
+    sensitivities_filename = output_directory / 'sensitivities.nc'
+    validation_filename = output_directory / 'validation.nc'
+    percentile_filename = output_directory / 'percentiles.nc'
+    training_set_filename = output_directory / TRAINING_SET_FILENAME
+
+    distribution = perturbation_distribution(shared['variable_names'])
+
+    if neighbors is None:
         training_set_adjusted = training_set.copy(deep=True)
     else:
         # make an adjusted training set for dry areas..
-        training_set_adjusted = extrapolate_water_elevation_to_dry_areas(
+        training_set_adjusted = extrapolate_to_dry_areas(
             da=training_set,
-            k_neighbors=k_neighbors,
+            neighbors=neighbors,
             idw_order=idw_order,
-            compute_headloss=True,
             mann_coef=mann_coef,
             u_ref=0.4,
             d_ref=1,
@@ -242,69 +568,102 @@ def _analyze(tracks_dir, analyze_dir, mann_coef):
         training_set_adjusted += training_set_adjusted['depth']
 
     if log_space:
+        # NOTE: Computed once, its values are used by the later stages
         training_depth_adjust = numpy.fmax(
             0, min_depth - training_set_adjusted.min(axis=0)
-        )
+        ).compute()
         training_set_adjusted += training_depth_adjust
         training_set_adjusted = numpy.log(training_set_adjusted)
 
     # Evaluating the Karhunen-Loeve expansion
     nens, ngrid = training_set.shape
-    if not kl_filename.exists():
+    kl_expansion = read_karhunen_loeve(output_directory)
+
+    # NOTE: Also written when plots are skipped so that the KL prediction
+    # figure can be rendered later, but only along with its expansion
+    if kl_expansion is None or not training_set_filename.exists():
+        training_set_adjusted.to_netcdf(training_set_filename)
+    if kl_expansion is None:
         LOGGER.info(
             f'Evaluating Karhunen-Loeve expansion from {ngrid} grid nodes and {nens} ensemble members'
         )
-        kl_expansion = karhunen_loeve_expansion(
-            training_set_adjusted.values,
-            neig=variance_explained,
-            method='PCA',
-            output_directory=output_directory,
-        )
+        if ngrid < KL_RANDOMIZED_MIN_NODES:
+            # NOTE: Read back rather than computing the extrapolation again
+            with xarray.open_dataarray(training_set_filename) as kl_training_input:
+                kl_training_values = kl_training_input.values
+            # NOTE: Saved here rather than pickled by the library
+            kl_expansion = karhunen_loeve_expansion(
+                kl_training_values,
+                neig=variance_explained,
+                method='PCA',
+            )
+            LOGGER.info(f'saving Karhunen-Loeve expansion to "{kl_directory}"')
+            save_karhunen_loeve(kl_expansion, kl_directory)
+        else:
+            # NOTE: Memory is bounded by the chunks rather than ngrid,
+            # the written training set is read back by chunks of nodes
+            with xarray.open_dataarray(
+                training_set_filename, chunks={'node': KL_NODE_CHUNK}
+            ) as kl_training_input:
+                kl_expansion = karhunen_loeve_expansion_randomized(
+                    kl_training_input.data,
+                    neig=variance_explained,
+                    output_directory=output_directory,
+                )
     else:
-        LOGGER.info(f'loading Karhunen-Loeve expansion from "{kl_filename}"')
-        with open(kl_filename, 'rb') as kl_handle:
-            kl_expansion = pickle.load(kl_handle)
+        LOGGER.info(f'loaded Karhunen-Loeve expansion of "{output_directory}"')
 
     LOGGER.info(f'found {kl_expansion["neig"]} Karhunen-Loeve modes')
     LOGGER.info(f'Karhunen-Loeve expansion: {list(kl_expansion)}')
 
-    # plot prediction versus actual simulated
-    if make_klprediction_plot:
-        kl_predicted = karhunen_loeve_prediction(
-            kl_dict=kl_expansion,
-            actual_values=training_set_adjusted,
-            ensembles_to_plot=[0, int(nens / 2), nens - 1],
-            element_table=elements if point_spacing is None else None,
-            plot_directory=output_directory,
-        )
-
     # evaluate the surrogate for each KL sample
     kl_training_set = xarray.DataArray(data=kl_expansion['samples'], dims=['run', 'mode'])
-    kl_surrogate_model = surrogate_from_training_set(
-        training_set=kl_training_set,
-        training_perturbations=training_perturbations,
-        distribution=distribution,
-        filename=kl_surrogate_filename,
-        use_quadrature=use_quadrature,
-        polynomial_order=polynomial_order,
-        regression_model=regression_model,
-    )
-
-    # plot kl surrogate model versus training set
-    if make_klsurrogate_plot:
-        kl_fit = validations_from_surrogate(
-            surrogate_model=kl_surrogate_model,
+    if use_quadrature:
+        kl_surrogate_model = surrogate_from_training_set(
             training_set=kl_training_set,
             training_perturbations=training_perturbations,
-            filename=kl_validation_filename,
+            distribution=distribution,
+            filename=kl_surrogate_filename,
+            use_quadrature=use_quadrature,
+            polynomial_order=polynomial_order,
+            regression_model=surrogate_regression_model(
+                cross_validation, random_state=random_state
+            ),
         )
-
-        plot_kl_surrogate_fit(
-            kl_fit=kl_fit,
-            output_filename=output_directory / 'kl_surrogate_fit.png'
-            if save_plots
-            else None,
+    else:
+        kl_surrogate_model = surrogate_from_training_set_parallel(
+            training_set=kl_training_set,
+            training_perturbations=training_perturbations,
+            distribution=distribution,
+            filename=kl_surrogate_filename,
+            polynomial_order=polynomial_order,
+            cross_validation=cross_validation,
+            random_state=random_state,
+            max_workers=surrogate_workers,
         )
+    # NOTE: The batched evaluation needs the expansion of any fitter
+    kl_surrogate_model = with_expansion(
+        kl_surrogate_model, distribution, polynomial_order
+    )
+
+    # kl surrogate model versus training set
+    validations_from_surrogate(
+        surrogate_model=kl_surrogate_model,
+        training_set=kl_training_set,
+        training_perturbations=training_perturbations,
+        filename=kl_validation_filename,
+    )
+
+    write_query_info(
+        output_directory,
+        variables=shared['variable_names'],
+        subset_filename=shared['subset_filename'],
+        use_depth=use_depth,
+        log_space=log_space,
+        min_depth=min_depth,
+        polynomial_order=polynomial_order,
+        depth_adjust=training_depth_adjust.values if log_space else None,
+    )
 
     # convert the KL surrogate model to the overall surrogate at each node
     surrogate_model = surrogate_from_karhunen_loeve(
@@ -315,71 +674,43 @@ def _analyze(tracks_dir, analyze_dir, mann_coef):
         filename=surrogate_filename,
     )
 
-    if make_sensitivities_plot:
-        sensitivities = sensitivities_from_surrogate(
-            surrogate_model=surrogate_model,
-            distribution=distribution,
-            variables=perturbations['variable'],
-            nodes=subset,
-            element_table=elements if point_spacing is None else None,
-            filename=sensitivities_filename,
-        )
-        plot_sensitivities(
-            sensitivities=sensitivities,
-            storm=storm_name,
-            output_filename=output_directory / 'sensitivities.png' if save_plots else None,
-        )
-
-    if make_validation_plot:
-        node_validation = validations_from_surrogate(
-            surrogate_model=surrogate_model,
-            training_set=training_set,
-            training_perturbations=training_perturbations,
-            validation_set=validation_set,
-            validation_perturbations=validation_perturbations,
-            convert_from_log_scale=log_space,
-            convert_from_depths=training_depth_adjust.values if log_space else use_depth,
-            minimum_allowable_value=min_depth if use_depth else None,
-            element_table=elements if point_spacing is None else None,
-            filename=validation_filename,
-        )
-
-        plot_validations(
-            validation=node_validation,
-            output_directory=output_directory if save_plots else None,
-        )
-
-        plot_selected_validations(
-            validation=node_validation,
-            run_list=validation_set['run'][
-                numpy.linspace(0, validation_set.shape[0], 6, endpoint=False).astype(int)
-            ].values,
-            output_directory=output_directory if save_plots else None,
-        )
+    sensitivities_from_kl_surrogate(
+        kl_surrogate_model=kl_surrogate_model,
+        kl_expansion=kl_expansion,
+        variables=training_perturbations['variable'],
+        nodes=subset,
+        element_table=elements if point_spacing is None else None,
+        filename=sensitivities_filename,
+    )
 
-    if make_percentile_plot:
-        percentiles = [10, 30, 50, 70, 90]
-        node_percentiles = percentiles_from_surrogate(
-            surrogate_model=surrogate_model,
-            distribution=distribution,
-            training_set=validation_set,
-            percentiles=percentiles,
-            convert_from_log_scale=log_space,
-            convert_from_depths=training_depth_adjust.values if log_space else use_depth,
-            minimum_allowable_value=min_depth if use_depth else None,
-            element_table=elements if point_spacing is None else None,
-            filename=percentile_filename,
-        )
+    validations_from_surrogate(
+        surrogate_model=surrogate_model,
+        training_set=training_set,
+        training_perturbations=training_perturbations,
+        validation_set=validation_set,
+        validation_perturbations=validation_perturbations,
+        convert_from_log_scale=log_space,
+        convert_from_depths=training_depth_adjust.values if log_space else use_depth,
+        minimum_allowable_value=min_depth if use_depth else None,
+        element_table=elements if point_spacing is None else None,
+        filename=validation_filename,
+    )
 
-        plot_selected_percentiles(
-            node_percentiles=node_percentiles,
-            perc_list=percentiles,
-            output_directory=output_directory if save_plots else None,
-        )
+    percentiles = [10, 30, 50, 70, 90]
+    percentiles_from_kl_surrogate(
+        kl_surrogate_model=kl_surrogate_model,
+        kl_expansion=kl_expansion,
+        distribution=distribution,
+        training_set=validation_set,
+        percentiles=percentiles,
+        convert_from_log_scale=log_space,
+        convert_from_depths=training_depth_adjust.values if log_space else use_depth,
+        minimum_allowable_value=min_depth if use_depth else None,
+        element_table=elements if point_spacing is None else None,
+        filename=percentile_filename,
+    )
 
-    if show_plots:
-        LOGGER.info('showing plots')
-        pyplot.show()
+    return output_directory
 
 
 if __name__ == '__main__':
@@ -388,5 +719,26 @@ if __name__ == '__main__':
     parser.add_argument('-d', '--ensemble-dir', type=Path)
     parser.add_argument('-t', '--tracks-dir', type=Path)
     parser.add_argument('-s', '--sequential', action='store_true')
+    parser.add_argument(
+        '--surrogate-cv', choices=CROSS_VALIDATIONS, default='loo',
+        help='cross validation of the surrogate regression',
+    )
+    parser.add_argument(
+        '--surrogate-workers', type=int, default=None,
+        help='workers for fitting the surrogate of each analysis',
+    )
+    plots = parser.add_mutually_exclusive_group()
+    plots.add_argument(
+        '--skip-plots', action='store_true',
+        help='only write the numerical products, e.g. for forecast cycles',
+    )
+    plots.add_argument(
+        '--plots-only', action='store_true',
+        help='render the figures of an already analyzed ensemble',
+    )
+    parser.add_argument(
+        '--plot-workers', type=int, default=None,
+        help='processes rendering the figures',
+    )
 
     main(parser.parse_args())
@@ -1,11 +1,39 @@
+import fcntl
+import json
 from argparse import ArgumentParser
+from contextlib import contextmanager
 from pathlib import Path
 
+import dask.array
+import numcodecs
+import numpy
+import xarray
+from pyschism.mesh import Hgrid
+
 from ensembleperturbation.client.combine_results import combine_results
+from ensembleperturbation.perturbation.atcf import parse_vortex_perturbations
 from ensembleperturbation.utilities import get_logger
 
+from fileio import write_json_atomic
+
 LOGGER = get_logger('klpc_wetonly')
 
+# Incrementally combined results of finished members
+STORE_NAME = 'ensemble.zarr'
+COMBINE_MANIFEST = 'combine_manifest.json'
+COMBINE_LOCK = '.combine.lock'
+MEMBERS_MANIFEST = 'members.json'
+# Written to the run outputs by `schism.sbatch` once the run succeeded
+RUN_DONE_FILE = 'maxelev.gr3'
+
+# Chunks are bounded along both runs and nodes so that reading all
+# nodes of a run or all runs of a node block are both cheap
+ZARR_RUN_CHUNK = 8
+ZARR_NODE_CHUNK = 2 ** 16
+ZARR_COMPRESSOR = numcodecs.Blosc(
+    cname='zstd', clevel=3, shuffle=numcodecs.Blosc.BITSHUFFLE
+)
+COMBINED_FILES = ('maxele.63.nc', 'perturbations.nc')
 
 
 def main(args):
@@ -13,13 +41,241 @@ def main(args):
     tracks_dir = args.tracks_dir
     ensemble_dir = args.ensemble_dir
 
-    output = combine_results(
-        model='schism',
-        adcirc_like=True,
-        output=ensemble_dir/'analyze',
-        directory=ensemble_dir,
-        parallel=not args.sequential
+    if args.member is not None:
+        combine_member(ensemble_dir, args.member)
+
+    elif args.from_store:
+        combine_from_store(ensemble_dir, tracks_dir)
+
+    else:
+        output = combine_results(
+            model='schism',
+            adcirc_like=True,
+            output=ensemble_dir/'analyze',
+            directory=ensemble_dir,
+            parallel=not args.sequential
+        )
+
+    if args.zarr:
+        write_zarr_stores(ensemble_dir/'analyze')
+
+
+def to_chunked_zarr(dataset, store_path):
+    '''Write dataset to a compressed Zarr store chunked by run and node'''
+
+    chunks = {
+        dim: size
+        for dim, size in (('run', ZARR_RUN_CHUNK), ('node', ZARR_NODE_CHUNK))
+        if dim in dataset.dims
+    }
+    dataset = dataset.chunk(chunks)
+    # NOTE: netCDF encodings (chunksizes, zlib, ...) don't apply
+    for variable in dataset.variables.values():
+        variable.encoding = {}
+    encoding = {
+        name: {'compressor': ZARR_COMPRESSOR} for name in dataset.data_vars
+    }
+    dataset.to_zarr(store_path, mode='w', encoding=encoding, consolidated=True)
+
+
+def write_zarr_stores(analyze_dir):
+    '''Write Zarr copies of the combined netCDF files for the analysis'''
+
+    for filename in COMBINED_FILES:
+        nc_path = analyze_dir / filename
+        zarr_path = nc_path.with_suffix('.zarr')
+        LOGGER.info(f'writing "{zarr_path}"')
+        with xarray.open_dataset(nc_path, chunks={}) as dataset:
+            to_chunked_zarr(dataset, zarr_path)
+
+
+@contextmanager
+def combine_lock(analyze_dir):
+    '''Serialize store creation and manifest updates of member jobs'''
+
+    analyze_dir.mkdir(parents=True, exist_ok=True)
+    with open(analyze_dir / COMBINE_LOCK, 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _read_manifest(analyze_dir):
+
+    manifest_path = analyze_dir / COMBINE_MANIFEST
+    if not manifest_path.exists():
+        return {'runs': [], 'combined': []}
+    with open(manifest_path) as fi:
+        return json.load(fi)
+
+
+def _write_manifest(analyze_dir, manifest):
+
+    write_json_atomic(analyze_dir / COMBINE_MANIFEST, manifest)
+
+
+def ensemble_runs(ensemble_dir):
+    '''All member names, including not yet generated streamed ones'''
+
+    members_path = ensemble_dir / MEMBERS_MANIFEST
+    if members_path.exists():
+        with open(members_path) as fi:
+            return list(json.load(fi)['runs'])
+    return sorted(run.name for run in (ensemble_dir / 'runs').iterdir())
+
+
+def finished_runs(ensemble_dir):
+    '''Member directories whose run finished successfully'''
+
+    return [
+        run_dir for run_dir in sorted((ensemble_dir / 'runs').iterdir())
+        if (run_dir / 'outputs' / RUN_DONE_FILE).exists()
+    ]
+
+
+def read_member_max_elevation(run_dir):
+    '''Maximum elevation of a single member in `adcirc_like` layout'''
+
+    out_files = sorted(
+        (run_dir / 'outputs').glob('out2d_*.nc'),
+        key=lambda path: int(path.stem.split('_')[-1])
     )
+    if len(out_files) == 0:
+        raise FileNotFoundError(f'No out2d output found in {run_dir}')
+
+    out2d = xarray.open_mfdataset(out_files, lock=False)
+    elevation = out2d['elevation']
+    arg_max = elevation.argmax(dim='time').compute()
+    h0 = float(out2d['minimum_depth'].isel(one=0).values)
+
+    zeta_max = elevation.isel(time=arg_max)
+    # NOTE: Nodes are dry if the total water depth is below `h0`, the
+    # elevation alone would also null wet land and deep nodes with
+    # negative maximum elevation
+    total_depth = zeta_max + out2d['depth']
+    maxele = xarray.Dataset(
+        {
+            'zeta_max': zeta_max.where(total_depth > h0, numpy.nan),
+            'time_of_zeta_max': out2d['time'].isel(time=arg_max),
+        },
+    ).reset_coords(drop=True)
+    maxele = maxele.rename(nSCHISM_hgrid_node='node').assign_coords(
+        node=numpy.arange(elevation.sizes['nSCHISM_hgrid_node']),
+        x=('node', out2d['SCHISM_hgrid_node_x'].values),
+        y=('node', out2d['SCHISM_hgrid_node_y'].values),
+        depth=('node', out2d['depth'].values),
+    )
+    maxele = maxele.expand_dims(run=[run_dir.name]).compute()
+    maxele.attrs['h0'] = h0
+    out2d.close()
+
+    return maxele
+
+
+def _create_store(store_path, runs, member_ds):
+    '''Create empty store for all the runs, filled per member later'''
+
+    n_nodes = member_ds.sizes['node']
+    data_vars = {}
+    for name, var in member_ds.data_vars.items():
+        fill_value = numpy.array(numpy.nan).astype(var.dtype)
+        data_vars[name] = (
+            ('run', 'node'),
+            dask.array.full(
+                (len(runs), n_nodes),
+                fill_value,
+                dtype=var.dtype,
+                chunks=(1, n_nodes),
+            ),
+        )
+    template = xarray.Dataset(
+        data_vars,
+        coords={
+            'run': runs,
+            **{name: coord for name, coord in member_ds.coords.items()
+               if name != 'run'},
+        },
+        attrs=member_ds.attrs,
+    )
+    # Only writes metadata and coordinates
+    template.to_zarr(store_path, mode='w', compute=False)
+
+
+def combine_member(ensemble_dir, run_dir):
+    '''Write results of a single finished member into the store'''
+
+    analyze_dir = ensemble_dir / 'analyze'
+    store_path = analyze_dir / STORE_NAME
+
+    member_ds = read_member_max_elevation(run_dir)
+
+    with combine_lock(analyze_dir):
+        manifest = _read_manifest(analyze_dir)
+        if not store_path.exists():
+            manifest = {'runs': ensemble_runs(ensemble_dir), 'combined': []}
+            _create_store(store_path, manifest['runs'], member_ds)
+            _write_manifest(analyze_dir, manifest)
+
+    # NOTE: Each member writes its own run chunks, no lock needed
+    run_idx = manifest['runs'].index(run_dir.name)
+    member_ds.drop_vars(list(member_ds.coords)).to_zarr(
+        store_path, region={'run': slice(run_idx, run_idx + 1)}
+    )
+
+    with combine_lock(analyze_dir):
+        manifest = _read_manifest(analyze_dir)
+        if run_dir.name not in manifest['combined']:
+            manifest['combined'].append(run_dir.name)
+        _write_manifest(analyze_dir, manifest)
+
+    LOGGER.info(
+        f'combined {run_dir.name}'
+        f' ({len(manifest["combined"])}/{len(manifest["runs"])})'
+    )
+
+
+def combine_from_store(ensemble_dir, tracks_dir, output_dir=None):
+    '''Write combined results of all finished members from the store
+
+    Results are written to the ensemble `analyze` directory unless
+    `output_dir` is given.
+    '''
+
+    analyze_dir = ensemble_dir / 'analyze'
+    store_path = analyze_dir / STORE_NAME
+    if output_dir is None:
+        output_dir = analyze_dir
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    # Pick up finished members whose combine job didn't run
+    combined = _read_manifest(analyze_dir)['combined']
+    for run_dir in finished_runs(ensemble_dir):
+        if run_dir.name in combined:
+            continue
+        combine_member(ensemble_dir, run_dir)
+
+    combined = _read_manifest(analyze_dir)['combined']
+    max_elevations = xarray.open_zarr(store_path)
+    max_elevations = max_elevations.sel(
+        run=[run for run in max_elevations['run'].values if run in combined]
+    )
+
+    # NOTE: All elements are treated as tria (quads are split)
+    grid = Hgrid.open(ensemble_dir / 'spinup' / 'hgrid.gr3', crs=4326)
+    max_elevations = max_elevations.assign_coords(
+        element=(
+            ('nele', 'nvertex'), grid.elements.triangulation.triangles
+        )
+    )
+
+    LOGGER.info(f'writing {len(combined)} runs to "{output_dir}"')
+    max_elevations.to_netcdf(output_dir / 'maxele.63.nc')
+    parse_vortex_perturbations(tracks_dir).to_netcdf(
+        output_dir / 'perturbations.nc'
+    )
+
 
 if __name__ == '__main__':
 
@@ -27,5 +283,17 @@ if __name__ == '__main__':
     parser.add_argument('-d', '--ensemble-dir', type=Path)
     parser.add_argument('-t', '--tracks-dir', type=Path)
     parser.add_argument('-s', '--sequential', action='store_true')
+    parser.add_argument(
+        '-m', '--member', type=Path,
+        help='combine a single finished member into the ensemble store',
+    )
+    parser.add_argument(
+        '--from-store', action='store_true',
+        help='write combined results from the incremental ensemble store',
+    )
+    parser.add_argument(
+        '--zarr', action='store_true',
+        help='also write chunked Zarr stores of the combined results',
+    )
 
     main(parser.parse_args())
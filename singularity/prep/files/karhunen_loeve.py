@@ -0,0 +1,176 @@
+'''Karhunen-Loeve expansion of large training sets
+
+Same results as `karhunen_loeve_expansion(..., method='PCA')` of
+`ensembleperturbation` but using a randomized SVD on a chunked dask
+array, so that the full `nens x ngrid` matrix and its dense
+decomposition are never held in memory.
+
+The expansion is stored as one `.npy` file per array (instead of a
+pickle) so that each array can be memory mapped on its own.
+'''
+
+import pickle
+import shutil
+
+import dask.array
+from matplotlib import pyplot
+import numpy
+
+from ensembleperturbation.utilities import get_logger
+
+LOGGER = get_logger('karhunen_loeve')
+
+# Nodes per chunk of the training set
+NODE_CHUNK = 2 ** 16
+# Power iterations of the randomized SVD, improves accuracy of the
+# trailing modes at the cost of passes over the data
+N_POWER_ITER = 2
+# Modes computed in addition to the kept ones for their accuracy
+N_OVERSAMPLES = 10
+# Modes first computed when keeping a fraction of the variance, doubled
+# until enough of the variance is explained
+INITIAL_MODES = 32
+# Arrays of the expansion stored as separate `.npy` files
+KL_ARRAYS = ('mean_vector', 'modes', 'eigenvalues', 'samples')
+KL_DIRECTORY = 'karhunen_loeve'
+# Expansion stored by older analyses
+KL_PICKLE = 'karhunen_loeve.pkl'
+
+
+
+def karhunen_loeve_expansion_randomized(
+    ymodel,
+    neig,
+    output_directory=None,
+    random_state=666,
+):
+    '''Truncated KL expansion (whitened PCA) from randomized SVD'''
+
+    if not isinstance(ymodel, dask.array.Array):
+        ymodel = dask.array.from_array(ymodel, chunks=(-1, NODE_CHUNK))
+    else:
+        ymodel = ymodel.rechunk({0: -1})
+
+    nens, ngrid = ymodel.shape
+    # NOTE: Rank of the centered matrix is at most nens - 1
+    rank = max(1, min(nens - 1, ngrid))
+
+    mean_vector = ymodel.mean(axis=0)
+    total_variance = ((ymodel - mean_vector) ** 2).sum() / (nens - 1)
+    mean_vector, total_variance = dask.compute(mean_vector, total_variance)
+    centered = ymodel - mean_vector
+
+    if neig is None:
+        n_modes = rank
+    elif isinstance(neig, float):
+        n_modes = INITIAL_MODES
+    else:
+        n_modes = neig
+
+    # NOTE: Only the requested modes and the oversamples are computed
+    # rather than all `rank` of them
+    while True:
+        k = min(n_modes + N_OVERSAMPLES, rank)
+        LOGGER.info(f'computing {k} singular values of {nens} x {ngrid} training set')
+        u, s, _ = dask.array.linalg.svd_compressed(
+            centered,
+            k=k,
+            n_power_iter=N_POWER_ITER,
+            seed=random_state,
+        )
+        u, s = dask.compute(u, s)
+        eigenvalues = s ** 2 / (nens - 1)
+
+        if not isinstance(neig, float):
+            break
+        # number of modes to explain `neig` fraction of the variance
+        explained = numpy.cumsum(eigenvalues) / total_variance
+        n_explained = int(numpy.searchsorted(explained, neig, side='right') + 1)
+        if n_explained <= n_modes or k == rank:
+            n_modes = n_explained
+            break
+        n_modes *= 2
+
+    neig = min(n_modes, k)
+
+    # same sign convention as `sklearn` PCA
+    u = u[:, :neig]
+    signs = numpy.sign(u[numpy.abs(u).argmax(axis=0), range(neig)])
+    signs[signs == 0] = 1
+    u = u * signs
+
+    # NOTE: Only the kept modes are projected out of the data
+    modes = ((u / s[:neig]).T @ centered).compute()
+
+    kl_dict = {
+        'mean_vector': mean_vector,
+        'modes': modes,
+        'eigenvalues': eigenvalues[:neig],
+        'neig': neig,
+        # whitened samples
+        'samples': u * numpy.sqrt(nens - 1),
+    }
+
+    if output_directory is not None:
+        save_karhunen_loeve(kl_dict, output_directory / KL_DIRECTORY)
+
+    return kl_dict
+
+
+def save_karhunen_loeve(kl_dict, directory):
+    '''Save the expansion arrays so that they can be memory mapped'''
+
+    # NOTE: Written aside so that a partial expansion is never loaded
+    tmp_directory = directory.with_name(f'.{directory.name}.tmp')
+    if tmp_directory.exists():
+        shutil.rmtree(tmp_directory)
+    tmp_directory.mkdir(parents=True)
+    for name in KL_ARRAYS:
+        numpy.save(tmp_directory / f'{name}.npy', numpy.asarray(kl_dict[name]))
+    if directory.exists():
+        shutil.rmtree(directory)
+    tmp_directory.rename(directory)
+
+
+def load_karhunen_loeve(directory, mmap_mode='r'):
+    '''Load the expansion arrays, memory mapped by default'''
+
+    kl_dict = {
+        name: numpy.load(directory / f'{name}.npy', mmap_mode=mmap_mode)
+        for name in KL_ARRAYS
+    }
+    kl_dict['neig'] = len(kl_dict['eigenvalues'])
+
+    return kl_dict
+
+
+def read_karhunen_loeve(output_directory, mmap_mode='r'):
+    '''Load the expansion of an analysis, None if there is none
+
+    Expansions of older analyses are read from the pickle'''
+
+    kl_directory = output_directory / KL_DIRECTORY
+    if kl_directory.exists():
+        return load_karhunen_loeve(kl_directory, mmap_mode=mmap_mode)
+
+    kl_filename = output_directory / KL_PICKLE
+    if kl_filename.exists():
+        LOGGER.info(f'loading Karhunen-Loeve expansion from "{kl_filename}"')
+        with open(kl_filename, 'rb') as kl_handle:
+            return pickle.load(kl_handle)
+
+    return None
+
+
+def plot_eigenvalues(kl_dict, output_directory):
+
+    figure = pyplot.figure()
+    axis = figure.add_subplot(1, 1, 1)
+
+    axis.plot(range(1, kl_dict['neig'] + 1), kl_dict['eigenvalues'], 'o-')
+
+    axis.set_xlabel('x')
+    axis.set_ylabel('Eigenvalue')
+
+    figure.savefig(output_directory / 'KL_eigenvalues.png', dpi=200, bbox_inches='tight')
+    pyplot.close()
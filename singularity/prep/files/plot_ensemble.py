@@ -0,0 +1,177 @@
+'''Figures of the ensemble analysis
+
+Rendered from the products written by `analyze_ensemble` after all the
+numerical work is done, each figure in its own process.
+'''
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy
+import xarray
+
+from ensembleperturbation.plotting.perturbation import plot_perturbations
+from ensembleperturbation.plotting.surrogate import (
+    plot_kl_surrogate_fit,
+    plot_selected_percentiles,
+    plot_selected_validations,
+    plot_sensitivities,
+    plot_validations,
+)
+from ensembleperturbation.uncertainty_quantification.karhunen_loeve_expansion import (
+    karhunen_loeve_prediction,
+)
+from ensembleperturbation.utilities import get_logger
+
+from karhunen_loeve import plot_eigenvalues, read_karhunen_loeve
+
+LOGGER = get_logger('klpc_wetonly')
+
+# Training and validation split of the analysis
+PERTURBATIONS_FILENAME = 'perturbations.nc'
+# Dry area adjusted training set of each analysis
+TRAINING_SET_FILENAME = 'training_set_adjusted.nc'
+
+
+
+def _open(path):
+
+    with xarray.open_dataset(path) as dataset:
+        return dataset.load()
+
+
+def _element_table(output_directory):
+
+    # NOTE: Only stored with outputs if plotted on the mesh
+    percentiles = _open(output_directory / 'percentiles.nc')
+    if 'element' in percentiles.coords:
+        return percentiles['element']
+    return None
+
+
+def _split_perturbations(shared_directory):
+
+    perturbations = _open(shared_directory / PERTURBATIONS_FILENAME)
+    return (
+        perturbations,
+        perturbations.sel(run=perturbations['type'] == 'training'),
+        perturbations.sel(run=perturbations['type'] == 'validation'),
+    )
+
+
+def plot_perturbations_figure(shared_directory, output_directory, tracks_dir):
+
+    perturbations, training, validation = _split_perturbations(shared_directory)
+    plot_perturbations(
+        training_perturbations=training,
+        validation_perturbations=validation,
+        runs=perturbations['run'].values,
+        perturbation_types=perturbations['type'].values,
+        track_directory=tracks_dir,
+        output_directory=output_directory,
+    )
+
+
+def plot_eigenvalues_figure(shared_directory, output_directory, tracks_dir):
+
+    plot_eigenvalues(read_karhunen_loeve(output_directory), output_directory)
+
+
+def plot_kl_prediction_figure(shared_directory, output_directory, tracks_dir):
+
+    # plot prediction versus actual simulated
+    with xarray.open_dataarray(output_directory / TRAINING_SET_FILENAME) as actual:
+        actual = actual.load()
+    nens = actual.shape[0]
+    karhunen_loeve_prediction(
+        kl_dict=read_karhunen_loeve(output_directory),
+        actual_values=actual,
+        ensembles_to_plot=[0, int(nens / 2), nens - 1],
+        element_table=_element_table(output_directory),
+        plot_directory=output_directory,
+    )
+
+
+def plot_kl_fit_figure(shared_directory, output_directory, tracks_dir):
+
+    # plot kl surrogate model versus training set
+    plot_kl_surrogate_fit(
+        kl_fit=_open(output_directory / 'kl_surrogate_fit.nc'),
+        output_filename=output_directory / 'kl_surrogate_fit.png',
+    )
+
+
+def plot_sensitivities_figure(shared_directory, output_directory, tracks_dir):
+
+    plot_sensitivities(
+        sensitivities=_open(output_directory / 'sensitivities.nc'),
+        storm=tracks_dir / 'original.22',
+        output_filename=output_directory / 'sensitivities.png',
+    )
+
+
+def plot_validations_figure(shared_directory, output_directory, tracks_dir):
+
+    node_validation = _open(output_directory / 'validation.nc')
+    plot_validations(
+        validation=node_validation,
+        output_directory=output_directory,
+    )
+
+    _, _, validation = _split_perturbations(shared_directory)
+    validation_runs = validation['run']
+    plot_selected_validations(
+        validation=node_validation,
+        run_list=validation_runs[
+            numpy.linspace(0, len(validation_runs), 6, endpoint=False).astype(int)
+        ].values,
+        output_directory=output_directory,
+    )
+
+
+def plot_percentiles_figure(shared_directory, output_directory, tracks_dir):
+
+    node_percentiles = _open(output_directory / 'percentiles.nc')
+    plot_selected_percentiles(
+        node_percentiles=node_percentiles,
+        perc_list=node_percentiles['quantile'].values.tolist(),
+        output_directory=output_directory,
+    )
+
+
+# Figures of each analysis output directory
+OUTPUT_FIGURES = (
+    plot_eigenvalues_figure,
+    plot_kl_prediction_figure,
+    plot_kl_fit_figure,
+    plot_sensitivities_figure,
+    plot_validations_figure,
+    plot_percentiles_figure,
+)
+
+
+def render_plots(tracks_dir, shared_directory, output_directories, max_workers=None):
+    '''Render all the figures of the analyses concurrently'''
+
+    tasks = [(plot_perturbations_figure, shared_directory)]
+    for output_directory in output_directories:
+        tasks.extend((figure, output_directory) for figure in OUTPUT_FIGURES)
+
+    LOGGER.info(f'rendering {len(tasks)} figures')
+    failed = []
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            executor.submit(figure, shared_directory, directory, tracks_dir):
+                (figure.__name__, directory)
+            for figure, directory in tasks
+        }
+        # NOTE: A failed figure shouldn't prevent rendering the others
+        for future in as_completed(futures):
+            name, directory = futures[future]
+            try:
+                future.result()
+            except Exception:
+                LOGGER.exception(f'failed rendering {name} of "{directory}"')
+                failed.append(f'{name} ({directory})')
+
+    if len(failed) > 0:
+        raise RuntimeError(f'Failed rendering {", ".join(failed)}')
@@ -0,0 +1,199 @@
+'''Maximum elevation predictions from a fitted KL surrogate
+
+The surrogate of an analysis output directory (e.g.
+`analyze/linear_k1_p1_n0.025`) is loaded once with the KL modes memory
+mapped, then the maximum elevation at the subset nodes is predicted
+for any perturbation vector. Perturbations are given in the same
+(standardized) space as `perturbations.nc`, 0 being unperturbed.
+
+    query_surrogate -o analyze/linear_k1_p1_n0.025 --vmax 1 --rmax -0.5
+'''
+
+import json
+import os
+from argparse import ArgumentParser
+from pathlib import Path
+import time
+
+import chaospy
+import numpy
+import pandas
+import xarray
+
+from ensembleperturbation.utilities import get_logger
+
+from karhunen_loeve import KL_DIRECTORY, read_karhunen_loeve, save_karhunen_loeve
+from surrogate_fit import POLYNOMIAL_ORDER, perturbation_distribution, with_expansion
+
+LOGGER = get_logger('klpc_wetonly')
+
+QUERY_INFO = 'query.json'
+DEPTH_ADJUST = 'depth_adjust.npy'
+# Short names of the perturbed variables
+VARIABLE_ALIASES = {
+    'cross_track': 'cross_track',
+    'along_track': 'along_track',
+    'rmax': 'radius_of_maximum_winds',
+    'vmax': 'max_sustained_wind_speed',
+}
+
+
+
+def write_query_info(
+    output_directory,
+    variables,
+    subset_filename,
+    use_depth,
+    log_space,
+    min_depth,
+    polynomial_order=POLYNOMIAL_ORDER,
+    depth_adjust=None,
+):
+    '''Store what is needed to convert surrogate values to elevations'''
+
+    info = {
+        'variables': [str(variable) for variable in variables],
+        # relative so that the analysis directory can be moved
+        'subset': os.path.relpath(subset_filename, output_directory),
+        'use_depth': bool(use_depth),
+        'log_space': bool(log_space),
+        'min_depth': float(min_depth),
+        'polynomial_order': int(polynomial_order),
+    }
+    if log_space:
+        numpy.save(output_directory / DEPTH_ADJUST, numpy.asarray(depth_adjust))
+    with open(output_directory / QUERY_INFO, 'w') as fo:
+        json.dump(info, fo, indent=2)
+
+
+def load_surrogate(output_directory):
+    '''Load the surrogate of an analysis for repeated queries'''
+
+    with open(output_directory / QUERY_INFO) as fi:
+        surrogate = json.load(fi)
+
+    kl_expansion = read_karhunen_loeve(output_directory, mmap_mode='r')
+    if not (output_directory / KL_DIRECTORY).exists():
+        # NOTE: Convert pickles of old analyses, to memory map modes
+        save_karhunen_loeve(kl_expansion, output_directory / KL_DIRECTORY)
+        kl_expansion = read_karhunen_loeve(output_directory, mmap_mode='r')
+    kl_surrogate_model = with_expansion(
+        numpy.load(output_directory / 'kl_surrogate.npy', allow_pickle=True),
+        perturbation_distribution(surrogate['variables']),
+        # NOTE: Not stored by older analyses
+        surrogate.get('polynomial_order', POLYNOMIAL_ORDER),
+    )
+
+    with xarray.open_dataset(output_directory / surrogate['subset']) as subset:
+        nodes = {
+            coord: subset[coord].values for coord in ('node', 'x', 'y', 'depth')
+        }
+
+    surrogate.update({
+        'expansion': chaospy.aspolynomial(kl_surrogate_model['expansion']),
+        # PC coefficients of KL modes scaled by sqrt of eigenvalues
+        'kl_coefficients': (
+            kl_surrogate_model['coefs'] * numpy.sqrt(kl_expansion['eigenvalues'])
+        ),
+        'modes': kl_expansion['modes'],
+        'mean_vector': numpy.asarray(kl_expansion['mean_vector']),
+        'nodes': nodes,
+    })
+    if surrogate['log_space']:
+        surrogate['depth_adjust'] = numpy.load(output_directory / DEPTH_ADJUST)
+
+    return surrogate
+
+
+def predict(surrogate, perturbations):
+    '''Maximum elevation (scenario x node) for perturbation vectors
+
+    `perturbations` is a scenario x variable array in the order of
+    `surrogate['variables']`
+    '''
+
+    perturbations = numpy.atleast_2d(perturbations)
+    basis = surrogate['expansion'](*perturbations.T)
+    kl_values = numpy.dot(basis.T, surrogate['kl_coefficients'])
+    values = numpy.dot(kl_values, surrogate['modes']) + surrogate['mean_vector']
+
+    if surrogate['log_space']:
+        values = numpy.exp(values) - surrogate['depth_adjust']
+    # NOTE: Same conversion as the surrogate percentiles
+    if surrogate['use_depth']:
+        values[values < surrogate['min_depth']] = numpy.nan
+        values -= surrogate['nodes']['depth']
+
+    return values
+
+
+def query(surrogate, scenarios):
+    '''Predicted `zeta_max` for a table of scenarios'''
+
+    missing = set(VARIABLE_ALIASES) - set(scenarios.columns)
+    if len(missing) > 0:
+        LOGGER.info(f'unperturbed {sorted(missing)}')
+    scenarios = scenarios.reindex(columns=list(VARIABLE_ALIASES), fill_value=0.0)
+    names = {name: alias for alias, name in VARIABLE_ALIASES.items()}
+    perturbations = scenarios[
+        [names[variable] for variable in surrogate['variables']]
+    ].values
+
+    start_time = time.time()
+    values = predict(surrogate, perturbations)
+    LOGGER.info(
+        f'predicted {len(scenarios)} scenario(s)'
+        f' in {(time.time() - start_time) * 1000:.1f} ms'
+    )
+
+    nodes = surrogate['nodes']
+    return xarray.Dataset(
+        {'zeta_max': (('scenario', 'node'), values)},
+        coords={
+            'scenario': numpy.arange(len(scenarios)),
+            'node': nodes['node'],
+            'x': ('node', nodes['x']),
+            'y': ('node', nodes['y']),
+            'depth': ('node', nodes['depth']),
+            **{
+                alias: ('scenario', scenarios[alias].values)
+                for alias in VARIABLE_ALIASES
+            },
+        },
+    )
+
+
+def main(args):
+
+    if args.scenarios is not None:
+        scenarios = pandas.read_csv(args.scenarios)
+    else:
+        scenarios = pandas.DataFrame([{
+            alias: getattr(args, alias) for alias in VARIABLE_ALIASES
+        }])
+
+    surrogate = load_surrogate(args.output_directory)
+    prediction = query(surrogate, scenarios)
+
+    LOGGER.info(f'writing predictions to "{args.out}"')
+    prediction.to_netcdf(args.out)
+
+
+if __name__ == '__main__':
+
+    parser = ArgumentParser()
+    parser.add_argument(
+        '-o', '--output-directory', type=Path, required=True,
+        help='analysis output directory with the fitted surrogate',
+    )
+    for alias in VARIABLE_ALIASES:
+        parser.add_argument(
+            f'--{alias.replace("_", "-")}', dest=alias, type=float, default=0.0
+        )
+    parser.add_argument(
+        '--scenarios', type=Path,
+        help=f'CSV of scenarios with columns {list(VARIABLE_ALIASES)}',
+    )
+    parser.add_argument('--out', type=Path, default=Path('prediction.nc'))
+
+    main(parser.parse_args())
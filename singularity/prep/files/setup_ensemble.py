@@ -3,12 +3,12 @@ import glob
 import logging
 import tempfile
 from argparse import ArgumentParser
-from copy import deepcopy
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from copy import copy, deepcopy
 from datetime import datetime, timedelta
 from pathlib import Path
 
 
-import f90nml
 import geopandas as gpd
 import pandas as pd
 from coupledmodeldriver import Platform
@@ -21,6 +21,10 @@ from coupledmodeldriver.configure import (
 from coupledmodeldriver.generate import SCHISMRunConfiguration
 from coupledmodeldriver.generate.schism.script import SchismEnsembleGenerationJob
 from coupledmodeldriver.generate import generate_schism_configuration
+from coupledmodeldriver.generate.schism.generate import (
+    write_run_directory,
+    write_spinup_directory,
+)
 from stormevents import StormEvent
 from stormevents.nhc.track import VortexTrack
 from pyschism.mesh import Hgrid
@@ -28,21 +32,319 @@ from pyschism.forcing import NWM
 from ensembleperturbation.perturbation.atcf import perturb_tracks
 
 import wwm
+from fileio import file_digest, link_file, write_json_atomic
+from namelist import IF_SOURCE_PATCH, patch_namelist, patch_namelists
 
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
 
-def _fix_nwm_issue(ensemble_dir):
+# Static inputs that are identical across members; they're
+# deduplicated into the ensemble `common/` directory
+SHARED_INPUTS = (
+    'hgrid.gr3',
+    'vgrid.in',
+    'bctides.in',
+    'manning.gr3',
+    'drag.gr3',
+    'windrot_geo2proj.gr3',
+    'elev.ic',
+    'source_sink.in',
+    'vsource.th',
+    'msource.th',
+    'vsink.th',
+    'source.json',
+    'sink.json',
+    'hgrid_WWM.gr3',
+    'wwmbnd.gr3',
+    'sflux/*.nc',
+)
+COMMON_DIR = 'common'
+
+# Streaming member generation status files
+MEMBERS_MANIFEST = 'members.json'
+MEMBERS_READY = 'members.ready'
+MEMBERS_DONE = 'members.done'
+
+# Column positions in fort.22 records
+FORT22_DATETIME_COL = 2
+FORT22_ADVISORY_COL = 4
+FORT22_HOURS_COL = 5
+
+
+def _read_fort22(path):
+    '''Read fort.22 records as padded string fields without parsing'''
+
+    return pd.read_csv(path, header=None, dtype=str, keep_default_na=False)
+
+
+def _to_best_fort22(fort22):
+    '''Fake BEST track records, same as writing a BEST `VortexTrack`'''
+
+    fort22 = fort22.copy()
+    issue_times = pd.to_datetime(
+        fort22[FORT22_DATETIME_COL].str.strip(), format='%Y%m%d%H'
+    )
+    hours = pd.to_timedelta(
+        fort22[FORT22_HOURS_COL].str.strip().astype(int), unit='h'
+    )
+    is_best = fort22[FORT22_ADVISORY_COL].str.strip() == 'BEST'
+    times = issue_times.where(is_best, issue_times + hours)
+
+    fort22[FORT22_DATETIME_COL] = times.dt.strftime('%Y%m%d%H').str.pad(11)
+    fort22[FORT22_ADVISORY_COL] = 'BEST'.rjust(5)
+    fort22[FORT22_HOURS_COL] = (
+        ((times - times.iloc[0]) / pd.Timedelta('1 hour'))
+        .astype(int).astype(str).str.pad(4)
+    )
+    # Record number is the last column
+    fort22[fort22.columns[-1]] = (
+        times.rank(method='dense').astype(int).astype(str).str.pad(4)
+    )
+
+    return fort22
+
+
+def _all_members(ensemble_dir):
+    return [ensemble_dir / 'spinup', *ensemble_dir.glob('runs/*')]
+
+
+def share_member_inputs(ensemble_dir, member_dirs=None, patterns=SHARED_INPUTS):
+    '''Deduplicate static member inputs by content into `common/`
+
+    Regular files matching `patterns` in spinup and each run are moved
+    to `common/<sha256>` and linked back. Shared files are made read
+    only so that an in-place write to one member cannot leak to others.
+    '''
+
+    common_dir = ensemble_dir / COMMON_DIR
+    common_dir.mkdir(exist_ok=True)
+
+    if member_dirs is None:
+        member_dirs = _all_members(ensemble_dir)
+    # Files already hardlinked to the same inode are hashed once
+    inode_digest = {}
+    n_shared = 0
+    for member in member_dirs:
+        for pattern in patterns:
+            for path in member.glob(pattern):
+                if path.is_symlink() or not path.is_file():
+                    continue
+
+                stat = path.stat()
+                inode = (stat.st_dev, stat.st_ino)
+                if inode not in inode_digest:
+                    inode_digest[inode] = file_digest(path)
+                common_path = common_dir / inode_digest[inode]
+
+                if not common_path.exists():
+                    os.replace(path, common_path)
+                    common_path.chmod(0o444)
+                link_file(common_path, path)
+                n_shared += 1
+
+    logger.info(
+        f"Linked {n_shared} member inputs to"
+        f" {len(list(common_dir.iterdir()))} shared files"
+    )
+
+
+def verify_member_inputs(
+        ensemble_dir,
+        member_dirs=None,
+        expected=None,
+        patterns=SHARED_INPUTS,
+        ):
+    '''Check every member resolves to the same complete input set
+
+    The set of inputs `expected` in the runs is taken from the checked
+    runs if not specified; it's returned for checking other members.
+    '''
+
+    spinup_dir = ensemble_dir / 'spinup'
+    if member_dirs is None:
+        member_dirs = _all_members(ensemble_dir)
+    run_dirs = [member for member in member_dirs if member != spinup_dir]
+
+    def _inputs(member):
+        return {
+            str(path.relative_to(member))
+            for pattern in patterns
+            for path in member.glob(pattern)
+        }
+
+    # Runs share a layout, spinup only needs its own inputs
+    if expected is None:
+        expected = set().union(*map(_inputs, run_dirs))
+    errors = []
+    for member in member_dirs:
+        required = {'param.nml'} | _inputs(member)
+        if member != spinup_dir:
+            required |= expected
+        for fname in sorted(required):
+            # NOTE: `exists` follows links, so dangling ones fail too
+            if not (member / fname).exists():
+                errors.append(f'{member.name}/{fname}')
+
+    if len(errors) > 0:
+        raise FileNotFoundError(
+            f"Missing or unresolved member inputs: {', '.join(errors)}"
+        )
 
-    # Workardoun for hydrology param bug #34
+    return expected
 
-    schism_dirs = [ensemble_dir / 'spinup', *ensemble_dir.glob('runs/*')]
-    for pth in schism_dirs:
-        nm_list = f90nml.read(pth / 'param.nml')
-        nm_list['opt']['if_source'] = 1
-        nm_list.write(pth / 'param.nml', force=True)
+
+def _generate_member(
+        run_dir,
+        run_configuration,
+        run_kwargs,
+        param_patches,
+        wwm_kwargs=None,
+        ):
+    '''Write a single run directory and apply run level setup'''
+
+    write_run_directory(
+        directory=run_dir,
+        name=run_dir.name,
+        configuration=run_configuration,
+        **run_kwargs,
+    )
+    if wwm_kwargs is not None:
+        wwm.setup_wwm_run(run_dir, param_patches=param_patches, **wwm_kwargs)
+    elif len(param_patches) > 0:
+        patch_namelist(run_dir / 'param.nml', param_patches)
+
+    return run_dir
+
+
+def stream_ensemble_members(
+        workdir,
+        mesh_file,
+        param_patches=(),
+        use_wwm=False,
+        shared_inputs=False,
+        max_workers=None,
+        ):
+    '''Generate spinup and members manifest first, then members in a pool
+
+    Each member is appended to `members.ready` as soon as it's set up,
+    so that its solve can be submitted while later members are still
+    being generated; `members.done` is created once all are ready.
+    '''
+
+    workdir = workdir.resolve()
+    for fname in (MEMBERS_MANIFEST, MEMBERS_READY, MEMBERS_DONE):
+        (workdir / fname).unlink(missing_ok=True)
+
+    # NOTE: Mirrors what `generate_schism_configuration` does before
+    # writing spinup and run directories, including changing directory
+    starting_dir = Path.cwd()
+    os.chdir(workdir)
+    try:
+        configuration = SCHISMRunConfiguration.read_directory(workdir)
+        configuration.move_paths(workdir)
+
+        platform = configuration['modeldriver']['platform']
+        slurm_account = configuration['slurm']['account']
+        if slurm_account is None:
+            slurm_account = platform.value['slurm_account']
+        fgrid_path = configuration['schism']['fgrid_path']
+        common_kwargs = {
+            'local_fgrid_filename': workdir / fgrid_path.name,
+            'local_hgrid_filename': workdir / 'hgrid.gr3',
+            'relative_paths': True,
+            'overwrite': True,
+            'platform': platform,
+            'schism_processors': configuration['schism']['processors'],
+            'slurm_account': slurm_account,
+            'job_duration': configuration['slurm']['job_duration'],
+            'partition': configuration['slurm']['partition'],
+            'email_type': configuration['slurm']['email_type'],
+            'email_address': configuration['slurm']['email_address'],
+        }
+
+        spinup_dir = write_spinup_directory(
+            directory=workdir / 'spinup',
+            configuration=copy(configuration),
+            duration=configuration['schism']['tidal_spinup_duration'],
+            link_mesh=True,
+            **common_kwargs,
+        )
+        wwm_kwargs = None
+        if use_wwm:
+            wwm.write_wwm_grids(mesh_file, [workdir])
+            wwm.setup_wwm_run(
+                spinup_dir,
+                param_patches=param_patches,
+                grids_dir=workdir,
+                hotfile_out=True,
+            )
+            wwm_kwargs = {
+                'grids_dir': workdir,
+                'hotfile_from': spinup_dir / f'{wwm.HOTFILE_OUT}.nc',
+            }
+        elif len(param_patches) > 0:
+            patch_namelist(spinup_dir / 'param.nml', param_patches)
+        if shared_inputs:
+            share_member_inputs(workdir, [spinup_dir])
+            verify_member_inputs(workdir, [spinup_dir])
+
+        runs_dir = workdir / 'runs'
+        runs_dir.mkdir(exist_ok=True)
+        perturbations = configuration.perturb()
+        # Spinup can be submitted once the manifest exists
+        write_json_atomic(
+            workdir / MEMBERS_MANIFEST,
+            {'spinup': spinup_dir.name, 'runs': list(perturbations.keys())}
+        )
+
+        run_kwargs = {
+            **common_kwargs,
+            'phase': 'HOTSTART',
+            'link_mesh': configuration['schism']['use_original_mesh'],
+            'do_spinup': True,
+            'spinup_directory': spinup_dir,
+        }
+        expected = None
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            futures = [
+                executor.submit(
+                    _generate_member,
+                    runs_dir / run_name,
+                    run_configuration,
+                    run_kwargs,
+                    param_patches,
+                    wwm_kwargs,
+                )
+                for run_name, run_configuration in perturbations.items()
+            ]
+            for future in as_completed(futures):
+                run_dir = future.result()
+                if shared_inputs:
+                    share_member_inputs(workdir, [run_dir])
+                    expected = verify_member_inputs(
+                        workdir, [run_dir], expected
+                    )
+                with open(workdir / MEMBERS_READY, 'a') as fo:
+                    fo.write(f'{run_dir.name}\n')
+                logger.info(f'Member {run_dir.name} is ready')
+
+        (workdir / MEMBERS_DONE).touch()
+
+    finally:
+        os.chdir(starting_dir)
+
+
+def _prepend_unperturbed(track_path, unperturbed_csv):
+    '''Overwrite perturbed-segment-only file with the full track'''
+
+    # Fake BEST track here (in case it's not a real best)!
+    perturbed_csv = _to_best_fort22(_read_fort22(track_path)).to_csv(
+        index=False, header=False
+    )
+    with open(track_path, 'w') as fo:
+        fo.write(unperturbed_csv + perturbed_csv)
 
 
 def main(args):
@@ -153,24 +455,18 @@ def main(args):
             )
 
             # Read generated tracks and append to unpertubed section
+            unperturbed_csv = unperturbed.fort_22().to_csv(
+                index=False, header=False
+            )
 
             perturbed_tracks = glob.glob(str(workdir/'track_files'/'*.22'))
-            for pt in perturbed_tracks:
-                # Fake BEST track here (in case it's not a real best)!
-                perturbed_data = VortexTrack.from_file(pt).data
-                perturbed_data.advisory = 'BEST'
-                perturbed_data.forecast_hours = 0
-                perturbed = VortexTrack(
-                    perturbed_data,
-                    file_deck='b',
-                    advisories = ['BEST'],
-                )
-                full_track = pd.concat(
-                    (unperturbed.fort_22(), perturbed.fort_22()),
-                    ignore_index=True
-                )
-                # Overwrites the perturbed-segment-only file
-                full_track.to_csv(pt, index=False, header=False)
+            with ProcessPoolExecutor() as executor:
+                # Raise any exception from the workers
+                list(executor.map(
+                    _prepend_unperturbed,
+                    perturbed_tracks,
+                    [unperturbed_csv] * len(perturbed_tracks),
+                ))
 
     # NOTE: Point to the original.22 file so that it is used for
     # spinup too instead of spinup trying to download!
@@ -205,6 +501,21 @@ def main(args):
         directory=workdir, absolute=False, overwrite=False,
     )
 
+    # All param.nml edits are applied in a single read/write per run
+    param_patches = []
+    if with_hydrology:
+        param_patches.append(IF_SOURCE_PATCH)
+
+    if args.stream_members:
+        stream_ensemble_members(
+            workdir,
+            mesh_file,
+            param_patches=param_patches,
+            use_wwm=use_wwm,
+            shared_inputs=args.shared_inputs,
+        )
+        return
+
     # Now generate the setup
     generate_schism_configuration(**{
         'configuration_directory': workdir,
@@ -214,10 +525,21 @@ def main(args):
         'parallel': True
     })
 
-    if with_hydrology:
-        _fix_nwm_issue(workdir)
     if use_wwm:
-        wwm.setup_wwm(mesh_file, workdir, ensemble=True)
+        # NOTE: Spinup is also patched since it writes WWM hotfile
+        wwm.setup_wwm(
+            mesh_file, workdir, ensemble=True, param_patches=param_patches
+        )
+    elif len(param_patches) > 0:
+        patch_namelists(
+            [workdir / 'spinup' / 'param.nml',
+             *workdir.glob('runs/*/param.nml')],
+            param_patches
+        )
+
+    if args.shared_inputs:
+        share_member_inputs(workdir)
+        verify_member_inputs(workdir)
 
 
 def parse_arguments():
@@ -281,6 +603,16 @@ def parse_arguments():
     argument_parser.add_argument(
         "--with-hydrology", action="store_true"
     )
+    argument_parser.add_argument(
+        "--shared-inputs",
+        action="store_true",
+        help="link identical static member inputs to ensemble `common/`",
+    )
+    argument_parser.add_argument(
+        "--stream-members",
+        action="store_true",
+        help="generate spinup first and mark members ready one by one",
+    )
 
     argument_parser.add_argument(
         "name", help="name of the storm", type=str)
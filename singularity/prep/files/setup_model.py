@@ -7,14 +7,16 @@ import argparse
 import shutil
 import hashlib
 import fcntl
-from time import time
+import json
+from time import time, sleep
 import tempfile
 from contextlib import contextmanager, ExitStack
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 import numpy as np
 import pandas as pd
 import geopandas as gpd
-import f90nml
+import xarray
 from matplotlib.transforms import Bbox
 
 from pyschism import dates
@@ -29,6 +31,8 @@ from pyschism.mesh.fgrid import ManningsN
 from pyschism.stations import Stations
 
 import wwm
+from fileio import file_digest, link_file, reflink, write_json_atomic
+from namelist import IF_SOURCE_PATCH, patch_namelist
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
@@ -36,6 +40,9 @@ logger.setLevel(logging.INFO)
 CDSAPI_URL = "https://cds.climate.copernicus.eu/api/v2"
 TPXO_LINK_PATH = pathlib.Path('~').expanduser() / '.local/share/tpxo'
 NWM_LINK_PATH = pathlib.Path('~').expanduser() / '.local/share/pyschism/nwm'
+METEO_MANIFEST = 'manifest.json'
+METEO_INDEX = 'meteo_index.json'
+CACHE_MANIFEST = 'cache_manifest.json'
 
 
 @contextmanager
@@ -90,21 +97,79 @@ def cache_lock(cache_path):
         finally:
             fcntl.flock(fp.fileno(), fcntl.LOCK_UN)
 
+def get_cache_objects_path(meteo_cache_path):
+
+    # Content-addressed storage shared by all meteo caches of a storm
+    return meteo_cache_path.parent / 'objects'
+
+
+def _store_cache_object(path, objects_path):
+
+    digest = file_digest(path)
+    obj_path = objects_path / digest[:2] / digest
+    if obj_path.exists():
+        return digest
+
+    obj_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = obj_path.with_name(f'.{digest}.{os.getpid()}.tmp')
+    # NOTE: Never hardlinked, the object must not share the inode of
+    # the run file which may still be modified
+    try:
+        reflink(path, tmp)
+    except OSError:
+        shutil.copy(path, tmp)
+    # Cached objects are immutable
+    os.chmod(tmp, 0o444)
+    os.replace(tmp, obj_path)
+
+    return digest
+
+
 def from_meteo_cache(meteo_cache_path, sflux_dir):
 
-    # TODO: Generalize
     # Redundant check
     if not meteo_cache_path.exists():
         return False
 
+    manifest_path = meteo_cache_path / METEO_MANIFEST
+    if not manifest_path.is_file():
+        # Caches from before content-addressing, or incomplete ones
+        return from_legacy_meteo_cache(meteo_cache_path, sflux_dir)
+
+    logger.info("Creating sflux from cache...")
+
+    with open(manifest_path) as fp:
+        manifest = json.load(fp)
+
+    objects_path = get_cache_objects_path(meteo_cache_path)
+    for relpath, digest in manifest['files'].items():
+        dest = sflux_dir / relpath
+        dest.parent.mkdir(parents=True, exist_ok=True)
+        link_file(objects_path / digest[:2] / digest, dest)
+
+    for relpath, target in manifest['links'].items():
+        dest = sflux_dir / relpath
+        if dest.is_symlink() or dest.exists():
+            os.remove(dest)
+        os.symlink(target, dest)
+
+    logger.info("Done linking cached sflux.")
+
+    return True
+
+
+def from_legacy_meteo_cache(meteo_cache_path, sflux_dir):
+
     contents = list(meteo_cache_path.iterdir())
     if not any(p.match("sflux_inputs.txt") for p in contents):
         return False
 
-    logger.info("Creating sflux from cache...")
+    logger.info("Creating sflux from legacy cache...")
 
     # Copy files from cache dir to sflux dir
     for p in contents:
+        if p.suffix == ".lock":
+            continue
         dest = sflux_dir / p.relative_to(meteo_cache_path)
         if p.is_dir():
             shutil.copytree(p, dest)
@@ -118,11 +183,9 @@ def from_meteo_cache(meteo_cache_path, sflux_dir):
 
 def copy_meteo_cache(sflux_dir, meteo_cache_path):
 
-    # TODO: Generalize
-    logger.info("Copying cache files to main cache location...")
-    # Copy files from sflux dir to cache dir
+    logger.info("Storing sflux files in main cache location...")
 
-    # Clean meteo_cache_path if already populated?
+    # Clean meteo_cache_path if already populated (e.g. legacy cache)
     contents_dst = list(meteo_cache_path.iterdir())
     contents_dst = [p for p in contents_dst if p.suffix != ".lock"]
     for p in contents_dst:
@@ -131,16 +194,546 @@ def copy_meteo_cache(sflux_dir, meteo_cache_path):
         else:
             os.remove(p)
 
-    # Copy files from cache dir to sflux dir
-    contents_src = list(sflux_dir.iterdir())
-    for p in contents_src:
-        dest = meteo_cache_path / p.relative_to(sflux_dir)
-        if p.is_dir():
-            shutil.copytree(p, dest)
+    # Files are added to the object store (reflinked if possible)
+    # and recorded by their content hash
+    objects_path = get_cache_objects_path(meteo_cache_path)
+    manifest = {'files': {}, 'links': {}}
+    for p in sorted(sflux_dir.rglob('*')):
+        relpath = str(p.relative_to(sflux_dir))
+        if p.is_symlink():
+            manifest['links'][relpath] = os.readlink(p)
+        elif p.is_file():
+            manifest['files'][relpath] = _store_cache_object(
+                p, objects_path
+            )
+
+    # Writing the manifest marks the cache entry as complete
+    write_json_atomic(meteo_cache_path / METEO_MANIFEST, manifest)
+
+    logger.info("Done storing sflux files in main cache location.")
+
+def _read_meteo_index(main_cache_path):
+
+    index_path = main_cache_path / METEO_INDEX
+    if not index_path.is_file():
+        return []
+
+    with open(index_path) as fp:
+        return json.load(fp)
+
+
+def add_to_meteo_index(source, meteo_cache_path, bbox, start_date, end_date):
+
+    main_cache_path = meteo_cache_path.parent
+    with cache_lock(main_cache_path):
+        index = [
+            entry for entry in _read_meteo_index(main_cache_path)
+            if entry['name'] != meteo_cache_path.name
+        ]
+        index.append({
+            'name': meteo_cache_path.name,
+            'source': source,
+            'bbox': [bbox.xmin, bbox.ymin, bbox.xmax, bbox.ymax],
+            'start_date': start_date.isoformat(),
+            'end_date': end_date.isoformat(),
+        })
+        write_json_atomic(main_cache_path / METEO_INDEX, index)
+
+
+def find_meteo_cache(source, main_cache_path, bbox, start_date, end_date):
+    '''Find the cached meteo entry that best covers the request
+
+    Only entries whose domain box contains `bbox` and whose date
+    range overlaps the requested one are considered. The entry with
+    the least uncovered time is returned.
+
+    Returns
+    -------
+    tuple
+        path to the cache entry (or `None`) and the list of
+        `(start, end)` date ranges missing from it
+    '''
+
+    tol = 0.01
+    best_path = None
+    best_missing = None
+    for entry in _read_meteo_index(main_cache_path):
+        if entry['source'] != source:
+            continue
+
+        entry_path = main_cache_path / entry['name']
+        if not (entry_path / METEO_MANIFEST).is_file():
+            continue
+
+        xmin, ymin, xmax, ymax = entry['bbox']
+        if not (xmin - tol <= bbox.xmin and ymin - tol <= bbox.ymin
+                and xmax + tol >= bbox.xmax and ymax + tol >= bbox.ymax):
+            continue
+
+        entry_start = datetime.fromisoformat(entry['start_date'])
+        entry_end = datetime.fromisoformat(entry['end_date'])
+        if entry_end <= start_date or entry_start >= end_date:
+            continue
+
+        missing = []
+        if entry_start > start_date:
+            missing.append((start_date, entry_start))
+        if entry_end < end_date:
+            missing.append((entry_end, end_date))
+
+        uncovered = sum((e - s for s, e in missing), timedelta())
+        if best_missing is None or uncovered < sum(
+                (e - s for s, e in best_missing), timedelta()):
+            best_path = entry_path
+            best_missing = missing
+
+    return best_path, best_missing
+
+
+def get_cached_entry_bbox(meteo_cache_path):
+
+    for entry in _read_meteo_index(meteo_cache_path.parent):
+        if entry['name'] == meteo_cache_path.name:
+            return Bbox(np.reshape(entry['bbox'], (2, 2)))
+
+
+def subset_sflux(src_dirs, sflux_dir, bbox, start_date, end_date):
+    '''Subset sflux files of one or more directories in time and space
+
+    Directories must be passed in chronological order. Records that
+    overlap the ones already written (e.g. at the boundary of a cached
+    and a newly fetched time slice) are dropped and the output files
+    of each sflux stream are renumbered consecutively.
+    '''
+
+    # Keep an extra meteo cycle on each side for time interpolation
+    pad = timedelta(hours=6)
+    t_lo = np.datetime64(start_date - pad)
+    t_hi = np.datetime64(end_date + pad)
+
+    last_time = {}
+    file_count = {}
+    for src_dir in src_dirs:
+        for path in sorted(src_dir.glob('sflux_*.nc')):
+            # e.g. sflux_air_1.0001.nc
+            stream = path.name.split('.')[0]
+            with xarray.open_dataset(path) as ds:
+                times = ds.time.values
+                in_time = (times >= t_lo) & (times <= t_hi)
+                if stream in last_time:
+                    in_time &= times > last_time[stream]
+                if not in_time.any():
+                    continue
+
+                # Keep one extra grid cell around the box
+                y_dim, x_dim = ds.lon.dims
+                lon = ds.lon.values
+                lat = ds.lat.values
+                in_box = (
+                    (lon >= bbox.xmin) & (lon <= bbox.xmax)
+                    & (lat >= bbox.ymin) & (lat <= bbox.ymax)
+                )
+                rows = np.flatnonzero(in_box.any(axis=1))
+                cols = np.flatnonzero(in_box.any(axis=0))
+                space_slices = {}
+                if len(rows) > 0 and len(cols) > 0:
+                    space_slices = {
+                        y_dim: slice(max(rows[0] - 1, 0), rows[-1] + 2),
+                        x_dim: slice(max(cols[0] - 1, 0), cols[-1] + 2),
+                    }
+
+                ds_sub = ds.isel(time=np.flatnonzero(in_time), **space_slices)
+                file_count[stream] = file_count.get(stream, 0) + 1
+                ds_sub.to_netcdf(
+                    sflux_dir / f'{stream}.{file_count[stream]:04d}.nc'
+                )
+                last_time[stream] = times[in_time][-1]
+
+
+def _read_cache_manifest(cache_dir):
+
+    manifest_path = cache_dir / CACHE_MANIFEST
+    if not manifest_path.is_file():
+        return {'entries': {}, 'deleted': []}
+
+    with open(manifest_path) as fp:
+        return json.load(fp)
+
+
+def _write_cache_manifest(cache_dir, manifest):
+
+    write_json_atomic(cache_dir / CACHE_MANIFEST, manifest)
+
+
+def _remove_from_meteo_index(meteo_cache_path):
+
+    main_cache_path = meteo_cache_path.parent
+    if not (main_cache_path / METEO_INDEX).is_file():
+        # E.g. derived inputs, which aren't indexed
+        return
+
+    with cache_lock(main_cache_path):
+        index = [
+            entry for entry in _read_meteo_index(main_cache_path)
+            if entry['name'] != meteo_cache_path.name
+        ]
+        write_json_atomic(main_cache_path / METEO_INDEX, index)
+
+
+def record_cache_access(cache_entry_path):
+    '''Record access time and files of a cache entry
+
+    The cache manifest at the root of the cache directory (parent of
+    the storm and derived cache directories) keeps, for each entry,
+    the files relative to the root, the last access time and whether
+    it's been synced to S3.
+    '''
+
+    entry_manifest_path = cache_entry_path / METEO_MANIFEST
+    if entry_manifest_path.is_file():
+        with open(entry_manifest_path) as fp:
+            digests = set(json.load(fp)['files'].values())
+        objects_path = get_cache_objects_path(cache_entry_path)
+        files = [entry_manifest_path] + [
+            objects_path / digest[:2] / digest for digest in sorted(digests)
+        ]
+    else:
+        # E.g. derived inputs or legacy meteo entries
+        files = sorted(
+            p for p in cache_entry_path.iterdir()
+            if p.is_file() and not p.name.startswith('.')
+        )
+    if len(files) == 0:
+        return
+
+    cache_dir = cache_entry_path.parent.parent
+    key = str(cache_entry_path.relative_to(cache_dir))
+    files = [str(p.relative_to(cache_dir)) for p in files]
+    with cache_lock(cache_dir):
+        manifest = _read_cache_manifest(cache_dir)
+        entry = manifest['entries'].get(key)
+        if entry is None or entry['files'] != files:
+            entry = {'files': files, 'synced': False}
+        entry['last_access'] = time()
+        manifest['entries'][key] = entry
+        _write_cache_manifest(cache_dir, manifest)
+
+
+def _cache_usage(cache_dir):
+
+    # Hardlinked files are only counted once
+    inodes = {}
+    for root, _, files in os.walk(cache_dir):
+        for name in files:
+            st = os.lstat(os.path.join(root, name))
+            inodes[(st.st_dev, st.st_ino)] = st.st_size
+    return sum(inodes.values())
+
+
+def evict_cache(cache_dir, max_size, keep=()):
+    '''Evict least recently used cache entries to fit in `max_size`
+
+    Parameters
+    ----------
+    cache_dir: pathlike
+        root of the cache, i.e. parent of storm cache directories
+    max_size: int
+        size budget in bytes
+    keep: iterable of pathlike
+        cache entries that must not be evicted (e.g. in use)
+
+    Returns
+    -------
+    list
+        evicted cache entries relative to `cache_dir`
+    '''
+
+    keep = {str(pathlib.Path(p).relative_to(cache_dir)) for p in keep}
+    evicted = []
+    with cache_lock(cache_dir):
+        usage = _cache_usage(cache_dir)
+        if usage <= max_size:
+            return evicted
+
+        manifest = _read_cache_manifest(cache_dir)
+        by_access = sorted(
+            manifest['entries'].items(), key=lambda i: i[1]['last_access']
+        )
+        for key, entry in by_access:
+            if usage <= max_size:
+                break
+            if key in keep:
+                continue
+
+            logger.info(f"Evicting cache entry {key}...")
+            del manifest['entries'][key]
+            referenced = {
+                f for e in manifest['entries'].values() for f in e['files']
+            }
+
+            # Keep the entry lock file for any process waiting on it
+            entry_path = cache_dir / key
+            with cache_lock(entry_path):
+                for relpath in entry['files']:
+                    if relpath in referenced:
+                        continue
+                    path = cache_dir / relpath
+                    if path.is_file():
+                        usage -= path.stat().st_size
+                        os.remove(path)
+                    if entry['synced']:
+                        manifest['deleted'].append(relpath)
+            _remove_from_meteo_index(entry_path)
+            evicted.append(key)
+
+        _write_cache_manifest(cache_dir, manifest)
+
+    return evicted
+
+
+def get_derived_cache_path(cache_dir, mesh_path, **params):
+
+    m = hashlib.sha256()
+    m.update(file_digest(mesh_path).encode('utf8'))
+    m.update(json.dumps(params, sort_keys=True).encode('utf8'))
+
+    return cache_dir / 'derived' / f"mesh_{m.hexdigest()}"
+
+
+def from_derived_cache(derived_cache_path, schism_dir, fnames):
+    '''Link cached mesh derived inputs, return the missing ones'''
+
+    missing = []
+    for fname in fnames:
+        cached = derived_cache_path / fname
+        if cached.is_file():
+            link_file(cached, schism_dir / fname)
         else:
-            shutil.copy(p, dest)
+            missing.append(fname)
+
+    return missing
+
+
+def copy_derived_cache(schism_dir, derived_cache_path, fnames):
+
+    for fname in fnames:
+        dest = derived_cache_path / fname
+        tmp = dest.with_name(f'.{fname}.{os.getpid()}.tmp')
+        # NOTE: Not hardlinked, same as meteo objects
+        try:
+            reflink(schism_dir / fname, tmp)
+        except OSError:
+            shutil.copy(schism_dir / fname, tmp)
+        # Cached files are immutable
+        os.chmod(tmp, 0o444)
+        os.replace(tmp, dest)
+
+
+def _write_era5_chunk(
+        chunk_dir,
+        start_date,
+        end_date,
+        bbox,
+        main_cache_path=None,
+        retries=3,
+        replay_dir=None,
+        ):
+
+    chunk_name = f'{start_date:%Y%m%d%H}_{end_date:%Y%m%d%H}'
+    if replay_dir is not None:
+        # Offline mode, e.g. for testing without CDS access
+        replay_chunk_dir = replay_dir / chunk_name
+        if not replay_chunk_dir.is_dir():
+            raise FileNotFoundError(
+                f"ERA5 chunk {chunk_name} not found in {replay_dir}!"
+            )
+        for p in replay_chunk_dir.glob('sflux_*.nc'):
+            link_file(p, chunk_dir / p.name)
+        return None
+
+    chunk_cache_path = None
+    with ExitStack() as stack:
+        if main_cache_path is not None:
+            chunk_cache_path = get_meteo_cache_path(
+                'era5_chunk', main_cache_path, bbox, start_date, end_date
+            )
+            stack.enter_context(cache_lock(chunk_cache_path))
+            if from_meteo_cache(chunk_cache_path, chunk_dir):
+                return chunk_cache_path
+
+        for attempt in range(1, retries + 1):
+            try:
+                era5 = ERA5()
+                era5.write(
+                        outdir=chunk_dir,
+                        start_date=start_date,
+                        rnday=(end_date - start_date).total_seconds() / timedelta(days=1).total_seconds(),
+                        air=True, rad=True, prc=True,
+                        bbox=bbox,
+                        overwrite=True)
+                break
+
+            except Exception as e:
+                if attempt == retries:
+                    raise
+                logger.warning(
+                    f"ERA5 chunk {chunk_name} failed on attempt {attempt}: {e}"
+                )
+                # Start over from an empty chunk directory
+                shutil.rmtree(chunk_dir)
+                chunk_dir.mkdir()
+                sleep(60 * attempt)
+
+        if chunk_cache_path is not None:
+            copy_meteo_cache(chunk_dir, chunk_cache_path)
+
+    return chunk_cache_path
+
+
+def _daily_edges(start_date, end_date):
+    '''Chunk edges from `start_date` to `end_date` at each midnight
+
+    Edges are anchored at midnight rather than at the start hour so
+    that overlapping requests share (cached) chunks.
+    '''
+
+    midnights = pd.date_range(
+        pd.Timestamp(start_date).normalize() + pd.Timedelta(days=1),
+        end_date,
+        freq='D',
+    ).to_pydatetime()
+
+    return [start_date, *(t for t in midnights if t < end_date), end_date]
+
+
+def write_era5(
+        outdir,
+        start_date,
+        end_date,
+        bbox,
+        main_cache_path=None,
+        max_workers=4,
+        retries=3,
+        replay_dir=None,
+        ):
+    '''Download ERA5 sflux in daily chunks concurrently
+
+    Large CDS requests queue for a long time and fail all at once, so
+    the request is split into daily chunks fetched by a bounded pool
+    of worker processes, each retried separately. If `main_cache_path`
+    is provided each chunk is also stored in the meteo cache. If
+    `replay_dir` is provided chunks are read from its
+    `<start>_<end>` (`%Y%m%d%H`) subdirectories instead of CDS.
+
+    Returns
+    -------
+    list
+        meteo cache paths of the chunks used
+    '''
+
+    edges = _daily_edges(start_date, end_date)
+
+    with ExitStack() as stack:
+        # On the same filesystem as output for cheap merging
+        tempdir = pathlib.Path(stack.enter_context(
+            tempfile.TemporaryDirectory(dir=outdir.parent)
+        ))
+        executor = stack.enter_context(
+            ProcessPoolExecutor(max_workers=max_workers)
+        )
+
+        futures = []
+        chunk_dirs = []
+        for i, (chunk_start, chunk_end) in enumerate(zip(edges[:-1], edges[1:])):
+            chunk_dir = tempdir / f'era5_{i:03d}'
+            chunk_dir.mkdir()
+            chunk_dirs.append(chunk_dir)
+            futures.append(executor.submit(
+                _write_era5_chunk,
+                chunk_dir, chunk_start, chunk_end, bbox,
+                main_cache_path=main_cache_path,
+                retries=retries,
+                replay_dir=replay_dir,
+            ))
+
+        chunk_cache_paths = [future.result() for future in futures]
+
+        subset_sflux(chunk_dirs, outdir, bbox, start_date, end_date)
+
+    return [p for p in chunk_cache_paths if p is not None]
+
+
+def _write_sflux_chunk(source, outdir, level, start_date, end_date, bbox):
+
+    # Just to make sure there are not permission issues for temporary
+    # data (e.g. HRRR tmpdir in current dir) and that workers don't
+    # share it
+    with ExitStack() as stack:
+        tempdir = stack.enter_context(tempfile.TemporaryDirectory())
+        stack.enter_context(pushd(tempdir))
+
+        nws = {'gfs': GFS, 'hrrr': HRRR}[source]()
+        nws.write(
+                outdir=outdir,
+                level=level,
+                start_date=start_date,
+                rnday=(end_date - start_date).total_seconds() / timedelta(days=1).total_seconds(),
+                air=True, rad=True, prc=True,
+                bbox=bbox,
+                overwrite=True
+            )
+
+
+def write_gfs_hrrr(sflux_dir, start_date, end_date, last_cycle, bbox, max_workers=4):
+    '''Concurrently download GFS (level 1) and HRRR (level 2) sflux
+
+    Each source's window is split into daily chunks up to the day of
+    the last meteo cycle, plus a single chunk from that day to the end
+    which holds the forecast. All chunks of both sources are written
+    to separate directories by a bounded pool of worker processes and
+    then merged into `sflux_dir`.
+    '''
+
+    last_day = last_cycle.replace(hour=0)
+    edges = list(pd.date_range(start_date, last_day, freq='D').to_pydatetime())
+    if edges[-1] != last_day:
+        edges.append(last_day)
+    edges.append(end_date)
+
+    # If we should limit forecast to 2 days, then why not use old HRRR
+    # implementation? Because we have prior day, today and 1 day
+    # forecast (?) BUT the new implementation has issues getting 2day
+    # forecast!
+    sources = [('gfs', 1), ('hrrr', 2)]
+
+    with ExitStack() as stack:
+        # On the same filesystem as sflux for cheap merging
+        tempdir = pathlib.Path(stack.enter_context(
+            tempfile.TemporaryDirectory(dir=sflux_dir.parent)
+        ))
+        executor = stack.enter_context(
+            ProcessPoolExecutor(max_workers=max_workers)
+        )
+
+        futures = []
+        chunk_dirs = []
+        for source, level in sources:
+            for i, (chunk_start, chunk_end) in enumerate(zip(edges[:-1], edges[1:])):
+                chunk_dir = tempdir / f'{source}_{i:03d}'
+                chunk_dir.mkdir()
+                chunk_dirs.append(chunk_dir)
+                futures.append(executor.submit(
+                    _write_sflux_chunk,
+                    source, chunk_dir, level, chunk_start, chunk_end, bbox
+                ))
+
+        for future in as_completed(futures):
+            # Raise any download error
+            future.result()
+
+        # Chunk directories are in chronological order for each source
+        subset_sflux(chunk_dirs, sflux_dir, bbox, start_date, end_date)
 
-    logger.info("Done copying cache files to main cache location.")
 
 def setup_schism_model(
         mesh_path,
@@ -153,6 +746,9 @@ def setup_schism_model(
         nhc_track_file=None,
         storm_id=None,
         use_wwm=False,
+        cache_max_size=None,
+        era5_workers=4,
+        era5_replay_dir=None,
         ):
 
 
@@ -210,11 +806,12 @@ def setup_schism_model(
 
     dramp = timedelta(days=1.)
 
+    manning_params = {
+        'min_value': 0.02, 'max_value': 0.05,
+        'min_depth': -1.0, 'max_depth': -3.0,
+    }
     hgrid = Hgrid.open(mesh_path, crs="epsg:4326")
-    fgrid = ManningsN.linear_with_depth(
-        hgrid,
-        min_value=0.02, max_value=0.05,
-        min_depth=-1.0, max_depth=-3.0)
+    fgrid = ManningsN.linear_with_depth(hgrid, **manning_params)
 
     coops_stations = None
     stations_file = station_info_path
@@ -272,6 +869,7 @@ def setup_schism_model(
     )
 
     logger.info("Writing to disk ...")
+    accessed_cache_paths = []
     if not parametric_wind:
 
         # In hindcast mode ERA5 is used manually: temporary solution
@@ -286,89 +884,88 @@ def setup_schism_model(
                 'end_date': start_date + rnday
         }
 
-        if hindcast_mode:
-            meteo_cache_path = get_meteo_cache_path(
-                'era5', main_cache_path, **meteo_cache_kwargs
-            )
-        else:
-            meteo_cache_path = get_meteo_cache_path(
-                'gfs_hrrr', main_cache_path, **meteo_cache_kwargs
-            )
+        meteo_source = 'era5' if hindcast_mode else 'gfs_hrrr'
+        meteo_cache_path = get_meteo_cache_path(
+            meteo_source, main_cache_path, **meteo_cache_kwargs
+        )
 
+        era5_kwargs = {
+                'main_cache_path': main_cache_path,
+                'max_workers': era5_workers,
+                'replay_dir': era5_replay_dir,
+        }
+
+        accessed_cache_paths.append(meteo_cache_path)
         with cache_lock(meteo_cache_path):
             if not from_meteo_cache(meteo_cache_path, sflux_dir):
-                if hindcast_mode:
-                    era5 = ERA5()
-                    era5.write(
-                            outdir=schism_dir / "sflux",
-                            start_date=start_date,
-                            rnday=rnday.total_seconds() / timedelta(days=1).total_seconds(),
-                            air=True, rad=True, prc=True,
-                            bbox=atm_bbox,
-                            overwrite=True)
-
-                else:
-
-
+                covering_path, missing = find_meteo_cache(
+                    meteo_source, main_cache_path, **meteo_cache_kwargs
+                )
+                # NOTE: Only ERA5 is fetched for missing time slices,
+                # GFS/HRRR data depend on the forecast cycles of setup
+                if covering_path is not None and (hindcast_mode or not missing):
+                    logger.info(
+                        f"Subsetting sflux from cache {covering_path.name}..."
+                    )
+                    accessed_cache_paths.append(covering_path)
                     with ExitStack() as stack:
-
-                        # Just to make sure there are not permission
-                        # issues for temporary data (e.g. HRRR tmpdir
-                        # in current dir)
-                        tempdir = stack.enter_context(tempfile.TemporaryDirectory())
-                        stack.enter_context(pushd(tempdir))
-
-                        gfs = GFS()
-                        gfs.write(
-                                outdir=schism_dir / "sflux",
-                                level=1,
-                                start_date=start_date,
-                                rnday=rnday.total_seconds() / timedelta(days=1).total_seconds(),
-                                air=True, rad=True, prc=True,
-                                bbox=atm_bbox,
-                                overwrite=True
+                        # On the same filesystem to allow hardlinks
+                        tempdir = pathlib.Path(stack.enter_context(
+                            tempfile.TemporaryDirectory(dir=schism_dir)
+                        ))
+                        cached_dir = tempdir / 'cached'
+                        cached_dir.mkdir()
+                        with cache_lock(covering_path):
+                            from_meteo_cache(covering_path, cached_dir)
+
+                        # Cached data start after the missing head slice
+                        cached_start = start_date
+                        if missing and missing[0][0] == start_date:
+                            cached_start = missing[0][1]
+                        src_dirs = [(cached_start, cached_dir)]
+
+                        covering_bbox = get_cached_entry_bbox(covering_path)
+                        for i, (miss_start, miss_end) in enumerate(missing):
+                            # Fetch on the cached grid for consistency
+                            logger.info(
+                                f"Fetching missing ERA5 {miss_start} to {miss_end}..."
                             )
-
-                        # If we should limit forecast to 2 days, then
-                        # why not use old HRRR implementation? Because
-                        # We have prior day, today and 1 day forecast (?)
-                        # BUT the new implementation has issues getting
-                        # 2day forecast!
-                        hrrr = HRRR()
-                        hrrr.write(
-                                outdir=schism_dir / "sflux",
-                                level=2,
-                                start_date=start_date,
-                                rnday=rnday.total_seconds() / timedelta(days=1).total_seconds(),
-                                air=True, rad=True, prc=True,
-                                bbox=atm_bbox,
-                                overwrite=True
+                            miss_dir = tempdir / f'missing_{i}'
+                            miss_dir.mkdir()
+                            accessed_cache_paths.extend(write_era5(
+                                miss_dir, miss_start, miss_end, covering_bbox,
+                                **era5_kwargs
+                            ))
+                            src_dirs.append((miss_start, miss_dir))
+
+                        subset_sflux(
+                            [d for _, d in sorted(src_dirs, key=lambda i: i[0])],
+                            sflux_dir, atm_bbox,
+                            start_date, start_date + rnday
                         )
 
-#                        hrrr3.HRRR(
-#                            start_date=start_date,
-#                            rnday=rnday.total_seconds() / timedelta(days=1).total_seconds(),
-#                            record=2,
-#                            bbox=atm_bbox
-#                        )
-#                        for i, nc_file  in enumerate(sorted(pathlib.Path().glob('*/*.nc'))):
-#                            dst_air = schism_dir / "sflux" / f"sflux_air_2.{i:04d}.nc"
-#                            shutil.move(nc_file, dst_air)
-#                            pathlib.Path(schism_dir / "sflux" / f"sflux_prc_2.{i:04d}.nc").symlink_to(
-#                                dst_air
-#                            )
-#                            pathlib.Path(schism_dir / "sflux" / f"sflux_rad_2.{i:04d}.nc").symlink_to(
-#                                dst_air
-#                            )
-
-                    
+                elif hindcast_mode:
+                    accessed_cache_paths.extend(write_era5(
+                        sflux_dir, start_date, start_date + rnday, atm_bbox,
+                        **era5_kwargs
+                    ))
+
+                else:
+                    write_gfs_hrrr(
+                        sflux_dir, start_date, start_date + rnday,
+                        last_meteo_cycle, atm_bbox
+                    )
+
                 with open(schism_dir / "sflux" / "sflux_inputs.txt", "w") as f:
                     f.write("&sflux_inputs\n/\n")
 
                 copy_meteo_cache(sflux_dir, meteo_cache_path)
+                add_to_meteo_index(
+                    meteo_source, meteo_cache_path, **meteo_cache_kwargs
+                )
 
-        windrot = gridgr3.Windrot.default(hgrid)
-        windrot.write(schism_dir / "windrot_geo2proj.gr3", overwrite=True)
+        # NOTE: windrot_geo2proj.gr3 is written with other mesh
+        # derived inputs
         ## end of workaround
 
         # Workaround for bug #30
@@ -384,21 +981,60 @@ def setup_schism_model(
                 round(nspool.total_seconds() / coldstart.param.core.dt))
     ## end of workaround
 
-    with ExitStack() as stack:
+    # Inputs derived only from the mesh are shared by all the runs
+    # using the same mesh
+    derived_cache_path = get_derived_cache_path(
+        main_cache_path.parent, mesh_path,
+        crs="epsg:4326", manning=manning_params, windrot='default'
+    )
+    derived_inputs = ['hgrid.gr3', fgrid.fname]
+    if not parametric_wind:
+        derived_inputs.append('windrot_geo2proj.gr3')
+    accessed_cache_paths.append(derived_cache_path)
 
-        # Just to make sure there are not permission
-        # issues for temporary data (e.g. HRRR tmpdir
-        # in current dir)
-        tempdir = stack.enter_context(tempfile.TemporaryDirectory())
-        stack.enter_context(pushd(tempdir))
+    with cache_lock(derived_cache_path):
+        missing = from_derived_cache(
+            derived_cache_path, schism_dir, derived_inputs
+        )
 
-        coldstart.write(schism_dir, overwrite=True)
+        with ExitStack() as stack:
 
-    # Workardoun for hydrology param bug #34
-    nm_list = f90nml.read(schism_dir / 'param.nml')
-    nm_list['opt']['if_source'] = 1
-    nm_list.write(schism_dir / 'param.nml', force=True)
-    ## end of workaround
+            # Just to make sure there are not permission
+            # issues for temporary data (e.g. HRRR tmpdir
+            # in current dir)
+            tempdir = stack.enter_context(tempfile.TemporaryDirectory())
+            stack.enter_context(pushd(tempdir))
+
+            coldstart.write(
+                schism_dir, overwrite=True,
+                hgrid='hgrid.gr3' in missing,
+                fgrid=fgrid.fname in missing,
+            )
+
+        if 'windrot_geo2proj.gr3' in missing:
+            windrot = gridgr3.Windrot.default(hgrid)
+            windrot.write(schism_dir / "windrot_geo2proj.gr3", overwrite=True)
+
+        copy_derived_cache(schism_dir, derived_cache_path, missing)
+
+    if 'hgrid.gr3' not in missing and coldstart.param.opt.ics == 2:
+        # Same as what pyschism does when writing hgrid
+        hgrid_ll = schism_dir / 'hgrid.ll'
+        if hgrid_ll.is_symlink() or hgrid_ll.exists():
+            os.remove(hgrid_ll)
+        os.symlink('hgrid.gr3', hgrid_ll)
+
+    # NOTE: Outside of the entry locks to avoid deadlock with eviction
+    for cache_path in accessed_cache_paths:
+        record_cache_access(cache_path)
+    if cache_max_size is not None:
+        evict_cache(
+            main_cache_path.parent,
+            int(cache_max_size * 2**30),
+            keep=accessed_cache_paths
+        )
+
+    param_patches = [IF_SOURCE_PATCH]
 
     ## Workaround to make sure outputs directory is copied from/to S3
     try:
@@ -407,8 +1043,13 @@ def setup_schism_model(
         pass
     ## end of workaround
 
+    # All param.nml edits are applied in a single read/write
     if use_wwm:
-        wwm.setup_wwm(mesh_path, schism_dir, ensemble=False)
+        wwm.setup_wwm(
+            mesh_path, schism_dir, ensemble=False, param_patches=param_patches
+        )
+    else:
+        patch_namelist(schism_dir / 'param.nml', param_patches)
 
     logger.info("Setup done")
 
@@ -430,6 +1071,9 @@ def main(args):
     tpxo_dir = args.tpxo_dir
     nwm_dir = args.nwm_dir
     use_wwm = args.use_wwm
+    cache_max_size = args.cache_max_size
+    era5_workers = args.era5_workers
+    era5_replay_dir = args.era5_replay_dir
 
     if TPXO_LINK_PATH.is_dir():
         shutil.rmtree(TPXO_LINK_PATH)
@@ -449,7 +1093,10 @@ def main(args):
         parametric_wind=param_wind,
         nhc_track_file=nhc_track,
         storm_id=f'{storm_name}{storm_year}',
-        use_wwm=use_wwm
+        use_wwm=use_wwm,
+        cache_max_size=cache_max_size,
+        era5_workers=era5_workers,
+        era5_replay_dir=era5_replay_dir,
         )
 
 
@@ -492,6 +1139,25 @@ if __name__ == '__main__':
         type=pathlib.Path
     )
 
+    parser.add_argument(
+        "--cache-max-size",
+        help="size budget of the cache directory in GiB (no eviction if not set)",
+        type=float
+    )
+
+    parser.add_argument(
+        "--era5-workers",
+        help="number of concurrent ERA5 daily chunk requests",
+        type=int,
+        default=4
+    )
+
+    parser.add_argument(
+        "--era5-replay-dir",
+        help="path to local ERA5 chunks to use instead of CDS (offline mode)",
+        type=pathlib.Path
+    )
+
     parser.add_argument(
         "--track-file",
         help="path to the storm track file for parametric wind setup",
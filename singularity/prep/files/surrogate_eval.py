@@ -0,0 +1,275 @@
+'''Batched evaluation of the KL surrogate at the subset nodes
+
+Same results as `percentiles_from_surrogate` and
+`sensitivities_from_surrogate` of `ensembleperturbation` but computed
+from the KL surrogate and modes directly. The polynomial basis is
+evaluated once per batch of samples and reduced to KL mode values,
+which are then pushed through the modes with a single matrix product
+per block of nodes. Memory use is bounded by `memory_budget` instead of
+growing with the number of nodes and samples.
+'''
+
+from pathlib import Path
+import time
+
+import chaospy
+import numpy
+import xarray
+
+from ensembleperturbation.utilities import get_logger
+
+LOGGER = get_logger('klpc_wetonly')
+
+# Bytes of intermediate values held in memory at once
+MEMORY_BUDGET = 2 ** 30
+# Distribution samples per basis evaluation
+SAMPLE_BATCH = 2 ** 16
+
+
+
+def _blocks(size, block_size):
+
+    for start in range(0, size, block_size):
+        yield slice(start, min(start + block_size, size))
+
+
+def _scaled_kl_coefficients(kl_surrogate_model, kl_expansion):
+    '''PC coefficients of KL modes scaled by sqrt of eigenvalues'''
+
+    return kl_surrogate_model['coefs'] * numpy.sqrt(kl_expansion['eigenvalues'])
+
+
+def node_coefficients(kl_surrogate_model, kl_expansion, nodes=slice(None)):
+    '''PC coefficients of the surrogate at the given nodes'''
+
+    coefficients = numpy.dot(
+        _scaled_kl_coefficients(kl_surrogate_model, kl_expansion),
+        kl_expansion['modes'][:, nodes],
+    )
+    coefficients[0, :] += kl_expansion['mean_vector'][nodes]
+
+    return coefficients
+
+
+def mode_samples(kl_surrogate_model, kl_expansion, distribution, sample_size, rule='korobov'):
+    '''KL mode values of the surrogate at interior and corner samples'''
+
+    dim = len(distribution)
+    expansion = chaospy.aspolynomial(kl_surrogate_model['expansion'])
+    kl_coefficients = _scaled_kl_coefficients(kl_surrogate_model, kl_expansion)
+
+    # Get samples of the input distributions
+    ## Interior
+    interior = distribution.sample(sample_size, rule=rule).reshape(dim, sample_size)
+    values = numpy.empty((sample_size, kl_coefficients.shape[1]))
+    for batch in _blocks(sample_size, SAMPLE_BATCH):
+        values[batch] = numpy.dot(expansion(*interior[:, batch]).T, kl_coefficients)
+
+    ## Min/max
+    corners = numpy.mgrid[(slice(0, 2, 1),) * dim].reshape(dim, 2 ** dim).T
+    corners = numpy.where(corners, distribution.lower, distribution.upper).T
+    corner_basis = expansion(*corners)
+    corner_basis = corner_basis[:, ~numpy.isnan(corner_basis).any(axis=0)]
+
+    return numpy.concatenate(
+        [values, numpy.dot(corner_basis.T, kl_coefficients)], axis=0
+    )
+
+
+def compute_kl_surrogate_percentiles(
+    kl_surrogate_model,
+    kl_expansion,
+    q,
+    distribution,
+    sample_size=2000,
+    convert_from_log_scale=False,
+    memory_budget=MEMORY_BUDGET,
+):
+    '''Percentiles of the surrogate at all nodes, by blocks of nodes'''
+
+    start_time = time.time()
+    q = numpy.asarray(q).ravel() / 100.0
+
+    samples = mode_samples(kl_surrogate_model, kl_expansion, distribution, sample_size)
+    modes = kl_expansion['modes']
+    mean_vector = kl_expansion['mean_vector']
+
+    num_samples = samples.shape[0]
+    num_points = len(mean_vector)
+    block_size = max(1, memory_budget // (8 * num_samples))
+    out = numpy.empty((len(q), num_points))
+    LOGGER.info(
+        f'calculating quantiles of {num_samples} samples'
+        f' at {num_points} points in blocks of {block_size}'
+    )
+    for block in _blocks(num_points, block_size):
+        values = numpy.dot(samples, modes[:, block])
+        values += mean_vector[block]
+        if isinstance(convert_from_log_scale, float):
+            values = convert_from_log_scale ** values
+        elif convert_from_log_scale:
+            values = numpy.exp(values)
+
+        # We invalidate values here to speedup
+        numpy.quantile(values, q, axis=0, overwrite_input=True, out=out[:, block])
+
+    end_time = time.time()
+    LOGGER.info(f'quantiles computed in {end_time - start_time:.1f} seconds')
+    return out
+
+
+def percentiles_from_kl_surrogate(
+    percentiles,
+    kl_surrogate_model,
+    kl_expansion,
+    distribution,
+    training_set,
+    sample_size=2000,
+    minimum_allowable_value=None,
+    convert_from_log_scale=False,
+    convert_from_depths=False,
+    element_table=None,
+    filename=None,
+    memory_budget=MEMORY_BUDGET,
+):
+    '''Same as `percentiles_from_surrogate` using the batched evaluation'''
+
+    if filename is not None and not isinstance(filename, Path):
+        filename = Path(filename)
+
+    if filename is not None and filename.exists():
+        LOGGER.info(f'loading percentiles from "{filename}"')
+        return xarray.open_dataset(filename)
+
+    LOGGER.info(f'calculating {len(percentiles)} percentile(s): {percentiles}')
+    surrogate_percentiles = xarray.DataArray(
+        compute_kl_surrogate_percentiles(
+            kl_surrogate_model=kl_surrogate_model,
+            kl_expansion=kl_expansion,
+            q=percentiles,
+            distribution=distribution,
+            sample_size=sample_size,
+            convert_from_log_scale=convert_from_log_scale,
+            memory_budget=memory_budget,
+        ),
+        coords={
+            'quantile': percentiles,
+            **{
+                coord: values
+                for coord, values in training_set.coords.items()
+                if coord not in ['run', 'type']
+            },
+        },
+        dims=('quantile', *(dim for dim in training_set.dims if dim not in ['run', 'type'])),
+    )
+
+    # before evaluating quantile for model set null water elevation to the ground elevation
+    training_set = numpy.fmax(training_set, -training_set['depth'])
+    skipna = None
+    if not training_set.isnull().any():
+        # Using non-NaN variant for much better performance!
+        skipna = False
+    modeled_percentiles = training_set.quantile(
+        dim='run', q=surrogate_percentiles['quantile'] / 100, skipna=skipna
+    )
+
+    if isinstance(convert_from_depths, (float, numpy.ndarray)):
+        surrogate_percentiles -= convert_from_depths
+    if minimum_allowable_value is not None:
+        too_small = (
+            modeled_percentiles + training_set['depth']
+        ).values < minimum_allowable_value
+        modeled_percentiles.values[too_small] = numpy.nan
+        too_small = surrogate_percentiles.values < minimum_allowable_value
+        surrogate_percentiles.values[too_small] = numpy.nan
+    if isinstance(convert_from_depths, (float, numpy.ndarray)) or convert_from_depths:
+        surrogate_percentiles -= training_set['depth']
+
+    modeled_percentiles.coords['quantile'] = surrogate_percentiles['quantile']
+
+    node_percentiles = xarray.combine_nested(
+        [surrogate_percentiles, modeled_percentiles], concat_dim='source'
+    ).assign_coords(source=['surrogate', 'model'])
+
+    node_percentiles = node_percentiles.to_dataset(name='quantiles')
+
+    node_percentiles = node_percentiles.assign(
+        differences=numpy.fabs(surrogate_percentiles - modeled_percentiles)
+    )
+
+    if element_table is not None:
+        node_percentiles = node_percentiles.assign_coords({'element': element_table})
+
+    if filename is not None:
+        LOGGER.info(f'saving percentiles to "{filename}"')
+        node_percentiles.to_netcdf(filename)
+
+    return node_percentiles
+
+
+def sensitivities_from_kl_surrogate(
+    kl_surrogate_model,
+    kl_expansion,
+    variables,
+    nodes,
+    element_table=None,
+    filename=None,
+    memory_budget=MEMORY_BUDGET,
+):
+    '''Same as `sensitivities_from_surrogate` using the batched evaluation'''
+
+    if filename is not None and not isinstance(filename, Path):
+        filename = Path(filename)
+
+    if filename is not None and filename.exists():
+        LOGGER.info(f'loading sensitivities from "{filename}"')
+        return xarray.open_dataset(filename)
+
+    LOGGER.info(f'extracting sensitivities from surrogate model and distribution')
+
+    start_time = time.time()
+    expansion = kl_surrogate_model['expansion']
+    norms = numpy.sqrt(kl_surrogate_model['norms'].reshape(-1, 1))
+    num_points = len(kl_expansion['mean_vector'])
+    # NOTE: Sobol indices need a few copies of the coefficients
+    block_size = max(1, memory_budget // (8 * 4 * len(norms)))
+    sensitivities = numpy.empty((2, len(variables), num_points))
+    for block in _blocks(num_points, block_size):
+        normed_Fcoefficients = node_coefficients(
+            kl_surrogate_model, kl_expansion, block
+        ) * norms
+        total_variance = (normed_Fcoefficients[1::] ** 2).sum(axis=0)
+        block_sensitivities = numpy.stack([
+            chaospy.FirstOrderSobol(expansion, normed_Fcoefficients),
+            chaospy.TotalOrderSobol(expansion, normed_Fcoefficients),
+        ])
+        # sensitivities where variance is small can go to zero
+        block_sensitivities[:, :, total_variance < 1e-6] = numpy.nan
+        sensitivities[:, :, block] = block_sensitivities
+
+    end_time = time.time()
+    LOGGER.info(f'sensitivities computed in {end_time - start_time:.1f} seconds')
+
+    sensitivities = xarray.DataArray(
+        sensitivities,
+        coords={
+            'order': ['main', 'total'],
+            'variable': variables,
+            'node': nodes['node'],
+            'x': nodes['x'],
+            'y': nodes['y'],
+            'depth': nodes['depth'],
+        },
+        dims=('order', 'variable', 'node'),
+    ).T
+
+    sensitivities = sensitivities.to_dataset(name='sensitivities')
+
+    if element_table is not None:
+        sensitivities = sensitivities.assign_coords({'element': element_table})
+
+    if filename is not None:
+        LOGGER.info(f'saving sensitivities to "{filename}"')
+        sensitivities.to_netcdf(filename)
+
+    return sensitivities
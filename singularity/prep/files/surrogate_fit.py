@@ -0,0 +1,177 @@
+'''Parallel fitting of the polynomial chaos surrogate of KL modes
+
+Same model as `surrogate_from_training_set` of `ensembleperturbation`
+but the KL modes are fit concurrently and the cross validation folds of
+each mode use the remaining workers. Results only depend on the random
+state, not on the number of workers.
+'''
+
+import os
+from pathlib import Path
+import pickle
+
+import chaospy
+from joblib import Parallel, delayed
+import numpoly
+import numpy
+from sklearn.linear_model import ElasticNetCV, RidgeCV
+from sklearn.model_selection import KFold, LeaveOneOut
+
+from ensembleperturbation.perturbation.atcf import VortexPerturbedVariable
+from ensembleperturbation.utilities import get_logger
+
+LOGGER = get_logger('klpc_wetonly')
+
+# loo: ElasticNet with leave-one-out, refits the model nens times
+# kfold: ElasticNet with shuffled K-fold, refits the model K times
+# press: ridge with analytic leave-one-out (PRESS), no refits
+CROSS_VALIDATIONS = ('loo', 'kfold', 'press')
+KFOLD_SPLITS = 5
+RANDOM_STATE = 666
+PRESS_ALPHAS = numpy.logspace(-6, 2, 17)
+POLYNOMIAL_ORDER = 3
+
+
+
+def perturbation_distribution(variable_names):
+    '''Joint distribution of the perturbed vortex variables'''
+
+    variables = {
+        variable_class.name: variable_class()
+        for variable_class in VortexPerturbedVariable.__subclasses__()
+    }
+
+    return chaospy.J(
+        *(
+            variables[variable_name].chaospy_distribution()
+            for variable_name in variable_names
+        )
+    )
+
+
+def _polynomial_expansion(distribution, polynomial_order):
+
+    return chaospy.generate_expansion(
+        order=polynomial_order,
+        dist=distribution,
+        rule='three_terms_recurrence',
+        retall=True,
+    )
+
+
+def with_expansion(surrogate_model, distribution, polynomial_order=POLYNOMIAL_ORDER):
+    '''Surrogate model with its polynomial expansion and norms
+
+    Only stored by `surrogate_from_training_set_parallel`, surrogates of
+    the library fitter and of older analyses get them regenerated.
+    '''
+
+    if 'expansion' in surrogate_model and 'norms' in surrogate_model:
+        return surrogate_model
+
+    polynomial_expansion, norms = _polynomial_expansion(distribution, polynomial_order)
+    return {
+        **surrogate_model,
+        'expansion': polynomial_expansion,
+        'norms': norms,
+    }
+
+
+def regression_model(cross_validation='loo', random_state=RANDOM_STATE, n_jobs=None):
+    '''Regression model of the surrogate for the cross validation type'''
+
+    if cross_validation == 'press':
+        # NOTE: `cv=None` is the efficient leave-one-out of ridge
+        return RidgeCV(alphas=PRESS_ALPHAS, fit_intercept=False)
+
+    if cross_validation == 'loo':
+        cross_validator = LeaveOneOut()
+    elif cross_validation == 'kfold':
+        cross_validator = KFold(
+            n_splits=KFOLD_SPLITS, shuffle=True, random_state=random_state
+        )
+    else:
+        raise ValueError(
+            f'Unknown cross validation "{cross_validation}",'
+            f' use one of {CROSS_VALIDATIONS}'
+        )
+
+    return ElasticNetCV(
+        fit_intercept=False,
+        cv=cross_validator,
+        l1_ratio=0.5,
+        selection='random',
+        random_state=random_state,
+        n_jobs=n_jobs,
+    )
+
+
+def _fit_mode(polynomials, abscissas, evals, model):
+
+    return chaospy.fit_regression(
+        polynomials=polynomials,
+        abscissas=abscissas,
+        evals=evals,
+        model=model,
+        retall=1,
+    )
+
+
+def surrogate_from_training_set_parallel(
+    training_set,
+    training_perturbations,
+    distribution,
+    filename=None,
+    polynomial_order=POLYNOMIAL_ORDER,
+    cross_validation='loo',
+    random_state=RANDOM_STATE,
+    max_workers=None,
+):
+    '''Fit the surrogate of each KL mode using a pool of workers'''
+
+    if filename is not None and not isinstance(filename, Path):
+        filename = Path(filename)
+
+    if filename is not None and filename.exists():
+        LOGGER.info(f'loading surrogate model from "{filename}"')
+        return numpy.load(filename, allow_pickle=True)
+
+    # expand polynomials with polynomial chaos
+    polynomial_expansion, norms = _polynomial_expansion(distribution, polynomial_order)
+
+    samples = numpy.asarray(training_set)
+    abscissas = numpy.asarray(training_perturbations['perturbations']).T
+    n_modes = samples.shape[1]
+
+    # NOTE: Left over workers are used for the folds of each mode
+    if max_workers is None:
+        max_workers = os.cpu_count()
+    mode_workers = max(1, min(max_workers, n_modes))
+    fold_workers = max(1, max_workers // mode_workers)
+    model = regression_model(
+        cross_validation, random_state=random_state, n_jobs=fold_workers
+    )
+
+    LOGGER.info(
+        f'fitting polynomial surrogate to {samples.shape} samples using'
+        f' {cross_validation} regression on {mode_workers}x{fold_workers} workers'
+    )
+    fits = Parallel(n_jobs=mode_workers)(
+        delayed(_fit_mode)(polynomial_expansion, abscissas, samples[:, mode], model)
+        for mode in range(n_modes)
+    )
+    poly_list, coefficients = zip(*fits)
+
+    # round to 8-decimal places, removes very small coefficients
+    surrogate_model = {
+        'poly': numpoly.polynomial(list(poly_list)).round(8),
+        'coefs': numpy.stack(coefficients).T,
+        'norms': norms,
+        'expansion': polynomial_expansion,
+    }
+    if filename is not None:
+        with open(filename, 'wb') as surrogate_handle:
+            LOGGER.info(f'saving surrogate model to "{filename}"')
+            pickle.dump(surrogate_model, surrogate_handle)
+
+    return surrogate_model
@@ -1,79 +1,171 @@
 from __future__ import annotations
-from copy import deepcopy
+import os
+from concurrent.futures import ThreadPoolExecutor
+from copy import copy
 from datetime import datetime, timedelta
+from itertools import chain
 from pathlib import Path
 
 import f90nml
 import numpy as np
 from pyschism.mesh.base import Elements
-from pyschism.mesh.base import Gr3
+from pyschism.mesh.base import Gr3, Hull
 from pyschism.mesh.gridgr3 import Gr3Field
 from pyschism.param.param import Param
 
+from fileio import link_file
+from namelist import MAX_WORKERS, patch_namelist
 
-REFS = Path('~').expanduser() / 'app/refs'
 
-def setup_wwm(mesh_file: Path, setup_dir: Path, ensemble: bool):
+REFS = Path('~').expanduser() / 'app/refs'
+HOTFILE_OUT = 'wwm_hot_out'
+HOTFILE_IN = 'wwm_hot_in.nc'
+WWM_GRIDS = ('hgrid_WWM.gr3', 'wwmbnd.gr3')
+
+def setup_wwm(
+        mesh_file: Path,
+        setup_dir: Path,
+        ensemble: bool,
+        param_patches=(),
+        shared_grids: bool = True,
+        hotstart: bool = True,
+        ):
     '''Output is
         - hgrid_WWM.gr3
         - param.nml
         - wwmbnd.gr3
         - wwminput.nml
+
+    Any other `param_patches` are applied to `param.nml` along with
+    the WWM coupling parameters in a single read/write. For ensembles
+    with `shared_grids` the grid files are written once in `setup_dir`
+    and linked into each run. For ensembles with `hotstart` the spinup
+    writes a WWM hotfile at its end time that all runs start from.
     '''
 
     
+    spinup_dir = None
     runs_dir = [setup_dir]
     if ensemble:
         spinup_dir = setup_dir/'spinup'
-        runs_dir = setup_dir.glob('runs/*')
+        runs_dir = list(setup_dir.glob('runs/*'))
+        if hotstart:
+            # Spinup needs WWM to write the hotfile for the runs
+            runs_dir.insert(0, spinup_dir)
+
+    shared = ensemble and shared_grids
+    write_wwm_grids(mesh_file, [setup_dir] if shared else runs_dir)
+
+    def _setup_run(run):
+        is_spinup = run == spinup_dir
+        hotfile_from = None
+        if hotstart and ensemble and not is_spinup:
+            hotfile_from = spinup_dir / f'{HOTFILE_OUT}.nc'
+        setup_wwm_run(
+            run,
+            param_patches=param_patches,
+            grids_dir=setup_dir if shared else None,
+            hotfile_out=hotstart and is_spinup,
+            hotfile_from=hotfile_from,
+        )
+
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        # Raise any exception from the threads
+        list(executor.map(_setup_run, runs_dir))
+
+
+def write_wwm_grids(mesh_file: Path, out_dirs):
+    '''Write WWM grid and boundary files into each of `out_dirs`'''
 
     schism_grid = Gr3.open(mesh_file, crs=4326)
     wwm_grid = break_quads(schism_grid)
     wwm_bdry = Gr3Field.constant(wwm_grid, 0.0)
 
-    # TODO: Update spinup
-    # NOTE: Requires setup of WWM hotfile
+    for out_dir in out_dirs:
+        wwm_grid.write(out_dir / 'hgrid_WWM.gr3', format='gr3')
+        wwm_bdry.write(out_dir / 'wwmbnd.gr3', format='gr3')
 
-    # Update runs
-    for run in runs_dir:
-        wwm_grid.write(run / 'hgrid_WWM.gr3', format='gr3')
-        wwm_bdry.write(run / 'wwmbnd.gr3', format='gr3')
 
-        schism_nml = update_schism_params(run / 'param.nml')
-        schism_nml.write(run / 'param.nml', force=True)
+def setup_wwm_run(
+        run: Path,
+        param_patches=(),
+        grids_dir: Path = None,
+        hotfile_out: bool = False,
+        hotfile_from: Path = None,
+        ):
+    '''Setup WWM inputs of a single SCHISM run directory
 
-        wwm_nml = get_wwm_params(run_name=run.name, schism_nml=schism_nml)
-        wwm_nml.write(run / 'wwminput.nml')
-        
+    Grid files are linked from `grids_dir` if specified. If
+    `hotfile_from` is specified the run reads WWM hotfile from it.
+    '''
+
+    if grids_dir is not None:
+        for fname in WWM_GRIDS:
+            link_file(grids_dir / fname, run / fname)
+
+    schism_nml = patch_namelist(
+        run / 'param.nml', [*param_patches, update_schism_params]
+    )
+    wwm_nml = get_wwm_params(
+        run_name=run.name,
+        schism_nml=schism_nml,
+        hotfile_out=hotfile_out,
+        hotfile_in=hotfile_from is not None,
+    )
+    wwm_nml.write(run / 'wwminput.nml')
+
+    if hotfile_from is not None:
+        # NOTE: Dangling until spinup is done, similar to SCHISM
+        # hotstart.nc link
+        hotfile = run / HOTFILE_IN
+        if hotfile.is_symlink() or hotfile.exists():
+            hotfile.unlink()
+        hotfile.symlink_to(os.path.relpath(hotfile_from, hotfile.parent))
 
 
 def break_quads(pyschism_mesh: Gr3) -> Gr3 | Gr3Field:
-    # Create new Elements and set it for the Gr3.elements
-    quads = pyschism_mesh.quads
-    if len(quads) == 0:
-        new_mesh = deepcopy(pyschism_mesh)
-
-    else:
-        tmp = quads[:,2:]
-        tmp = np.insert(tmp, 0, quads[:, 0], axis=1)
-        broken = np.vstack((quads[:, :3], tmp))
-        trias = pyschism_mesh.triangles
-        final_trias = np.vstack((trias, broken))
-        # NOTE: Node IDs and indexs are the same as before
-        elements = {
-            idx+1: list(map(pyschism_mesh.nodes.get_id_by_index, tri))
-            for idx, tri in enumerate(final_trias)
-        }
-
-        new_mesh = deepcopy(pyschism_mesh)
-        new_mesh.elements = Elements(pyschism_mesh.nodes, elements)
+    '''Split quads into triangles using only index arrays; the new
+    mesh shares the nodes of the input mesh instead of copying them.
+    '''
 
+    elements = pyschism_mesh.elements.elements
+    n_verts = np.fromiter(
+        map(len, elements.values()), dtype=int, count=len(elements)
+    )
+    if not np.any(n_verts == 4):
+        return copy(pyschism_mesh)
+
+    # Vectorized element vertex ID -> node index lookup
+    node_ids = np.asarray(pyschism_mesh.nodes.id)
+    sorter = np.argsort(node_ids)
+    vert_ids = np.asarray(list(chain.from_iterable(elements.values())))
+    vert_idxs = sorter[np.searchsorted(node_ids, vert_ids, sorter=sorter)]
+    offsets = np.concatenate(([0], np.cumsum(n_verts[:-1])))
+
+    trias = vert_idxs[offsets[n_verts == 3, None] + np.arange(3)]
+    quads = vert_idxs[offsets[n_verts == 4, None] + np.arange(4)]
+    broken = np.vstack((quads[:, [0, 1, 2]], quads[:, [0, 2, 3]]))
+    final_trias = np.vstack((trias, broken))
+
+    # NOTE: Node IDs and indexs are the same as before
+    new_elements = dict(zip(
+        range(1, len(final_trias) + 1), node_ids[final_trias].tolist()
+    ))
+
+    new_mesh = copy(pyschism_mesh)
+    new_mesh.elements = Elements(pyschism_mesh.nodes, new_elements)
+    new_mesh.hull = Hull(new_mesh)
 
     return new_mesh
 
 
 
-def get_wwm_params(run_name, schism_nml) -> f90nml.Namelist:
+def get_wwm_params(
+        run_name,
+        schism_nml,
+        hotfile_out=False,
+        hotfile_in=False,
+        ) -> f90nml.Namelist:
     
     # Get relevant values from SCHISM setup
     begin_time = datetime(
@@ -109,6 +201,10 @@ def get_wwm_params(run_name, schism_nml) -> f90nml.Namelist:
     # Minimum water depth. THis must be same as h0 in selfe
     proc_nml['DMIN'] = 0.01
 
+    init_nml = wwm_params['INIT']
+    # Use hotstart file (see &HOTFILE section)
+    init_nml['LHOTR'] = hotfile_in
+
     grid_nml = wwm_params['GRID']
     # Number of directional bins
     grid_nml['MDC'] = mdc
@@ -165,53 +261,36 @@ def get_wwm_params(run_name, schism_nml) -> f90nml.Namelist:
     # Time for definition of station files
     sta_nml['DEFINETC'] = 86400
 
-    # TODO: Add hot file?
     hot_nml = wwm_params['HOTFILE']
     # Write hotfile
-    hot_nml['LHOTF'] = False
-    #'.nc' suffix will be added 
-#    hot_nml['FILEHOT_OUT'] = 'wwm_hot_out'
-#    #Starting time of hotfile writing. With ihot!=0 in SCHISM,
-#    # this will be whatever the new hotstarted time is (even with ihot=2)
-#    hot_nml['BEGTC'] = '20030908.000000'
-#    # time between hotfile writes
-#    hot_nml['DELTC'] = 86400.
-#    # unit used above
-#    hot_nml['UNITC'] = 'SEC'
-#    # Ending time of hotfile writing (adjust with BEGTC)
-#    hot_nml['ENDTC'] = '20031008.000000'
-#    # Applies only to netcdf
-#    # If T then hotfile contains 2 last records.
-#    # If F then hotfile contains N record if N outputs
-#    # have been done.
-#    # For binary only one record.
-#    hot_nml['LCYCLEHOT'] = True
-#    # 1: binary hotfile of data as output
-#    # 2: netcdf hotfile of data as output (default)
-#    hot_nml['HOTSTYLE_OUT'] = 2
-#    # 0: hotfile in a single file (binary or netcdf)
-#    # MPI_REDUCE is then used and thus youd avoid too freq. output 
-#    # 1: hotfiles in separate files, each associated
-#    # with one process
-#    hot_nml['MULTIPLEOUT'] = 0
-#    # (Full) hot file name for input
-#    hot_nml['FILEHOT_IN'] = 'wwm_hot_in.nc'
-#    # 1: binary hotfile of data as input
-#    # 2: netcdf hotfile of data as input (default)
-#    hot_nml['HOTSTYLE_IN'] = 2
-#    # Position in hotfile (only for netcdf)
-#    # for reading
-#    hot_nml['IHOTPOS_IN'] = 1
-#    # 0: read hotfile from one single file
-#    # 1: read hotfile from multiple files (must use same # of CPU?)
-#    hot_nml['MULTIPLEIN'] = 0
+    hot_nml['LHOTF'] = hotfile_out
+    if hotfile_out:
+        #'.nc' suffix will be added 
+        hot_nml['FILEHOT_OUT'] = HOTFILE_OUT
+        # Only write a single record at the end of the run
+        hot_nml['BEGTC'] = end_time.strftime(time_fmt)
+        hot_nml['DELTC'] = wwm_delta_t
+        hot_nml['UNITC'] = 'SEC'
+        hot_nml['ENDTC'] = end_time.strftime(time_fmt)
+        hot_nml['LCYCLEHOT'] = False
+        # 2: netcdf hotfile of data as output (default)
+        hot_nml['HOTSTYLE_OUT'] = 2
+        # 0: hotfile in a single file (binary or netcdf)
+        hot_nml['MULTIPLEOUT'] = 0
+    if hotfile_in:
+        # (Full) hot file name for input
+        hot_nml['FILEHOT_IN'] = HOTFILE_IN
+        # 2: netcdf hotfile of data as input (default)
+        hot_nml['HOTSTYLE_IN'] = 2
+        # Position in hotfile (only for netcdf)
+        hot_nml['IHOTPOS_IN'] = 1
+        # 0: read hotfile from one single file
+        hot_nml['MULTIPLEIN'] = 0
 
     return wwm_params
 
 
-def update_schism_params(path: Path) -> f90nml.Namelist:
-
-    schism_nml = f90nml.read(path)
+def update_schism_params(schism_nml: f90nml.Namelist) -> f90nml.Namelist:
 
     core_nml = schism_nml['core']
     core_nml['msc2'] = 24
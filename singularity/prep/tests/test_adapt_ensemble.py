@@ -0,0 +1,60 @@
+import pytest
+
+pytest.importorskip('ensembleperturbation')
+
+import numpy
+import xarray
+
+import adapt_ensemble
+
+
+def _write_percentiles(path, surrogate, nodes=(0, 1, 2)):
+
+    quantiles = numpy.stack([surrogate, numpy.zeros_like(surrogate)])
+    xarray.Dataset(
+        {'quantiles': (('source', 'quantile', 'node'), quantiles)},
+        coords={
+            'source': ['surrogate', 'model'],
+            'quantile': [10, 90],
+            'node': list(nodes),
+        },
+    ).to_netcdf(path)
+    return path
+
+
+def test_ordered_runs(tmp_path):
+
+    for name in ['korobov_quadrature_10', 'korobov_quadrature_2', 'original', 'random_1']:
+        (tmp_path / 'runs' / name).mkdir(parents=True)
+
+    assert adapt_ensemble.ordered_runs(tmp_path) == [
+        'original', 'random_1', 'korobov_quadrature_2', 'korobov_quadrature_10'
+    ]
+
+
+def test_percentile_change(tmp_path):
+
+    previous = _write_percentiles(
+        tmp_path / 'previous.nc', numpy.zeros((2, 3))
+    )
+    current = _write_percentiles(
+        tmp_path / 'current.nc',
+        numpy.array([[0.3, 0.0, 0.4], [0.1, numpy.nan, 0.1]]),
+    )
+
+    # max over percentiles of RMS over nodes, ignoring null nodes
+    assert adapt_ensemble.percentile_change(previous, current) == pytest.approx(
+        numpy.sqrt((0.3 ** 2 + 0.4 ** 2) / 3)
+    )
+
+
+def test_percentile_change_common_nodes(tmp_path):
+
+    previous = _write_percentiles(
+        tmp_path / 'previous.nc', numpy.zeros((2, 2)), nodes=(0, 1)
+    )
+    current = _write_percentiles(
+        tmp_path / 'current.nc', numpy.full((2, 2), 0.1), nodes=(1, 2)
+    )
+
+    assert adapt_ensemble.percentile_change(previous, current) == pytest.approx(0.1)
@@ -0,0 +1,130 @@
+import pytest
+
+pytest.importorskip('ensembleperturbation')
+
+import numpy
+import xarray
+
+import analyze_ensemble
+
+
+def _max_elevations(values, x):
+
+    values = numpy.asarray(values, dtype=float)
+    return xarray.DataArray(
+        values,
+        dims=('run', 'node'),
+        coords={
+            'run': [f'run_{idx}' for idx in range(values.shape[0])],
+            'x': ('node', numpy.asarray(x, dtype=float)),
+            'y': ('node', numpy.zeros(values.shape[1])),
+            'depth': ('node', numpy.full(values.shape[1], 10.0)),
+        },
+    )
+
+
+def test_dry_area_neighbors_all_wet():
+
+    da = _max_elevations(numpy.ones((2, 4)), [0, 0.01, 0.02, 0.05])
+
+    neighbors = analyze_ensemble.dry_area_neighbors(da, k_neighbors=1)
+
+    assert neighbors['dry_nodes'].shape == (0,)
+    assert neighbors['distances'].shape == (2, 0, 1)
+    assert neighbors['neighbors'].shape == (2, 0, 1)
+    adjusted = analyze_ensemble.extrapolate_to_dry_areas(da, neighbors)
+    numpy.testing.assert_array_equal(adjusted.values, da.values)
+
+
+def test_dry_area_neighbors():
+
+    da = _max_elevations(
+        [[1.0, 2.0, numpy.nan, 3.0], [1.0, 2.0, 2.5, 3.0]],
+        [0, 0.01, 0.02, 0.05],
+    )
+
+    neighbors = analyze_ensemble.dry_area_neighbors(da, k_neighbors=1)
+
+    assert neighbors['dry_nodes'].tolist() == [2]
+    # closest wet node in the first run, wet in the second
+    assert neighbors['neighbors'][:, :, 0].tolist() == [[1], [-1]]
+    assert numpy.isnan(neighbors['distances'][1, 0, 0])
+
+    mann_coef = 0.05
+    adjusted = analyze_ensemble.extrapolate_to_dry_areas(
+        da, neighbors, mann_coef=mann_coef
+    )
+    friction_factor = (0.4 * mann_coef) ** 2
+    assert adjusted.values[0, 2] == pytest.approx(
+        2.0 - neighbors['distances'][0, 0, 0] * friction_factor
+    )
+    numpy.testing.assert_array_equal(adjusted.values[1], da.values[1])
+
+
+def test_dry_area_neighbors_beyond_candidates():
+
+    n_nodes = analyze_ensemble.NEIGHBOR_CANDIDATES + 10
+    values = numpy.ones((1, n_nodes))
+    values[0, :-2] = numpy.nan
+    da = _max_elevations(values, numpy.arange(n_nodes) * 0.01)
+
+    neighbors = analyze_ensemble.dry_area_neighbors(da, k_neighbors=2)
+
+    # the closest candidates are all dry, wet ones found per run
+    assert neighbors['neighbors'][0, 0].tolist() == [n_nodes - 2, n_nodes - 1]
+    assert (neighbors['neighbors'][0] >= n_nodes - 2).all()
+
+
+def test_dry_area_neighbors_cached(tmp_path):
+
+    filename = tmp_path / 'neighbors.npz'
+    da = _max_elevations(
+        [[1.0, 2.0, numpy.nan, 3.0]], [0, 0.01, 0.02, 0.05]
+    )
+    analyze_ensemble.dry_area_neighbors(da, k_neighbors=1, filename=filename)
+
+    cached = analyze_ensemble.dry_area_neighbors(
+        da * numpy.nan, k_neighbors=1, filename=filename
+    )
+    assert cached['dry_nodes'].tolist() == [2]
+
+    # a different number of neighbors isn't taken from the cache
+    recomputed = analyze_ensemble.dry_area_neighbors(
+        da, k_neighbors=2, filename=filename
+    )
+    assert recomputed['neighbors'].shape == (1, 1, 2)
+
+
+def test_extrapolate_to_dry_areas_chunked():
+
+    rng = numpy.random.default_rng(0)
+    values = rng.uniform(0.5, 2.0, (3, 40))
+    values[rng.uniform(size=values.shape) < 0.3] = numpy.nan
+    da = _max_elevations(values, rng.uniform(0, 0.1, 40))
+    neighbors = analyze_ensemble.dry_area_neighbors(da, k_neighbors=2)
+
+    adjusted = analyze_ensemble.extrapolate_to_dry_areas(da, neighbors, idw_order=2)
+    # extrapolated as each block of nodes is read
+    chunked = analyze_ensemble.extrapolate_to_dry_areas(
+        da.chunk({'node': 7}), neighbors, idw_order=2
+    )
+
+    assert not numpy.isnan(adjusted.values).any()
+    numpy.testing.assert_allclose(chunked.values, adjusted.values)
+
+
+def test_extrapolate_to_dry_areas_run_chunks():
+
+    rng = numpy.random.default_rng(1)
+    values = rng.uniform(0.5, 2.0, (5, 30))
+    values[rng.uniform(size=values.shape) < 0.3] = numpy.nan
+    da = _max_elevations(values, rng.uniform(0, 0.1, 30))
+    neighbors = analyze_ensemble.dry_area_neighbors(da, k_neighbors=1)
+
+    adjusted = analyze_ensemble.extrapolate_to_dry_areas(da, neighbors)
+    # e.g. split by `array.slicing.split_large_chunks` of large ensembles
+    chunked = analyze_ensemble.extrapolate_to_dry_areas(
+        da.chunk({'run': 2, 'node': 8}), neighbors
+    )
+
+    numpy.testing.assert_allclose(chunked.values, adjusted.values)
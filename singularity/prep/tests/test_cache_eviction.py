@@ -0,0 +1,95 @@
+from datetime import datetime
+
+import pytest
+
+pytest.importorskip('pyschism')
+
+from matplotlib.transforms import Bbox
+
+import setup_model
+
+
+BBOX = Bbox([[-80.0, 25.0], [-70.0, 35.0]])
+START = datetime(2018, 9, 10)
+END = datetime(2018, 9, 14)
+
+
+def _derived_entry(cache_dir):
+
+    derived_cache_path = cache_dir / 'derived' / 'mesh_0123'
+    derived_cache_path.mkdir(parents=True)
+    (derived_cache_path / 'manning.gr3').write_bytes(b'0' * 1000)
+    setup_model.record_cache_access(derived_cache_path)
+    return derived_cache_path
+
+
+def _meteo_entry(cache_dir):
+
+    sflux_dir = cache_dir.parent / 'sflux'
+    sflux_dir.mkdir()
+    (sflux_dir / 'sflux_air_1.0001.nc').write_bytes(b'1' * 1000)
+    meteo_cache_path = setup_model.get_meteo_cache_path(
+        'era5', cache_dir / 'florence_2018', BBOX, START, END
+    )
+    meteo_cache_path.mkdir(parents=True)
+    setup_model.copy_meteo_cache(sflux_dir, meteo_cache_path)
+    setup_model.add_to_meteo_index('era5', meteo_cache_path, BBOX, START, END)
+    setup_model.record_cache_access(meteo_cache_path)
+    return meteo_cache_path
+
+
+def _key(cache_dir, path):
+
+    return str(path.relative_to(cache_dir))
+
+
+def test_evict_cache_within_budget(tmp_path):
+
+    cache_dir = tmp_path / 'cache'
+    _derived_entry(cache_dir)
+
+    assert setup_model.evict_cache(cache_dir, 10 ** 6) == []
+
+
+def test_evict_cache_least_recently_used(tmp_path):
+
+    cache_dir = tmp_path / 'cache'
+    derived = _derived_entry(cache_dir)
+    meteo = _meteo_entry(cache_dir)
+    usage = setup_model._cache_usage(cache_dir)
+
+    evicted = setup_model.evict_cache(cache_dir, usage - 500)
+
+    assert evicted == [_key(cache_dir, derived)]
+    assert not (derived / 'manning.gr3').exists()
+    # derived entries aren't indexed
+    assert not (derived.parent / setup_model.METEO_INDEX).exists()
+    manifest = setup_model._read_cache_manifest(cache_dir)
+    assert list(manifest['entries']) == [_key(cache_dir, meteo)]
+    # never synced, nothing to delete from S3
+    assert manifest['deleted'] == []
+
+
+def test_evict_cache_keeps_entries_in_use(tmp_path):
+
+    cache_dir = tmp_path / 'cache'
+    derived = _derived_entry(cache_dir)
+    meteo = _meteo_entry(cache_dir)
+    manifest = setup_model._read_cache_manifest(cache_dir)
+    for entry in manifest['entries'].values():
+        entry['synced'] = True
+    setup_model._write_cache_manifest(cache_dir, manifest)
+    usage = setup_model._cache_usage(cache_dir)
+
+    evicted = setup_model.evict_cache(cache_dir, usage - 500, keep=[derived])
+
+    assert evicted == [_key(cache_dir, meteo)]
+    assert (derived / 'manning.gr3').exists()
+    assert setup_model.find_meteo_cache(
+        'era5', meteo.parent, BBOX, START, END
+    ) == (None, None)
+    manifest = setup_model._read_cache_manifest(cache_dir)
+    assert len(manifest['deleted']) == 2
+    assert all(
+        relpath.startswith('florence_2018/') for relpath in manifest['deleted']
+    )
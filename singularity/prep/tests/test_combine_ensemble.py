@@ -0,0 +1,122 @@
+import pytest
+
+pytest.importorskip('ensembleperturbation')
+
+import combine_ensemble
+
+
+def test_finished_runs(tmp_path):
+
+    for name, outputs in [
+        ('run_1', ['out2d_1.nc', combine_ensemble.RUN_DONE_FILE]),
+        # still running or failed
+        ('run_2', ['out2d_1.nc']),
+        ('run_3', []),
+    ]:
+        (tmp_path / 'runs' / name / 'outputs').mkdir(parents=True)
+        for output in outputs:
+            (tmp_path / 'runs' / name / 'outputs' / output).touch()
+
+    assert combine_ensemble.finished_runs(tmp_path) == [tmp_path / 'runs' / 'run_1']
+
+
+def _write_member_outputs(run_dir, elevation):
+
+    import numpy
+    import xarray
+
+    outputs = run_dir / 'outputs'
+    outputs.mkdir(parents=True)
+    n_nodes = elevation.shape[1]
+    # Split in two stacks to check their ordering when reading
+    for idx, times in ((1, slice(0, 2)), (2, slice(2, None))):
+        time = numpy.arange(elevation.shape[0], dtype=float)[times] * 3600
+        xarray.Dataset(
+            {
+                'elevation': (('time', 'nSCHISM_hgrid_node'), elevation[times]),
+                'depth': ('nSCHISM_hgrid_node', [10.0, -2.0, -1.0][:n_nodes]),
+                'SCHISM_hgrid_node_x': ('nSCHISM_hgrid_node', numpy.arange(n_nodes, dtype=float)),
+                'SCHISM_hgrid_node_y': ('nSCHISM_hgrid_node', numpy.zeros(n_nodes)),
+                'minimum_depth': ('one', [0.01]),
+            },
+            coords={'time': time},
+        ).to_netcdf(outputs / f'out2d_{idx}.nc')
+    (outputs / combine_ensemble.RUN_DONE_FILE).touch()
+
+
+def _elevation():
+
+    import numpy
+
+    # wet node, dry land node, land node flooded at the last step
+    return numpy.array(
+        [
+            [-0.5, -2.0, -1.0],
+            [0.2, -2.0, -1.0],
+            [-0.1, -2.0, -1.0],
+            [0.1, -2.0, 1.5],
+        ]
+    )
+
+
+def test_read_member_max_elevation(tmp_path):
+
+    import numpy
+
+    run_dir = tmp_path / 'runs' / 'run_1'
+    _write_member_outputs(run_dir, _elevation())
+
+    maxele = combine_ensemble.read_member_max_elevation(run_dir)
+
+    assert maxele['run'].values.tolist() == ['run_1']
+    zeta_max = maxele['zeta_max'].isel(run=0).values
+    assert zeta_max[0] == pytest.approx(0.2)
+    # dry on land, total water depth is zero
+    assert numpy.isnan(zeta_max[1])
+    assert zeta_max[2] == pytest.approx(1.5)
+    assert maxele['time_of_zeta_max'].isel(run=0).values.tolist() == [3600, 0, 10800]
+
+
+def test_read_member_max_elevation_negative_wet(tmp_path):
+
+    import numpy
+
+    run_dir = tmp_path / 'runs' / 'run_1'
+    elevation = numpy.full((4, 1), -0.3)
+    _write_member_outputs(run_dir, elevation)
+
+    maxele = combine_ensemble.read_member_max_elevation(run_dir)
+
+    # below datum but wet, not masked
+    assert maxele['zeta_max'].values.ravel().tolist() == pytest.approx([-0.3])
+
+
+def test_combine_member(tmp_path):
+
+    import numpy
+    import xarray
+
+    runs = ['run_1', 'run_2', 'run_3']
+    combine_ensemble.write_json_atomic(
+        tmp_path / combine_ensemble.MEMBERS_MANIFEST, {'runs': runs}
+    )
+    elevation = _elevation()
+    _write_member_outputs(tmp_path / 'runs' / 'run_2', elevation)
+    _write_member_outputs(tmp_path / 'runs' / 'run_1', elevation + 1)
+
+    combine_ensemble.combine_member(tmp_path, tmp_path / 'runs' / 'run_2')
+    combine_ensemble.combine_member(tmp_path, tmp_path / 'runs' / 'run_1')
+    # combining twice doesn't duplicate the member
+    combine_ensemble.combine_member(tmp_path, tmp_path / 'runs' / 'run_1')
+
+    analyze_dir = tmp_path / 'analyze'
+    manifest = combine_ensemble._read_manifest(analyze_dir)
+    assert manifest == {'runs': runs, 'combined': ['run_2', 'run_1']}
+
+    with xarray.open_zarr(analyze_dir / combine_ensemble.STORE_NAME) as store:
+        zeta_max = store['zeta_max'].load()
+    assert zeta_max['run'].values.tolist() == runs
+    assert zeta_max.sel(run='run_1').values[0] == pytest.approx(1.2)
+    assert zeta_max.sel(run='run_2').values[0] == pytest.approx(0.2)
+    # not yet combined
+    assert numpy.isnan(zeta_max.sel(run='run_3').values).all()
@@ -0,0 +1,65 @@
+import os
+import stat
+
+import pytest
+
+pytest.importorskip('pyschism')
+
+import setup_model
+
+
+FNAMES = ['manning.gr3', 'windrot_geo2proj.gr3']
+
+
+@pytest.fixture
+def mesh_path(tmp_path):
+
+    path = tmp_path / 'hgrid.gr3'
+    path.write_text('mesh\n')
+    return path
+
+
+def test_derived_cache_path_depends_on_mesh_and_params(tmp_path, mesh_path):
+
+    path = setup_model.get_derived_cache_path(tmp_path, mesh_path, mannings_n=0.025)
+
+    assert path.parent == tmp_path / 'derived'
+    assert path == setup_model.get_derived_cache_path(
+        tmp_path, mesh_path, mannings_n=0.025
+    )
+    assert path != setup_model.get_derived_cache_path(
+        tmp_path, mesh_path, mannings_n=0.05
+    )
+    other_mesh = tmp_path / 'other.gr3'
+    other_mesh.write_text('other mesh\n')
+    assert path != setup_model.get_derived_cache_path(
+        tmp_path, other_mesh, mannings_n=0.025
+    )
+
+
+def test_derived_cache_round_trip(tmp_path, mesh_path):
+
+    schism_dir = tmp_path / 'run'
+    schism_dir.mkdir()
+    for fname in FNAMES:
+        (schism_dir / fname).write_text(fname)
+    derived_cache_path = setup_model.get_derived_cache_path(tmp_path, mesh_path)
+    derived_cache_path.mkdir(parents=True)
+
+    setup_model.copy_derived_cache(schism_dir, derived_cache_path, FNAMES)
+    for fname in FNAMES:
+        cached = derived_cache_path / fname
+        assert not os.path.samefile(schism_dir / fname, cached)
+        assert not os.stat(cached).st_mode & stat.S_IWUSR
+        # the run files are left writable
+        assert os.stat(schism_dir / fname).st_mode & stat.S_IWUSR
+
+    other_dir = tmp_path / 'other_run'
+    other_dir.mkdir()
+    missing = setup_model.from_derived_cache(
+        derived_cache_path, other_dir, FNAMES + ['albedo.gr3']
+    )
+
+    assert missing == ['albedo.gr3']
+    for fname in FNAMES:
+        assert (other_dir / fname).read_text() == fname
@@ -0,0 +1,55 @@
+from datetime import datetime
+
+import pytest
+
+pytest.importorskip('pyschism')
+
+import setup_model
+
+
+def test_daily_edges_at_midnight():
+
+    edges = setup_model._daily_edges(
+        datetime(2018, 9, 10, 6), datetime(2018, 9, 12, 18)
+    )
+
+    assert edges == [
+        datetime(2018, 9, 10, 6),
+        datetime(2018, 9, 11),
+        datetime(2018, 9, 12),
+        datetime(2018, 9, 12, 18),
+    ]
+
+
+def test_daily_edges_of_whole_days():
+
+    edges = setup_model._daily_edges(datetime(2018, 9, 10), datetime(2018, 9, 12))
+
+    assert edges == [
+        datetime(2018, 9, 10), datetime(2018, 9, 11), datetime(2018, 9, 12)
+    ]
+
+
+def test_daily_edges_within_a_day():
+
+    edges = setup_model._daily_edges(
+        datetime(2018, 9, 10, 6), datetime(2018, 9, 10, 18)
+    )
+
+    assert edges == [datetime(2018, 9, 10, 6), datetime(2018, 9, 10, 18)]
+
+
+def test_overlapping_requests_share_chunks():
+
+    def chunks(start_date, end_date):
+        edges = setup_model._daily_edges(start_date, end_date)
+        return set(zip(edges[:-1], edges[1:]))
+
+    first = chunks(datetime(2018, 9, 9, 6), datetime(2018, 9, 14))
+    second = chunks(datetime(2018, 9, 10, 12), datetime(2018, 9, 15, 6))
+
+    assert first & second == {
+        (datetime(2018, 9, 11), datetime(2018, 9, 12)),
+        (datetime(2018, 9, 12), datetime(2018, 9, 13)),
+        (datetime(2018, 9, 13), datetime(2018, 9, 14)),
+    }
@@ -0,0 +1,56 @@
+import json
+import os
+
+from fileio import file_digest, link_file, write_json_atomic
+
+
+def test_file_digest(tmp_path):
+
+    first = tmp_path / 'first'
+    second = tmp_path / 'second'
+    first.write_bytes(b'x' * 10)
+    second.write_bytes(b'x' * 10)
+
+    assert file_digest(first) == file_digest(second, blocksize=3)
+    second.write_bytes(b'y' * 10)
+    assert file_digest(first) != file_digest(second)
+
+
+def test_link_file_replaces_destination(tmp_path):
+
+    src = tmp_path / 'common' / 'src'
+    src.parent.mkdir()
+    src.write_text('shared')
+    dst = tmp_path / 'run' / 'dst'
+    dst.parent.mkdir()
+    dst.write_text('old')
+
+    link_file(src, dst)
+
+    assert dst.read_text() == 'shared'
+    assert os.path.samefile(src, dst)
+    # no temporary file left behind
+    assert [path.name for path in dst.parent.iterdir()] == ['dst']
+
+
+def test_link_file_replaces_symlink(tmp_path):
+
+    src = tmp_path / 'src'
+    src.write_text('shared')
+    dst = tmp_path / 'dst'
+    dst.symlink_to('missing')
+
+    link_file(src, dst)
+
+    assert not dst.is_symlink()
+    assert dst.read_text() == 'shared'
+
+
+def test_write_json_atomic(tmp_path):
+
+    path = tmp_path / 'manifest.json'
+    write_json_atomic(path, {'runs': ['a']})
+    write_json_atomic(path, {'runs': ['a', 'b']})
+
+    assert json.loads(path.read_text()) == {'runs': ['a', 'b']}
+    assert [p.name for p in tmp_path.iterdir()] == ['manifest.json']
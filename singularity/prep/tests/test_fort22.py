@@ -0,0 +1,66 @@
+import pytest
+
+pytest.importorskip('coupledmodeldriver')
+pytest.importorskip('ensembleperturbation')
+
+import pandas as pd
+
+import setup_ensemble
+
+
+def _record(datetime, advisory, hours, record):
+
+    return [
+        'AL', ' 06', f' {datetime}', '   ', f' {advisory}', f' {hours:>3}',
+        ' 285N', '  695W', f' {record:>3}',
+    ]
+
+
+def test_read_fort22_keeps_padding(tmp_path):
+
+    path = tmp_path / 'fort.22'
+    path.write_text(','.join(_record('2018091012', 'OFCL', 0, 1)) + '\n')
+
+    fort22 = setup_ensemble._read_fort22(path)
+
+    assert fort22.iloc[0].tolist() == _record('2018091012', 'OFCL', 0, 1)
+
+
+def test_to_best_fort22_forecast():
+
+    fort22 = pd.DataFrame([
+        _record('2018091012', 'OFCL', 0, 1),
+        _record('2018091012', 'OFCL', 12, 2),
+        # another isotach of the same time
+        _record('2018091012', 'OFCL', 12, 3),
+        _record('2018091012', 'OFCL', 24, 4),
+    ])
+
+    best = setup_ensemble._to_best_fort22(fort22)
+
+    assert best[setup_ensemble.FORT22_DATETIME_COL].tolist() == [
+        ' 2018091012', ' 2018091100', ' 2018091100', ' 2018091112'
+    ]
+    assert best[setup_ensemble.FORT22_ADVISORY_COL].unique().tolist() == [' BEST']
+    assert best[setup_ensemble.FORT22_HOURS_COL].tolist() == [
+        '   0', '  12', '  12', '  24'
+    ]
+    assert best[best.columns[-1]].tolist() == ['   1', '   2', '   2', '   3']
+    # other fields and the input are left as is
+    assert best[6].tolist() == [' 285N'] * 4
+    assert fort22[setup_ensemble.FORT22_ADVISORY_COL].unique().tolist() == [' OFCL']
+
+
+def test_to_best_fort22_best_track():
+
+    fort22 = pd.DataFrame([
+        _record('2018091000', 'BEST', 0, 1),
+        _record('2018091006', 'BEST', 0, 2),
+    ])
+
+    best = setup_ensemble._to_best_fort22(fort22)
+
+    assert best[setup_ensemble.FORT22_DATETIME_COL].tolist() == [
+        ' 2018091000', ' 2018091006'
+    ]
+    assert best[setup_ensemble.FORT22_HOURS_COL].tolist() == ['   0', '   6']
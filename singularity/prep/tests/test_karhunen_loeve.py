@@ -0,0 +1,120 @@
+import pytest
+
+pytest.importorskip('ensembleperturbation')
+
+import numpy
+
+import karhunen_loeve
+
+
+def _training_set(nens=40, ngrid=500, n_modes=5, seed=0):
+
+    rng = numpy.random.default_rng(seed)
+    # low rank plus a little noise, decreasing variance per mode
+    scales = 2.0 ** -numpy.arange(n_modes)
+    samples = rng.standard_normal((nens, n_modes)) * scales
+    modes = rng.standard_normal((n_modes, ngrid))
+    noise = 1e-6 * rng.standard_normal((nens, ngrid))
+    return 3.0 + samples @ modes + noise
+
+
+def _pca(ymodel):
+
+    centered = ymodel - ymodel.mean(axis=0)
+    _, s, _ = numpy.linalg.svd(centered, full_matrices=False)
+    return s ** 2 / (len(ymodel) - 1)
+
+
+def _reconstruct(kl_dict):
+
+    # whitened samples scaled back by the eigenvalues
+    return kl_dict['mean_vector'] + (
+        kl_dict['samples'] * numpy.sqrt(kl_dict['eigenvalues'])
+    ) @ kl_dict['modes']
+
+
+def test_randomized_modes(monkeypatch):
+
+    monkeypatch.setattr(karhunen_loeve, 'NODE_CHUNK', 128)
+    ymodel = _training_set()
+
+    kl_dict = karhunen_loeve.karhunen_loeve_expansion_randomized(ymodel, neig=3)
+
+    assert kl_dict['neig'] == 3
+    assert kl_dict['modes'].shape == (3, ymodel.shape[1])
+    assert kl_dict['samples'].shape == (ymodel.shape[0], 3)
+    numpy.testing.assert_allclose(kl_dict['eigenvalues'], _pca(ymodel)[:3], rtol=1e-6)
+    # whitened samples
+    numpy.testing.assert_allclose(
+        kl_dict['samples'].std(axis=0, ddof=1), 1.0, rtol=1e-6
+    )
+
+
+def test_randomized_variance_explained(monkeypatch):
+
+    # fewer modes first computed than needed
+    monkeypatch.setattr(karhunen_loeve, 'INITIAL_MODES', 1)
+    monkeypatch.setattr(karhunen_loeve, 'N_OVERSAMPLES', 1)
+    ymodel = _training_set()
+
+    kl_dict = karhunen_loeve.karhunen_loeve_expansion_randomized(ymodel, neig=0.9999)
+
+    eigenvalues = _pca(ymodel)
+    explained = numpy.cumsum(eigenvalues) / eigenvalues.sum()
+    assert kl_dict['neig'] == numpy.searchsorted(explained, 0.9999, side='right') + 1
+    numpy.testing.assert_allclose(_reconstruct(kl_dict), ymodel, atol=1e-3)
+
+
+def _kl_dict(nens=6, ngrid=9, neig=3):
+
+    rng = numpy.random.default_rng(1)
+    return {
+        'mean_vector': rng.standard_normal(ngrid),
+        'modes': rng.standard_normal((neig, ngrid)),
+        'eigenvalues': numpy.sort(rng.uniform(size=neig))[::-1],
+        'neig': neig,
+        'samples': rng.standard_normal((nens, neig)),
+    }
+
+
+def test_save_read_karhunen_loeve(tmp_path):
+
+    kl_dict = _kl_dict()
+    karhunen_loeve.save_karhunen_loeve(
+        kl_dict, tmp_path / karhunen_loeve.KL_DIRECTORY
+    )
+
+    loaded = karhunen_loeve.read_karhunen_loeve(tmp_path)
+
+    assert loaded['neig'] == kl_dict['neig']
+    # memory mapped
+    assert isinstance(loaded['modes'], numpy.memmap)
+    for name in karhunen_loeve.KL_ARRAYS:
+        numpy.testing.assert_array_equal(loaded[name], kl_dict[name])
+    assert not (tmp_path / f'.{karhunen_loeve.KL_DIRECTORY}.tmp').exists()
+
+
+def test_save_karhunen_loeve_replaces(tmp_path):
+
+    directory = tmp_path / karhunen_loeve.KL_DIRECTORY
+    karhunen_loeve.save_karhunen_loeve(_kl_dict(neig=3), directory)
+    # left over by an interrupted save
+    (tmp_path / f'.{directory.name}.tmp').mkdir()
+
+    karhunen_loeve.save_karhunen_loeve(_kl_dict(neig=2), directory)
+
+    assert karhunen_loeve.read_karhunen_loeve(tmp_path)['neig'] == 2
+
+
+def test_read_karhunen_loeve_pickle(tmp_path):
+
+    import pickle
+
+    assert karhunen_loeve.read_karhunen_loeve(tmp_path) is None
+
+    kl_dict = _kl_dict()
+    with open(tmp_path / karhunen_loeve.KL_PICKLE, 'wb') as kl_handle:
+        pickle.dump(kl_dict, kl_handle)
+
+    loaded = karhunen_loeve.read_karhunen_loeve(tmp_path)
+    numpy.testing.assert_array_equal(loaded['modes'], kl_dict['modes'])
@@ -0,0 +1,115 @@
+from datetime import datetime
+import os
+import stat
+
+import pytest
+
+pytest.importorskip('pyschism')
+
+from matplotlib.transforms import Bbox
+
+import setup_model
+
+
+BBOX = Bbox([[-80.0, 25.0], [-70.0, 35.0]])
+START = datetime(2018, 9, 10)
+END = datetime(2018, 9, 14)
+
+
+def _write_sflux(sflux_dir):
+
+    sflux_dir.mkdir(parents=True, exist_ok=True)
+    (sflux_dir / 'sflux_air_1.0001.nc').write_bytes(b'air')
+    (sflux_dir / 'sflux_inputs.txt').write_text('&sflux_inputs\n/\n')
+    os.symlink('sflux_air_1.0001.nc', sflux_dir / 'sflux_air_1.0002.nc')
+
+
+def test_meteo_cache_path_is_deterministic(tmp_path):
+
+    path = setup_model.get_meteo_cache_path('era5', tmp_path, BBOX, START, END)
+
+    assert path == setup_model.get_meteo_cache_path(
+        'era5', tmp_path, BBOX, START, END
+    )
+    assert path.parent == tmp_path
+    assert path.name.startswith('era5_')
+
+
+def test_meteo_cache_path_depends_on_request(tmp_path):
+
+    path = setup_model.get_meteo_cache_path('era5', tmp_path, BBOX, START, END)
+    other_end = datetime(2018, 9, 15)
+    other_bbox = Bbox([[-81.0, 25.0], [-70.0, 35.0]])
+
+    assert path != setup_model.get_meteo_cache_path(
+        'era5', tmp_path, BBOX, START, other_end
+    )
+    assert path != setup_model.get_meteo_cache_path(
+        'era5', tmp_path, other_bbox, START, END
+    )
+    assert path != setup_model.get_meteo_cache_path(
+        'gfs', tmp_path, BBOX, START, END
+    )
+
+
+def test_store_cache_object_does_not_share_inode(tmp_path):
+
+    run_file = tmp_path / 'run' / 'sflux_air_1.0001.nc'
+    run_file.parent.mkdir()
+    run_file.write_bytes(b'air')
+    objects_path = tmp_path / 'objects'
+
+    digest = setup_model._store_cache_object(run_file, objects_path)
+    obj_path = objects_path / digest[:2] / digest
+
+    assert obj_path.read_bytes() == b'air'
+    assert not os.path.samefile(run_file, obj_path)
+    assert not os.stat(obj_path).st_mode & stat.S_IWUSR
+    # the run file is left writable and modifying it keeps the object
+    assert os.stat(run_file).st_mode & stat.S_IWUSR
+    run_file.write_bytes(b'modified')
+    assert obj_path.read_bytes() == b'air'
+
+
+def test_store_cache_object_deduplicates(tmp_path):
+
+    first = tmp_path / 'first.nc'
+    second = tmp_path / 'second.nc'
+    first.write_bytes(b'same')
+    second.write_bytes(b'same')
+    objects_path = tmp_path / 'objects'
+
+    assert setup_model._store_cache_object(
+        first, objects_path
+    ) == setup_model._store_cache_object(second, objects_path)
+    assert len(list(objects_path.rglob('*'))) == 2
+
+
+def test_meteo_cache_round_trip(tmp_path):
+
+    sflux_dir = tmp_path / 'run' / 'sflux'
+    _write_sflux(sflux_dir)
+    meteo_cache_path = setup_model.get_meteo_cache_path(
+        'era5', tmp_path / 'cache' / 'florence_2018', BBOX, START, END
+    )
+    meteo_cache_path.mkdir(parents=True)
+
+    setup_model.copy_meteo_cache(sflux_dir, meteo_cache_path)
+    restored = tmp_path / 'other_run' / 'sflux'
+    restored.mkdir(parents=True)
+
+    assert setup_model.from_meteo_cache(meteo_cache_path, restored)
+    assert (restored / 'sflux_air_1.0001.nc').read_bytes() == b'air'
+    assert (restored / 'sflux_inputs.txt').read_text() == '&sflux_inputs\n/\n'
+    assert os.readlink(restored / 'sflux_air_1.0002.nc') == 'sflux_air_1.0001.nc'
+
+
+def test_incomplete_meteo_cache_is_not_used(tmp_path):
+
+    meteo_cache_path = tmp_path / 'era5_incomplete'
+    meteo_cache_path.mkdir()
+    (meteo_cache_path / '.cache.lock').touch()
+    sflux_dir = tmp_path / 'sflux'
+    sflux_dir.mkdir()
+
+    assert not setup_model.from_meteo_cache(meteo_cache_path, sflux_dir)
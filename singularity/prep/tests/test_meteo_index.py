@@ -0,0 +1,138 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+pytest.importorskip('pyschism')
+
+from matplotlib.transforms import Bbox
+import numpy as np
+import pandas as pd
+import xarray
+
+import setup_model
+
+
+BBOX = Bbox([[-80.0, 25.0], [-70.0, 35.0]])
+START = datetime(2018, 9, 10)
+END = datetime(2018, 9, 14)
+
+
+def _add_entry(main_cache_path, source, bbox, start_date, end_date):
+
+    meteo_cache_path = setup_model.get_meteo_cache_path(
+        source, main_cache_path, bbox, start_date, end_date
+    )
+    meteo_cache_path.mkdir(parents=True)
+    (meteo_cache_path / setup_model.METEO_MANIFEST).write_text(
+        '{"files": {}, "links": {}}'
+    )
+    setup_model.add_to_meteo_index(
+        source, meteo_cache_path, bbox, start_date, end_date
+    )
+    return meteo_cache_path
+
+
+def _write_sflux(path, times):
+
+    lon, lat = np.meshgrid(np.arange(-85.0, -64.0), np.arange(20.0, 41.0))
+    xarray.Dataset(
+        {
+            'prmsl': (
+                ('time', 'ny_grid', 'nx_grid'),
+                np.zeros((len(times), *lon.shape)),
+            ),
+            'lon': (('ny_grid', 'nx_grid'), lon),
+            'lat': (('ny_grid', 'nx_grid'), lat),
+        },
+        coords={'time': times},
+    ).to_netcdf(path)
+
+
+def test_find_meteo_cache_empty(tmp_path):
+
+    assert setup_model.find_meteo_cache(
+        'era5', tmp_path, BBOX, START, END
+    ) == (None, None)
+
+
+def test_find_meteo_cache_covering_entry(tmp_path):
+
+    larger_bbox = Bbox([[-90.0, 20.0], [-60.0, 40.0]])
+    entry = _add_entry(
+        tmp_path, 'era5', larger_bbox,
+        START - timedelta(days=1), END + timedelta(days=1),
+    )
+
+    assert setup_model.find_meteo_cache(
+        'era5', tmp_path, BBOX, START, END
+    ) == (entry, [])
+    assert setup_model.get_cached_entry_bbox(entry).bounds == larger_bbox.bounds
+
+
+def test_find_meteo_cache_least_missing(tmp_path):
+
+    _add_entry(tmp_path, 'era5', BBOX, START - timedelta(days=1), START + timedelta(days=1))
+    best = _add_entry(tmp_path, 'era5', BBOX, START + timedelta(days=1), END)
+
+    path, missing = setup_model.find_meteo_cache(
+        'era5', tmp_path, BBOX, START, END
+    )
+
+    assert path == best
+    assert missing == [(START, START + timedelta(days=1))]
+
+
+def test_find_meteo_cache_skips_unusable_entries(tmp_path):
+
+    # other source, smaller box, no overlap in time
+    _add_entry(tmp_path, 'gfs', BBOX, START, END)
+    _add_entry(tmp_path, 'era5', Bbox([[-75.0, 25.0], [-70.0, 35.0]]), START, END)
+    _add_entry(tmp_path, 'era5', BBOX, END, END + timedelta(days=1))
+    # incomplete entry, i.e. without a manifest
+    incomplete = _add_entry(tmp_path, 'era5', BBOX, START, END + timedelta(hours=1))
+    (incomplete / setup_model.METEO_MANIFEST).unlink()
+
+    assert setup_model.find_meteo_cache(
+        'era5', tmp_path, BBOX, START, END
+    ) == (None, None)
+
+
+def test_subset_sflux_stitches_overlapping_chunks(tmp_path):
+
+    first = tmp_path / 'first'
+    second = tmp_path / 'second'
+    sflux_dir = tmp_path / 'sflux'
+    for path in (first, second, sflux_dir):
+        path.mkdir()
+    _write_sflux(
+        first / 'sflux_air_1.0001.nc',
+        pd.date_range('2018-09-09', '2018-09-12', freq='H'),
+    )
+    _write_sflux(
+        second / 'sflux_air_1.0001.nc',
+        pd.date_range('2018-09-11', '2018-09-15', freq='H'),
+    )
+
+    setup_model.subset_sflux([first, second], sflux_dir, BBOX, START, END)
+
+    outputs = sorted(sflux_dir.glob('sflux_air_1.*.nc'))
+    assert [path.name for path in outputs] == [
+        'sflux_air_1.0001.nc', 'sflux_air_1.0002.nc'
+    ]
+    datasets = [xarray.open_dataset(path) for path in outputs]
+    try:
+        times = np.concatenate([ds.time.values for ds in datasets])
+        # padded by a meteo cycle on each side, no duplicate records
+        np.testing.assert_array_equal(
+            times,
+            pd.date_range('2018-09-09 18:00', '2018-09-14 06:00', freq='H').values,
+        )
+        # padded by a grid cell on each side
+        for ds in datasets:
+            assert ds.lon.values.min() == -81.0
+            assert ds.lon.values.max() == -69.0
+            assert ds.lat.values.min() == 24.0
+            assert ds.lat.values.max() == 36.0
+    finally:
+        for ds in datasets:
+            ds.close()
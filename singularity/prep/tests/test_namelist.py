@@ -0,0 +1,73 @@
+import pytest
+
+f90nml = pytest.importorskip('f90nml')
+
+from namelist import IF_SOURCE_PATCH, patch_namelist, patch_namelists
+
+
+NAMELIST = '''&core
+    dt = 150.0
+/
+
+&opt
+    if_source = 0
+    nws = 2
+/
+'''
+
+
+@pytest.fixture
+def param_nml(tmp_path):
+
+    path = tmp_path / 'param.nml'
+    path.write_text(NAMELIST)
+    return path
+
+
+def test_patch_namelist_values(param_nml):
+
+    patch_namelist(param_nml, [IF_SOURCE_PATCH, {'core': {'dt': 100.0}}])
+
+    nml = f90nml.read(param_nml)
+    assert nml['opt']['if_source'] == 1
+    assert nml['core']['dt'] == 100.0
+    # other values are kept
+    assert nml['opt']['nws'] == 2
+
+
+def test_patch_namelist_new_group(param_nml):
+
+    patch_namelist(param_nml, [{'schout': {'nhot': 1, 'nhot_write': 8640}}])
+
+    nml = f90nml.read(param_nml)
+    assert nml['schout']['nhot'] == 1
+    assert nml['schout']['nhot_write'] == 8640
+
+
+def test_patch_namelist_in_order(param_nml):
+
+    def double_dt(nml):
+        nml['core']['dt'] *= 2
+
+    returned = patch_namelist(
+        param_nml, [{'core': {'dt': 50.0}}, double_dt, {'opt': {'nws': 0}}]
+    )
+
+    nml = f90nml.read(param_nml)
+    assert nml['core']['dt'] == 100.0
+    assert nml['opt']['nws'] == 0
+    assert returned['core']['dt'] == 100.0
+
+
+def test_patch_namelists(tmp_path):
+
+    paths = []
+    for run in range(3):
+        path = tmp_path / f'param_{run}.nml'
+        path.write_text(NAMELIST)
+        paths.append(path)
+
+    patch_namelists(paths, (patch for patch in [IF_SOURCE_PATCH]), max_workers=2)
+
+    for path in paths:
+        assert f90nml.read(path)['opt']['if_source'] == 1
@@ -0,0 +1,230 @@
+import pickle
+
+import pytest
+
+pytest.importorskip('ensembleperturbation')
+chaospy = pytest.importorskip('chaospy')
+
+import numpy
+import pandas
+import xarray
+
+import karhunen_loeve
+import query_surrogate
+import surrogate_fit
+
+VARIABLES = ['max_sustained_wind_speed', 'radius_of_maximum_winds']
+MODES = numpy.array([[1.0, 0.0, 2.0], [0.0, 1.0, -1.0]])
+MEAN_VECTOR = numpy.array([5.0, 6.0, 7.0])
+DEPTH = numpy.array([4.0, 5.0, 8.0])
+# constant, linear in vmax and rmax per mode
+COEFFICIENTS = numpy.array([[0.5, 0.0], [1.0, 0.0], [0.0, 2.0]])
+
+
+def _expansion():
+
+    vmax, rmax = chaospy.variable(2)
+    return chaospy.polynomial([1, vmax, rmax])
+
+
+def _expected(perturbations, log_space=False, depth_adjust=0.0):
+
+    perturbations = numpy.atleast_2d(perturbations)
+    basis = numpy.column_stack([numpy.ones(len(perturbations)), perturbations])
+    values = basis @ COEFFICIENTS @ MODES + MEAN_VECTOR
+    if log_space:
+        values = numpy.exp(values) - depth_adjust
+    return values
+
+
+def _surrogate(**kwargs):
+
+    surrogate = {
+        'variables': VARIABLES,
+        'use_depth': False,
+        'log_space': False,
+        'min_depth': -numpy.inf,
+        'expansion': _expansion(),
+        'kl_coefficients': COEFFICIENTS,
+        'modes': MODES,
+        'mean_vector': MEAN_VECTOR,
+        'nodes': {'depth': DEPTH},
+    }
+    surrogate.update(kwargs)
+    return surrogate
+
+
+def test_predict():
+
+    perturbations = numpy.array([[0.0, 0.0], [1.0, -0.5], [-1.0, 2.0]])
+
+    values = query_surrogate.predict(_surrogate(), perturbations)
+
+    assert values.shape == (3, 3)
+    numpy.testing.assert_allclose(values, _expected(perturbations))
+    # single scenario
+    numpy.testing.assert_allclose(
+        query_surrogate.predict(_surrogate(), perturbations[1]),
+        _expected(perturbations[1]),
+    )
+
+
+def test_predict_depths():
+
+    perturbations = numpy.array([[0.0, 0.0], [-4.0, 0.0]])
+    expected = _expected(perturbations)
+    min_depth = 5.5
+
+    values = query_surrogate.predict(
+        _surrogate(use_depth=True, min_depth=min_depth), perturbations
+    )
+
+    # too shallow nodes are null, others converted from depths
+    expected = numpy.where(expected < min_depth, numpy.nan, expected - DEPTH)
+    numpy.testing.assert_allclose(values, expected)
+    assert numpy.isnan(values[1, 0])
+
+
+def test_predict_elevations():
+
+    perturbations = numpy.array([[-4.0, 0.0]])
+
+    # min_depth only applies to depths, as for the surrogate percentiles
+    values = query_surrogate.predict(
+        _surrogate(use_depth=False, min_depth=5.5), perturbations
+    )
+
+    numpy.testing.assert_allclose(values, _expected(perturbations))
+    assert not numpy.isnan(values).any()
+
+
+def test_predict_log_space():
+
+    depth_adjust = numpy.array([0.0, 1.0, 2.0])
+    perturbations = numpy.array([[0.1, 0.2]])
+
+    values = query_surrogate.predict(
+        _surrogate(
+            log_space=True,
+            depth_adjust=depth_adjust,
+            mean_vector=numpy.zeros(3),
+            modes=MODES / 10,
+        ),
+        perturbations,
+    )
+
+    basis = numpy.array([1.0, 0.1, 0.2])
+    numpy.testing.assert_allclose(
+        values, numpy.exp(basis @ COEFFICIENTS @ (MODES / 10)) - depth_adjust
+    )
+
+
+def _write_analysis(tmp_path, pickled_expansion=False, surrogate_model=None):
+
+    output_directory = tmp_path / 'linear_k1_p1_n0.025'
+    output_directory.mkdir()
+    subset_filename = tmp_path / 'subset.nc'
+    xarray.Dataset(
+        {'zeta_max': (('run', 'node'), numpy.zeros((1, 3)))},
+        coords={
+            'node': [10, 11, 12],
+            'x': ('node', [0.0, 1.0, 2.0]),
+            'y': ('node', [0.0, 0.0, 0.0]),
+            'depth': ('node', DEPTH),
+        },
+    ).to_netcdf(subset_filename)
+
+    eigenvalues = numpy.array([4.0, 0.25])
+    kl_expansion = {
+        'mean_vector': MEAN_VECTOR,
+        'modes': MODES,
+        'eigenvalues': eigenvalues,
+        'neig': 2,
+        'samples': numpy.zeros((4, 2)),
+    }
+    if pickled_expansion:
+        with open(output_directory / karhunen_loeve.KL_PICKLE, 'wb') as kl_handle:
+            pickle.dump(kl_expansion, kl_handle)
+    else:
+        karhunen_loeve.save_karhunen_loeve(
+            kl_expansion, output_directory / karhunen_loeve.KL_DIRECTORY
+        )
+    if surrogate_model is None:
+        surrogate_model = {
+            'coefs': COEFFICIENTS / numpy.sqrt(eigenvalues),
+            'norms': numpy.ones(3),
+            'expansion': _expansion(),
+        }
+    # surrogate of the whitened KL samples, as pickled by the fit
+    with open(output_directory / 'kl_surrogate.npy', 'wb') as surrogate_handle:
+        pickle.dump(surrogate_model, surrogate_handle)
+
+    query_surrogate.write_query_info(
+        output_directory,
+        variables=VARIABLES,
+        subset_filename=subset_filename,
+        use_depth=True,
+        log_space=False,
+        min_depth=0.0,
+        polynomial_order=1,
+    )
+    return output_directory
+
+
+@pytest.mark.parametrize('pickled_expansion', [False, True])
+def test_query(tmp_path, pickled_expansion):
+
+    output_directory = _write_analysis(tmp_path, pickled_expansion)
+
+    surrogate = query_surrogate.load_surrogate(output_directory)
+    prediction = query_surrogate.query(
+        surrogate, pandas.DataFrame([{'vmax': 1.0, 'rmax': -0.5}])
+    )
+
+    # older pickled expansions are converted for memory mapping
+    assert (output_directory / karhunen_loeve.KL_DIRECTORY).exists()
+    assert prediction['node'].values.tolist() == [10, 11, 12]
+    assert prediction['cross_track'].values.tolist() == [0.0]
+    numpy.testing.assert_allclose(
+        prediction['zeta_max'].values, _expected([1.0, -0.5]) - DEPTH
+    )
+
+
+def test_query_without_expansion(tmp_path):
+
+    # e.g. fitted by the library on quadratures, or by older analyses
+    output_directory = _write_analysis(
+        tmp_path,
+        surrogate_model={'coefs': COEFFICIENTS / numpy.sqrt([4.0, 0.25])},
+    )
+
+    surrogate = query_surrogate.load_surrogate(output_directory)
+    prediction = query_surrogate.query(
+        surrogate, pandas.DataFrame([{'vmax': 1.0, 'rmax': -0.5}])
+    )
+
+    expansion = chaospy.generate_expansion(
+        order=1,
+        dist=surrogate_fit.perturbation_distribution(VARIABLES),
+        rule='three_terms_recurrence',
+    )
+    basis = numpy.asarray(expansion(1.0, -0.5), dtype=float)
+    numpy.testing.assert_allclose(
+        prediction['zeta_max'].values[0],
+        basis @ COEFFICIENTS @ MODES + MEAN_VECTOR - DEPTH,
+    )
+
+
+def test_with_expansion():
+
+    distribution = surrogate_fit.perturbation_distribution(VARIABLES)
+    surrogate_model = {'coefs': COEFFICIENTS, 'norms': numpy.ones(3), 'expansion': _expansion()}
+
+    # stored expansions are kept
+    assert surrogate_fit.with_expansion(surrogate_model, distribution) is surrogate_model
+
+    rebuilt = surrogate_fit.with_expansion({'coefs': COEFFICIENTS}, distribution, 2)
+    # all the terms up to order 2 of the 2 variables
+    assert len(rebuilt['expansion']) == 6
+    assert len(rebuilt['norms']) == 6
+    numpy.testing.assert_array_equal(rebuilt['coefs'], COEFFICIENTS)
@@ -0,0 +1,59 @@
+import pytest
+
+pytest.importorskip('pyschism')
+
+from pyschism.mesh.base import Gr3
+
+import wwm
+
+
+def _open_gr3(tmp_path, nodes, elements):
+
+    lines = ['test', f'{len(elements)} {len(nodes)}']
+    lines.extend(f'{id} {x} {y} -1.0' for id, (x, y) in nodes.items())
+    lines.extend(
+        f'{id} {len(verts)} {" ".join(map(str, verts))}'
+        for id, verts in elements.items()
+    )
+    path = tmp_path / 'hgrid.gr3'
+    path.write_text('\n'.join(lines) + '\n')
+    return Gr3.open(path)
+
+
+def _triangles(mesh):
+
+    return [list(map(str, verts)) for verts in mesh.elements.elements.values()]
+
+
+def test_break_quads(tmp_path):
+
+    # node IDs aren't sorted
+    nodes = {
+        10: (0.0, 0.0),
+        30: (1.0, 0.0),
+        20: (1.0, 1.0),
+        40: (0.0, 1.0),
+        50: (2.0, 0.0),
+    }
+    elements = {1: [10, 30, 20, 40], 2: [30, 50, 20]}
+    mesh = _open_gr3(tmp_path, nodes, elements)
+
+    broken = wwm.break_quads(mesh)
+
+    # triangles first, then the two halves of each quad
+    assert _triangles(broken) == [
+        ['30', '50', '20'],
+        ['10', '30', '20'],
+        ['10', '20', '40'],
+    ]
+    assert list(map(str, broken.nodes.id)) == list(map(str, mesh.nodes.id))
+    # input mesh is left as is
+    assert len(mesh.elements.elements) == 2
+
+
+def test_break_quads_without_quads(tmp_path):
+
+    nodes = {1: (0.0, 0.0), 2: (1.0, 0.0), 3: (1.0, 1.0)}
+    mesh = _open_gr3(tmp_path, nodes, {1: [1, 2, 3]})
+
+    assert _triangles(wwm.break_quads(mesh)) == [['1', '2', '3']]
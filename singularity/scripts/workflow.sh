@@ -5,7 +5,11 @@ set -e
 THIS_SCRIPT_DIR=$( cd -- "$( dirname -- "${BASH_SOURCE[0]}" )" &> /dev/null && pwd )
 source $THIS_SCRIPT_DIR/input.conf
 
-if [ $use_wwm == 1 ]; then hotstart_exec='pschism_WWM_PAHM_TVD-VL'; fi
+if [ $use_wwm == 1 ]; then
+    # Spinup also runs WWM to write the wave hotfile
+    spinup_exec='pschism_WWM_PAHM_TVD-VL'
+    hotstart_exec='pschism_WWM_PAHM_TVD-VL'
+fi
 
 # PATH
 export PATH=$L_SCRIPT_DIR:$PATH
@@ -91,14 +95,57 @@ PREP_KWDS+=" --nwm-file $L_NWM_DATASET"
 PREP_KWDS+=" --tpxo-dir $L_TPXO_DATASET"
 if [ $use_wwm == 1 ]; then PREP_KWDS+=" --use-wwm"; fi
 if [ $hydrology == 1 ]; then PREP_KWDS+=" --with-hydrology"; fi
+if [ $shared_inputs == 1 ]; then PREP_KWDS+=" --shared-inputs"; fi
+if [ $stream_members == 1 ]; then PREP_KWDS+=" --stream-members"; fi
 export PREP_KWDS
-# NOTE: We need to wait because run jobs depend on perturbation dirs!
-setup_id=$(sbatch \
-    --wait \
-    --parsable \
-    --export=ALL,PREP_KWDS,STORM=$storm,YEAR=$year,IMG="$L_IMG_DIR/prep.sif" \
-    $L_SCRIPT_DIR/prep.sbatch \
-)
+ensemble_dir=$run_dir/setup/ensemble.dir
+if [ $adaptive_batch_size -gt 0 ] && [ $stream_members == 1 ]; then
+    echo "Adaptive ensemble size is not supported with streaming members"
+    exit 1
+fi
+if [ $stream_members == 1 ]; then
+    # NOTE: Members are submitted as setup marks them ready
+    setup_id=$(sbatch \
+        --parsable \
+        --export=ALL,PREP_KWDS,STORM=$storm,YEAR=$year,IMG="$L_IMG_DIR/prep.sif" \
+        $L_SCRIPT_DIR/prep.sbatch \
+    )
+else
+    # NOTE: We need to wait because run jobs depend on perturbation dirs!
+    setup_id=$(sbatch \
+        --wait \
+        --parsable \
+        --export=ALL,PREP_KWDS,STORM=$storm,YEAR=$year,IMG="$L_IMG_DIR/prep.sif" \
+        $L_SCRIPT_DIR/prep.sbatch \
+    )
+fi
+
+function setup_running {
+    [ -n "$(squeue --noheader --jobs $1 2>/dev/null)" ]
+}
+
+function job_dependency {
+    # Dependency of type $1 on the jobs of $2 (":id1:id2...") that
+    # haven't ended yet
+    # NOTE: Jobs that ended long ago are purged from slurmctld
+    # (MinJobAge) and depending on them is rejected by sbatch
+    local dep_type=$1
+    local jobs=${2#:}
+    if [ -z "$jobs" ]; then return; fi
+
+    local ended
+    ended=$(sacct -X --noheader --parsable2 --format=JobID,State \
+        --jobs ${jobs//:/,} 2>/dev/null \
+        | awk -F'|' -v dep=$dep_type \
+        '$2 == "COMPLETED" || (dep == "afterany" && $2 !~ /^(PENDING|RUNNING|REQUEUED|RESIZING|SUSPENDED)/) {print $1}')
+
+    local pending=""
+    local jobid
+    for jobid in ${jobs//:/ }; do
+        if ! grep -qx "$jobid" <<< "$ended"; then pending+=":$jobid"; fi
+    done
+    if [ -n "$pending" ]; then echo "$dep_type$pending"; fi
+}
 
 
 echo "Launching runs"
@@ -106,28 +153,129 @@ SCHISM_SHARED_ENV=""
 SCHISM_SHARED_ENV+="ALL"
 SCHISM_SHARED_ENV+=",IMG=$L_IMG_DIR/solve.sif"
 SCHISM_SHARED_ENV+=",MODULES=$L_SOLVE_MODULES"
+if [ $stream_members == 1 ]; then
+    while [ ! -f $ensemble_dir/members.json ]; do
+        if ! setup_running $setup_id; then
+            echo "Ensemble setup failed before spinup was ready"
+            exit 1
+        fi
+        sleep 30
+    done
+    spinup_dep=""
+else
+    spinup_dep="-d afterok:$setup_id"
+fi
 spinup_id=$(sbatch \
     --parsable \
-    -d afterok:$setup_id \
-    --export=$SCHISM_SHARED_ENV,SCHISM_DIR="$run_dir/setup/ensemble.dir/spinup",SCHISM_EXEC="$spinup_exec" \
+    $spinup_dep \
+    --export=$SCHISM_SHARED_ENV,SCHISM_DIR="$ensemble_dir/spinup",SCHISM_EXEC="$spinup_exec" \
     $L_SCRIPT_DIR/schism.sbatch
 )
 
 joblist=""
-for i in $run_dir/setup/ensemble.dir/runs/*; do
+batch_joblist=""
+combine_joblist=""
+post_from_store=$incremental_combine
+function submit_run {
+    # NOTE: Declared separately so that a failed sbatch isn't masked
+    local spinup_dep jobid combine_id
+    spinup_dep=$(job_dependency afterok ":$spinup_id")
     jobid=$(
-        sbatch --parsable -d afterok:$spinup_id \
-        --export=$SCHISM_SHARED_ENV,SCHISM_DIR="$i",SCHISM_EXEC="$hotstart_exec" \
+        sbatch --parsable ${spinup_dep:+-d $spinup_dep} \
+        --export=$SCHISM_SHARED_ENV,SCHISM_DIR="$1",SCHISM_EXEC="$hotstart_exec" \
         $L_SCRIPT_DIR/schism.sbatch
         )
+    if [ -z "$jobid" ]; then
+        echo "Failed to submit run $1"
+        exit 1
+    fi
     joblist+=":$jobid"
-done
+    batch_joblist+=":$jobid"
+    if [ $incremental_combine == 1 ]; then
+        # Add member results to the ensemble store as soon as it's done
+        combine_id=$(
+            sbatch --parsable -d afterok:$jobid \
+            --export=ALL,IMG="$L_IMG_DIR/prep.sif",ENSEMBLE_DIR="$ensemble_dir/",SCHISM_DIR="$1" \
+            $L_SCRIPT_DIR/combine_member.sbatch
+            )
+        if [ -z "$combine_id" ]; then
+            echo "Failed to submit combine of run $1"
+            exit 1
+        fi
+        combine_joblist+=":$combine_id"
+    fi
+}
+
+if [ $stream_members == 1 ]; then
+    n_submitted=0
+    while true; do
+        # Check before reading so that no ready member is missed
+        setup_done=0
+        if ! setup_running $setup_id; then setup_done=1; fi
+        if [ -f $ensemble_dir/members.ready ]; then
+            while read -r member; do
+                submit_run $ensemble_dir/runs/$member
+                n_submitted=$((n_submitted + 1))
+            done < <(tail -n +$((n_submitted + 1)) $ensemble_dir/members.ready)
+        fi
+        if [ $setup_done == 1 ]; then break; fi
+        sleep 30
+    done
+    if [ ! -f $ensemble_dir/members.done ]; then
+        echo "Ensemble setup failed after $n_submitted members"
+        exit 1
+    fi
+elif [ $adaptive_batch_size -gt 0 ]; then
+    # Run members in sample order batches until the surrogate converges
+    ordered_runs=()
+    while read -r member; do
+        # Skip anything else printed to stdout
+        if [ -n "$member" ] && [ -d $ensemble_dir/runs/$member ]; then
+            ordered_runs+=($member)
+        fi
+    done < <(singularity run $SINGULARITY_BINDFLAGS $L_IMG_DIR/prep.sif \
+        adapt_ensemble order --ensemble-dir $ensemble_dir)
+
+    batch=0
+    for ((i = 0; i < ${#ordered_runs[@]}; i += adaptive_batch_size)); do
+        batch_joblist=""
+        for member in "${ordered_runs[@]:i:adaptive_batch_size}"; do
+            submit_run $ensemble_dir/runs/$member
+        done
+        # NOTE: Failed runs or analysis shouldn't stop the next batches
+        sbatch \
+            --wait \
+            --parsable \
+            -d afterany${batch_joblist} \
+            --export=ALL,IMG="$L_IMG_DIR/prep.sif",ENSEMBLE_DIR="$ensemble_dir/",BATCH=$batch,TOLERANCE=$adaptive_tolerance \
+            $L_SCRIPT_DIR/adapt.sbatch || true
+        if [ -f $ensemble_dir/analyze/converged ]; then
+            echo "Surrogate converged after $((i + adaptive_batch_size)) members"
+            break
+        fi
+        batch=$((batch + 1))
+    done
+    # NOTE: All the submitted runs have ended by now and failed ones
+    # are tolerated, the members are combined from the store in post
+    joblist=""
+    post_from_store=1
+else
+    for i in $ensemble_dir/runs/*; do
+        submit_run $i
+    done
+fi
 #echo "Wait for ${joblist}"
 #srun -d afterok${joblist} --pty sleep 1
 
 # Post processing
+post_dep=$(job_dependency afterok "$joblist")
+combine_dep=$(job_dependency afterany "$combine_joblist")
+if [ -n "$combine_dep" ]; then
+    # NOTE: Members missed by failed combine jobs are picked up in post
+    post_dep+="${post_dep:+,}$combine_dep"
+fi
 sbatch \
     --parsable \
-    -d afterok${joblist} \
-    --export=ALL,IMG="$L_IMG_DIR/prep.sif",ENSEMBLE_DIR="$run_dir/setup/ensemble.dir/" \
+    ${post_dep:+-d $post_dep} \
+    --export=ALL,IMG="$L_IMG_DIR/prep.sif",ENSEMBLE_DIR="$ensemble_dir/",INCREMENTAL=$post_from_store,SKIP_PLOTS=$skip_plots \
     $L_SCRIPT_DIR/post.sbatch